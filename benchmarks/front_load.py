@@ -0,0 +1,163 @@
+# benchmarks/front_load.py
+"""
+Пропускная способность фронта вебхуков в зависимости от числа воркеров.
+
+Отправляет --updates синтетических апдейтов Telegram (сообщения от --chats разных
+пользователей) по --concurrency одновременно и печатает апдейты в секунду и задержку
+ответа.
+
+По умолчанию для каждого числа воркеров из --workers поднимает в этом процессе
+WorkerFront, а воркерами служат заглушки: каждая разбирает апдейт моделью aiogram и
+тратит --work-ms процессорного времени, изображая обработку хендлерами. Так видно,
+как пропускная способность растет с числом процессов (БД и Telegram не нужны):
+    python -m benchmarks.front_load --workers 1 2 4 --updates 2000 --work-ms 5
+
+С --url апдейты отправляются на уже запущенный фронт (например, с тестовым ботом).
+Настоящие воркеры отвечают, как только апдейт встал в очередь, поэтому здесь
+измеряется скорость приема апдейтов, а 503 означает переполненную очередь:
+    python -m benchmarks.front_load --url http://127.0.0.1:8080/webhook --updates 2000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+
+from aiohttp import ClientError, ClientSession, web
+
+# Фронт запускает воркеры командой "python <этот файл>", поэтому заглушке
+# хватает aiohttp и aiogram, а модули бота импортируются только во фронте
+STUB_WORK_MS = "BENCH_WORK_MS"
+STUB_BASE_PORT = "BENCH_BASE_PORT"
+STUB_WEBHOOK_PATH = "BENCH_WEBHOOK_PATH"
+STUB_PATH = "/webhook"
+
+
+def run_stub_worker():
+    from aiogram.types import Update
+
+    index = int(os.environ["WORKER_INDEX"])
+    work = float(os.environ[STUB_WORK_MS]) / 1000
+
+    async def handle(request: web.Request) -> web.Response:
+        Update.model_validate(json.loads(await request.read()))
+        deadline = time.perf_counter() + work
+        while time.perf_counter() < deadline:
+            pass
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(os.environ[STUB_WEBHOOK_PATH], handle)
+    web.run_app(app, host="127.0.0.1", port=int(os.environ[STUB_BASE_PORT]) + index, print=None, access_log=None)
+
+
+def make_update(update_id: int, user_id: int) -> bytes:
+    chat = {"id": user_id, "type": "private", "first_name": "Bench"}
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": "benchmark",
+        },
+    }).encode()
+
+
+async def replay(url: str, updates: int, chats: int, concurrency: int, secret: str | None) -> str:
+    """Отправляет апдейты и возвращает строку с результатом."""
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    bodies = [make_update(update_id, 9_000_000_000_000 + random.randrange(chats)) for update_id in range(updates)]
+    latencies, statuses = [], {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(session: ClientSession, body: bytes):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, data=body, headers=headers) as response:
+                    await response.read()
+                    status = response.status
+            except (ClientError, asyncio.TimeoutError):
+                status = "error"
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async with ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(send(session, body) for body in bodies))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return (
+        f"{updates} updates in {elapsed:.2f}s ({updates / elapsed:.0f}/s), "
+        f"latency p50 {p50:.0f} ms, p99 {p99:.0f} ms, statuses {statuses}"
+    )
+
+
+async def wait_for_workers(workers: int, base_port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    for index in range(workers):
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", base_port + index), timeout=1):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Stub worker #{index} did not start")
+                await asyncio.sleep(0.1)
+
+
+async def run_with_stub_workers(workers: int, args):
+    # Импорт здесь: модули бота нужны только фронту, заглушки воркеров обходятся без них
+    from tgbot.services.worker_front import WorkerFront
+
+    os.environ.update({
+        STUB_WORK_MS: str(args.work_ms),
+        STUB_BASE_PORT: str(args.base_port),
+        STUB_WEBHOOK_PATH: STUB_PATH,
+    })
+    front = WorkerFront(workers=workers, base_port=args.base_port, webhook_path=STUB_PATH)
+    runner = web.AppRunner(front.create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        await wait_for_workers(workers, args.base_port)
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}{STUB_PATH}"
+        result = await replay(url, args.updates, args.chats, args.concurrency, None)
+        print(f"{workers} worker(s): {result}")
+    finally:
+        await runner.cleanup()
+
+
+async def main(args):
+    if args.url:
+        print(await replay(args.url, args.updates, args.chats, args.concurrency, args.secret))
+        return
+    for workers in args.workers:
+        await run_with_stub_workers(workers, args)
+
+
+if __name__ == "__main__":
+    if "WORKER_INDEX" in os.environ and STUB_WORK_MS in os.environ:
+        run_stub_worker()
+    else:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument("--updates", type=int, default=2000, help="сколько апдейтов отправить")
+        parser.add_argument("--chats", type=int, default=500, help="среди скольких пользователей распределить апдейты")
+        parser.add_argument("--concurrency", type=int, default=100, help="сколько запросов держать одновременно")
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="числа воркеров для сравнения")
+        parser.add_argument("--work-ms", type=float, default=5, help="процессорное время заглушки на апдейт, мс")
+        parser.add_argument("--base-port", type=int, default=18100, help="первый порт заглушек воркеров")
+        parser.add_argument("--url", help="адрес вебхука запущенного фронта вместо заглушек")
+        parser.add_argument("--secret", help="секрет вебхука Telegram для заголовка X-Telegram-Bot-Api-Secret-Token")
+        asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,56 @@
+# benchmarks/loop_lag.py
+
+import asyncio
+import statistics
+import time
+
+
+class LoopLagMonitor:
+    """
+    Замер отзывчивости цикла событий: фоновая задача просыпается каждые interval секунд
+    и записывает, на сколько цикл опоздал ее разбудить. Блокирующий код в цикле
+    сразу виден как рост max_ms.
+
+        async with LoopLagMonitor() as lag:
+            await workload()
+        print(lag.summary())
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+        self._task: asyncio.Task | None = None
+        self._sleep_started = 0.0
+        self.samples_ms: list[float] = []
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        # Даем монитору запуститься до начала нагрузки
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc):
+        # Если цикл был заблокирован до самого конца, незавершенный замер - и есть задержка
+        overdue = time.perf_counter() - self._sleep_started - self._interval
+        if overdue > 0:
+            self.samples_ms.append(overdue * 1000)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._sleep_started = time.perf_counter()
+            await asyncio.sleep(self._interval)
+            self.samples_ms.append((time.perf_counter() - self._sleep_started - self._interval) * 1000)
+
+    @property
+    def max_ms(self) -> float:
+        return max(self.samples_ms, default=0.0)
+
+    @property
+    def p99_ms(self) -> float:
+        if len(self.samples_ms) < 2:
+            return self.max_ms
+        return statistics.quantiles(self.samples_ms, n=100)[98]
+
+    def summary(self) -> str:
+        return f"loop lag max {self.max_ms:.1f} ms, p99 {self.p99_ms:.1f} ms ({len(self.samples_ms)} samples)"
@@ -0,0 +1,74 @@
+# benchmarks/promo_redeem.py
+"""
+Проверка атомарной активации промокода под конкурентной нагрузкой.
+
+Создает промокод на --uses активаций и --redeemers тестовых пользователей, которые
+одновременно (каждый по два раза) пытаются его активировать. Успешных активаций
+должно быть ровно --uses, остаток промокода - 0, повторных активаций одним
+пользователем - ни одной. Тестовые данные удаляются в конце.
+
+Запуск из корня проекта с настроенным .env (нужна рабочая БД):
+    python -m benchmarks.promo_redeem --redeemers 1000 --uses 100
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import delete, func, select
+
+from database import requests as db
+from db import PromoCode, UsedPromoCode, User, async_session_maker, setup_database
+
+# Диапазон ID тестовых пользователей - вне диапазона реальных ID Telegram
+FIRST_USER_ID = 9_000_000_000_000
+
+
+async def main(redeemers: int, uses: int):
+    await setup_database()
+    code = f"BENCH-{uuid.uuid4().hex[:8]}"
+    user_ids = [FIRST_USER_ID + i for i in range(redeemers)]
+    promo = await db.create_promo_code(code, bonus_days=1, max_uses=uses)
+    async with async_session_maker() as session:
+        session.add_all(User(user_id=user_id, full_name="benchmark") for user_id in user_ids)
+        await session.commit()
+
+    try:
+        attempts = [db.redeem_promo_code(user_id, code) for user_id in user_ids * 2]
+        started_at = time.perf_counter()
+        results = await asyncio.gather(*attempts)
+        elapsed = time.perf_counter() - started_at
+
+        outcomes = Counter("ok" if redeemed else reason for redeemed, reason in results)
+        async with async_session_maker() as session:
+            uses_left = await session.scalar(select(PromoCode.uses_left).where(PromoCode.id == promo.id))
+            rows = await session.scalar(select(func.count()).where(UsedPromoCode.promo_code_id == promo.id))
+            per_user = await session.scalar(
+                select(func.count()).select_from(
+                    select(UsedPromoCode.user_id).where(UsedPromoCode.promo_code_id == promo.id)
+                    .group_by(UsedPromoCode.user_id).having(func.count() > 1).subquery()
+                )
+            )
+
+        print(f"{len(attempts)} redemption attempts by {redeemers} users in {elapsed:.2f}s: {dict(outcomes)}")
+        print(f"uses_left={uses_left}, used_promo_codes rows={rows}, users with more than one use={per_user}")
+        expected_ok = min(uses, redeemers)
+        ok = outcomes["ok"] == expected_ok and rows == expected_ok and uses_left == uses - expected_ok and per_user == 0
+        print("OK" if ok else f"FAILED: expected exactly {expected_ok} successful redemptions")
+        return ok
+    finally:
+        async with async_session_maker() as session:
+            await session.execute(delete(UsedPromoCode).where(UsedPromoCode.promo_code_id == promo.id))
+            await session.execute(delete(PromoCode).where(PromoCode.id == promo.id))
+            await session.execute(delete(User).where(User.user_id.in_(user_ids)))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redeemers", type=int, default=1000, help="сколько пользователей активируют промокод")
+    parser.add_argument("--uses", type=int, default=100, help="лимит активаций промокода")
+    args = parser.parse_args()
+    raise SystemExit(0 if asyncio.run(main(args.redeemers, args.uses)) else 1)
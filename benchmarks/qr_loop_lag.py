@@ -0,0 +1,48 @@
+# benchmarks/qr_loop_lag.py
+"""
+Отзывчивость цикла событий при одновременной отрисовке QR-кодов профиля.
+
+Отрисовывает --renders разных QR-кодов (по ссылке подписки на пользователя) одновременно:
+- inline: отрисовка прямо в цикле событий, как было до выноса в пул потоков;
+- executor: create_qr_code - отрисовка в пуле потоков;
+- cached: повторный запрос тех же QR - готовые PNG из LRU-кэша.
+Для каждого способа печатает общее время и задержку цикла событий.
+
+Запуск из корня проекта (БД и .env не нужны):
+    python -m benchmarks.qr_loop_lag --renders 100
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+
+from benchmarks.loop_lag import LoopLagMonitor
+from tgbot.services import qr_generator
+
+
+async def render_inline(data: str):
+    qr_generator._render_png(data)
+
+
+async def run(name: str, links: list[str], render):
+    async with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        await asyncio.gather(*(render(link) for link in links))
+        elapsed = time.perf_counter() - started
+    print(f"{name:>8}: {len(links)} QR codes in {elapsed:.2f}s, {lag.summary()}")
+
+
+async def main(renders: int):
+    # Ссылки разные, чтобы кэш не срабатывал в первых двух прогонах
+    links = [f"https://example.com/sub/{uuid.uuid4().hex}{uuid.uuid4().hex}" for _ in range(renders)]
+    await run("inline", links, render_inline)
+    await run("executor", links, qr_generator.create_qr_code)
+    await run("cached", links, qr_generator.create_qr_code)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--renders", type=int, default=100, help="сколько QR-кодов отрисовывается одновременно")
+    args = parser.parse_args()
+    asyncio.run(main(args.renders))
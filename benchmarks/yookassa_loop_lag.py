@@ -0,0 +1,93 @@
+# benchmarks/yookassa_loop_lag.py
+"""
+Отзывчивость цикла событий при одновременном создании платежей YooKassa.
+
+Поднимает в отдельном потоке заглушку API YooKassa, отвечающую с задержкой --latency,
+и создает --payments платежей одновременно двумя способами:
+- sync: блокирующий HTTP-запрос через requests - так работал синхронный SDK YooKassa;
+- async: YooKassaClient бота на общей сессии aiohttp.
+Для каждого способа печатает общее время и задержку цикла событий.
+
+Запуск из корня проекта с настроенным .env (настоящий API YooKassa не используется):
+    python -m benchmarks.yookassa_loop_lag --payments 50 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+import uuid
+
+import requests
+from aiohttp import web
+
+from benchmarks.loop_lag import LoopLagMonitor
+from tgbot.services import payment
+
+PAYMENT_DATA = {"amount": {"value": "149.50", "currency": "RUB"}, "capture": True, "description": "benchmark"}
+
+
+def start_stub_api(latency: float) -> str:
+    """Запускает заглушку API в отдельном потоке со своим циклом событий и возвращает ее адрес."""
+    async def create_payment(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        payment_id = str(uuid.uuid4())
+        return web.json_response({
+            "id": payment_id,
+            "status": "pending",
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://example.com/pay/{payment_id}"},
+        })
+
+    app = web.Application()
+    app.router.add_post("/v3/payments", create_payment)
+    started = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        address["port"] = runner.addresses[0][1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return f"http://127.0.0.1:{address['port']}/v3"
+
+
+async def create_sync(api_url: str):
+    response = requests.post(
+        f"{api_url}/payments", json=PAYMENT_DATA, auth=("bench", "bench"),
+        headers={"Idempotence-Key": str(uuid.uuid4())}, timeout=30
+    )
+    response.raise_for_status()
+
+
+async def run(name: str, payments: int, create):
+    async with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        await asyncio.gather(*(create() for _ in range(payments)))
+        elapsed = time.perf_counter() - started
+    print(f"{name:>5}: {payments} payments in {elapsed:.2f}s, {lag.summary()}")
+
+
+async def main(payments: int, latency: float):
+    api_url = start_stub_api(latency)
+    payment.YOOKASSA_API_URL = api_url
+    client = payment.YooKassaClient(shop_id="bench", secret_key="bench")
+    try:
+        await run("sync", payments, lambda: create_sync(api_url))
+        await run("async", payments, lambda: client.create_payment(PAYMENT_DATA, str(uuid.uuid4())))
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payments", type=int, default=50, help="сколько платежей создается одновременно")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка ответа заглушки API, секунды")
+    args = parser.parse_args()
+    asyncio.run(main(args.payments, args.latency))
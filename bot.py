@@ -1,7 +1,15 @@
+import time
+
+# Засекаем время старта до тяжелых импортов, чтобы измерить полное время запуска
+STARTED_AT = time.perf_counter()
+
 import asyncio
+from datetime import timedelta
+from functools import partial
 
 from aiogram import Dispatcher, F, Bot
 from aiogram.enums import ChatType
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand, BotCommandScopeDefault, BotCommandScopeChat, BotCommandScopeAllPrivateChats
 from aiogram.utils.callback_answer import CallbackAnswerMiddleware
@@ -14,28 +22,125 @@ from aiohttp import web
 from loader import bot, config, logger, xui_client
 
 # --- ШАГ 2: Импортируем наши новые модули и хендлеры ---
-from db import setup_database_sync
+from db import setup_database, get_pool_metrics
 from tgbot.handlers import routers_list
 from tgbot.middlewares.flood import ThrottlingMiddleware
-from tgbot.handlers.webhook_handlers import yookassa_webhook_handler
+from tgbot.middlewares.rate_limit import RateLimitMiddleware
+from tgbot.middlewares.update_queue import UpdateQueueMiddleware, QueuedRequestHandler
+from tgbot.handlers.webhook_handlers import (
+    yookassa_webhook_handler, process_payment_notification, get_payment_pipeline_metrics
+)
+from tgbot.services import metrics
+from tgbot.services.webhook_queue import WebhookJobQueue
+from tgbot.services.payment import yookassa_client
+from tgbot.services.transaction_log import transaction_log
+from tgbot.services.broadcast import BroadcastManager
+from tgbot.services.reference_cache import reference_cache
+from tgbot.services.fsm_storage import PostgresStorage
+from tgbot.services.cache_bus import ALL, FSM, cache_bus
+from tgbot.services.worker_front import WorkerFront
+from tgbot.services.leader import LeaderElector
+from database.requests import get_replica_metrics
 from utils import broadcaster
 
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
-async def on_startup(bot): # Добавили marzban в аргументы
+
+# Несколько процессов-воркеров возможны только в режиме вебхука
+CLUSTER_WORKERS = config.webhook.workers if config.webhook.use_webhook else 1
+# Команды меню и установку вебхука выполняет только первый воркер
+IS_PRIMARY_WORKER = config.webhook.worker_index in (None, 0)
+
+metrics.register_source("db_pool", get_pool_metrics)
+metrics.register_source("db_replica", get_replica_metrics)
+metrics.register_source("payment_pipeline", get_payment_pipeline_metrics)
+
+# Все исходящие запросы бота проходят через общий ограничитель частоты.
+# Лимит Telegram общий на бота, поэтому делится между воркерами
+rate_limiter = RateLimitMiddleware(global_rate=30 / CLUSTER_WORKERS)
+bot.session.middleware(rate_limiter)
+metrics.register_source("telegram_rate_limit", rate_limiter.get_metrics)
+
+broadcast_manager = BroadcastManager(bot)
+metrics.register_source("broadcasts", broadcast_manager.get_metrics)
+metrics.register_source("cache_bus", cache_bus.get_metrics)
+metrics.register_source("transaction_log", transaction_log.get_metrics)
+
+# Создается при старте: планировщик работает только в процессе-лидере
+leader_elector: LeaderElector | None = None
+
+# Попытки запустить шину сброса кэшей, прежде чем воркер откажется стартовать
+CACHE_BUS_START_ATTEMPTS = 5
+CACHE_BUS_RETRY_DELAY = 2
+
+
+def create_payment_queue(dp: Dispatcher) -> WebhookJobQueue:
+    """Создает очередь обработки вебхуков YooKassa, привязанную к хранилищу FSM диспетчера."""
+    payment_queue = WebhookJobQueue(
+        processor=partial(process_payment_notification, bot=bot, xui=xui_client, storage=dp.storage),
+        workers=config.yookassa.webhook_workers
+    )
+    metrics.register_source("payment_queue", payment_queue.get_metrics)
+    return payment_queue
+
+
+async def start_cache_bus():
+    for attempt in range(1, CACHE_BUS_START_ATTEMPTS + 1):
+        try:
+            await cache_bus.start()
+            return
+        except Exception as e:
+            if attempt == CACHE_BUS_START_ATTEMPTS:
+                raise
+            logger.warning(
+                f"Failed to start cross-process cache invalidation (attempt {attempt}), "
+                f"retrying in {CACHE_BUS_RETRY_DELAY}s: {e}"
+            )
+            await asyncio.sleep(CACHE_BUS_RETRY_DELAY)
+
+
+async def on_startup(bot, dispatcher: Dispatcher, payment_queue: WebhookJobQueue, broadcast_manager: BroadcastManager): # Добавили marzban в аргументы
     """Выполняется при запуске бота."""
     # 1. Инициализируем базу данных
-    setup_database_sync()
+    db_started_at = time.perf_counter()
+    await setup_database()
+    db_bootstrap_ms = (time.perf_counter() - db_started_at) * 1000
+
+    # Изменения тарифов, каналов и состояний FSM должны доходить до остальных воркеров и копий бота.
+    # Без шины воркер работал бы на устаревших данных, поэтому он не стартует, а фронт перезапустит его.
+    # Одиночный процесс с общим хранилищем FSM работает и без шины, но читает состояния прямо из БД
+    storage = dispatcher.storage
+    if CLUSTER_WORKERS > 1 or isinstance(storage, PostgresStorage):
+        try:
+            await start_cache_bus()
+        except Exception as e:
+            if CLUSTER_WORKERS > 1:
+                raise
+            logger.error(f"Cache invalidation is unavailable, FSM read cache disabled: {e}", exc_info=True)
+            storage.disable_read_cache()
 
-    # 2. Запускаем планировщик
+    # Профиль бота, тарифы и каналы нужны почти каждому пользователю - загружаем заранее
     try:
-        scheduler.start()
-        logger.info("✅ Scheduler started successfully.")
+        await reference_cache.warm_up(bot)
     except Exception as e:
-        logger.error(f"❌ Failed to start scheduler: {e}", exc_info=True)
-    
-    # ...
-    from tgbot.services.scheduler import schedule_jobs
-    schedule_jobs(scheduler, bot)
+        logger.error(f"Failed to warm up reference cache: {e}", exc_info=True)
+
+    # Воркеры очереди вебхуков: подхватывают и задачи, не обработанные до перезапуска
+    payment_queue.start()
+
+    # 2. Планировщик и фоновые задачи запустятся, когда этот процесс станет лидером
+    global leader_elector
+    leader_elector = LeaderElector(
+        on_elected=partial(start_background_jobs, bot, payment_queue, broadcast_manager),
+        on_demoted=stop_background_jobs,
+        heartbeat_interval=config.tg_bot.leader_heartbeat_interval
+    )
+    leader_elector.start()
+    metrics.register_source("leader", leader_elector.get_metrics)
+
+    if not IS_PRIMARY_WORKER:
+        logger.info(f"Worker #{config.webhook.worker_index} started; webhook is managed by worker #0.")
+        return
+
     # Можно добавить проверку соединения с Marzban
     # if await marzban.is_online():
     #     logger.info("Marzban panel is online.")
@@ -51,12 +156,69 @@ async def on_startup(bot): # Добавили marzban в аргументы
     # 4. Установка вебхука
     if config.webhook.use_webhook:
         webhook_url = f"https://{config.webhook.domain}{config.webhook.url}"
-        await bot.set_webhook(webhook_url, drop_pending_updates=True) # Добавлено drop_pending_updates
+        # chat_member не приходит без явного запроса - передаем все типы, на которые есть хендлеры
+        await bot.set_webhook(
+            webhook_url,
+            drop_pending_updates=True,
+            allowed_updates=dispatcher.resolve_used_update_types()
+        )
         logger.info(f"Webhook set to: {webhook_url}")
     else:
         await bot.delete_webhook(drop_pending_updates=True)
         logger.info("Polling mode: Webhook deleted and pending updates dropped.")
 
+    logger.info(
+        f"Startup completed in {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms "
+        f"(database bootstrap {db_bootstrap_ms:.0f} ms)."
+    )
+
+async def start_background_jobs(bot: Bot, payment_queue: WebhookJobQueue, broadcast_manager: BroadcastManager):
+    """Запускает планировщик и фоновые задачи, когда процесс становится лидером."""
+    # Рассылки, прерванные перезапуском или сменой лидера, продолжаются с последней контрольной точки
+    await broadcast_manager.resume_stale()
+
+    if scheduler.running:
+        # Процесс снова стал лидером - задачи уже добавлены, просто снимаем паузу
+        scheduler.resume()
+        logger.info("✅ Scheduler resumed.")
+        return
+
+    try:
+        scheduler.start()
+        logger.info("✅ Scheduler started successfully.")
+    except Exception as e:
+        logger.error(f"❌ Failed to start scheduler: {e}", exc_info=True)
+
+    from tgbot.services.scheduler import schedule_jobs
+    schedule_jobs(scheduler, bot, payment_queue, broadcast_manager)
+
+
+def stop_background_jobs():
+    """Останавливает запуск задач по расписанию, когда процесс перестает быть лидером."""
+    if scheduler.running:
+        scheduler.pause()
+        logger.info("Scheduler paused: this process is no longer the leader.")
+
+
+async def on_shutdown(dispatcher: Dispatcher, payment_queue: WebhookJobQueue):
+    """Выполняется при остановке бота."""
+    # Отпускаем лидерство первым, чтобы другая копия бота сразу подхватила планировщик
+    if leader_elector:
+        await leader_elector.stop()
+    await payment_queue.stop()
+    await cache_bus.stop()
+    await yookassa_client.close()
+    # Сохраняем отложенные изменения состояний FSM
+    try:
+        await dispatcher.storage.close()
+    except Exception as e:
+        logger.error(f"Failed to close FSM storage on shutdown: {e}")
+    # Отправляем накопленную сводку транзакций, чтобы она не потерялась
+    try:
+        await transaction_log.close()
+    except Exception as e:
+        logger.error(f"Failed to flush transaction log on shutdown: {e}")
+
 # bot.py
 
 async def register_commands(bot: Bot):
@@ -114,15 +276,50 @@ def register_global_middlewares(dp: Dispatcher):
     logger.info("Global middlewares registered.")
 
 
+def create_storage() -> BaseStorage:
+    """Создает хранилище FSM, выбранное в конфиге."""
+    if config.tg_bot.fsm_storage == "memory":
+        return MemoryStorage()
+    storage = PostgresStorage(
+        ttl=timedelta(hours=config.tg_bot.fsm_state_ttl_hours),
+        # Состояние пользователя может изменить и другой воркер (например, при обработке оплаты)
+        on_saved=partial(cache_bus.publish_keys, FSM)
+    )
+    cache_bus.subscribe(FSM, lambda payload: storage.invalidate(None if payload == ALL else payload.split(",")))
+    metrics.register_source("fsm_storage", storage.get_metrics)
+    return storage
+
+
+def setup_update_queue(dp: Dispatcher, reject_when_full: bool) -> bool:
+    """Включает фоновую обработку апдейтов, если она не отключена в конфиге."""
+    if not config.tg_bot.background_updates:
+        return False
+    update_queue = UpdateQueueMiddleware(
+        workers=config.tg_bot.update_workers,
+        max_queue=config.tg_bot.update_queue_size,
+        reject_when_full=reject_when_full
+    )
+    update_queue.setup(dp)
+    metrics.register_source("update_queue", update_queue.get_metrics)
+    logger.info(f"Background update processing enabled: {config.tg_bot.update_workers} workers.")
+    return True
+
+
 def main_webhook():
-    storage = MemoryStorage()
+    storage = create_storage()
     dp = Dispatcher(storage=storage, xui=xui_client)
     dp.include_routers(*routers_list)
     register_global_middlewares(dp)
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    payment_queue = create_payment_queue(dp)
+    dp['payment_queue'] = payment_queue
+    dp['broadcast_manager'] = broadcast_manager
+    background_updates = setup_update_queue(dp, reject_when_full=True)
 
     app = web.Application()
     app['bot'] = bot
+    app['payment_queue'] = payment_queue
 
     app['xui'] = xui_client # Это у вас уже должно быть
     app['config'] = config # <--- ДОБАВЬТЕ ЭТУ СТРОКУ
@@ -130,34 +327,53 @@ def main_webhook():
     
     # --- НАШИ ИЗМЕНЕНИЯ ---
     # 1. Регистрируем обработчик для вебхуков Telegram
-    telegram_webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    if background_updates:
+        # Апдейт только ставится в очередь, поэтому ответ Telegram не ждет обработки
+        telegram_webhook_handler = QueuedRequestHandler(dispatcher=dp, bot=bot, handle_in_background=False)
+    else:
+        telegram_webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
     telegram_webhook_handler.register(app, path=config.webhook.url)
     
     # 2. Регистрируем обработчик для вебхуков YooKassa на отдельный путь
     app.router.add_post('/yookassa', yookassa_webhook_handler)
+    app.router.add_get('/metrics', metrics.metrics_handler)
 
     setup_application(app, dp, bot=bot, xui=xui_client)
     
-    logger.info("Starting bot in webhook mode...")
-    web.run_app(app, host='0.0.0.0', port=8080)
+    if config.webhook.worker_index is None:
+        logger.info("Starting bot in webhook mode...")
+        web.run_app(app, host='0.0.0.0', port=8080)
+    else:
+        # Воркер за фронтом: принимает запросы только от него
+        port = config.webhook.worker_base_port + config.webhook.worker_index
+        logger.info(f"Starting webhook worker #{config.webhook.worker_index} on port {port}...")
+        web.run_app(app, host='127.0.0.1', port=port)
 
 
 async def main_polling():
-    storage = MemoryStorage()
+    storage = create_storage()
     dp = Dispatcher(storage=storage, xui=xui_client)
     dp.include_routers(*routers_list)
     register_global_middlewares(dp)
     
+    payment_queue = create_payment_queue(dp)
+    dp['payment_queue'] = payment_queue
+    dp['broadcast_manager'] = broadcast_manager
+    dp.shutdown.register(on_shutdown)
+    background_updates = setup_update_queue(dp, reject_when_full=False)
+
     # Вызываем on_startup до запуска основных процессов
-    await on_startup(bot)
+    await on_startup(bot, dp, payment_queue, broadcast_manager)
     
     logger.info("Starting bot in polling mode...")
 
     # Создаем задачу для запуска веб-сервера YooKassa в фоне
-    yookassa_server_task = asyncio.create_task(start_yookassa_webhook_server(dp))
+    yookassa_server_task = asyncio.create_task(start_yookassa_webhook_server(dp, payment_queue))
 
     # Создаем задачу для запуска поллинга Telegram в фоне
-    polling_task = asyncio.create_task(dp.start_polling(bot))
+    # С очередью апдейтов поллинг передает их по одному: при заполненной очереди он ждет,
+    # а не создает неограниченное число задач
+    polling_task = asyncio.create_task(dp.start_polling(bot, handle_as_tasks=not background_updates))
 
     # Запускаем обе задачи и ждем их завершения (что в норме не произойдет)
     await asyncio.gather(
@@ -166,7 +382,7 @@ async def main_polling():
     )
 
 
-async def start_yookassa_webhook_server(dp: Dispatcher):
+async def start_yookassa_webhook_server(dp: Dispatcher, payment_queue: WebhookJobQueue):
     app = web.Application()
     
     # "Внедряем" в приложение все нужные нам объекты
@@ -174,8 +390,10 @@ async def start_yookassa_webhook_server(dp: Dispatcher):
     app['xui'] = xui_client # <--- ВОТ ЭТА СТРОКА РЕШАЕТ ПРОБЛЕМУ
     app['config'] = config         # <--- ЭТА СТРОКА НУЖНА ДЛЯ ОПОВЕЩЕНИЙ АДМИНА
     app['dp'] = dp
+    app['payment_queue'] = payment_queue
     
     app.router.add_post('/yookassa', yookassa_webhook_handler)
+    app.router.add_get('/metrics', metrics.metrics_handler)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -190,9 +408,18 @@ if __name__ == '__main__':
     # Логирование уже настроено в loader.py
     logger.info("Initializing bot...")
     
-    if config.webhook.use_webhook:
+    if config.webhook.use_webhook and CLUSTER_WORKERS > 1 and config.webhook.worker_index is None:
+        # Этот процесс - фронт: запускает воркеры и распределяет между ними вебхуки
+        WorkerFront(
+            workers=CLUSTER_WORKERS,
+            base_port=config.webhook.worker_base_port,
+            webhook_path=config.webhook.url
+        ).run()
+    elif config.webhook.use_webhook:
         main_webhook()
     else:
+        if config.webhook.workers > 1:
+            logger.warning("WORKERS is ignored in polling mode: only one process can poll Telegram.")
         try:
             asyncio.run(main_polling())
         except (KeyboardInterrupt, SystemExit):
@@ -1,9 +1,97 @@
 # database/requests.py (ПОЛНОСТЬЮ ПЕРЕПИСАННАЯ ВЕРСИЯ НА SQLAlchemy)
 
-from datetime import datetime, timedelta
-from sqlalchemy import select, func, update, delete
+import asyncio
+import time as time_module
+from contextvars import ContextVar
+from datetime import date, datetime, time, timedelta
+from functools import wraps
+from sqlalchemy import BigInteger, select, func, update, delete, literal, or_, and_, not_, text
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import async_session_maker, User, Tariff, PromoCode, UsedPromoCode, RequiredChannel
+from db import (async_session_maker, replica_session_maker, db_config,
+                User, Tariff, PromoCode, UsedPromoCode, RequiredChannel, DailyStats, Payment, WebhookJob,
+                Broadcast, QrFileCache, FsmRecord)
+from loader import logger
+
+# =============================================================================
+# --- Маршрутизация запросов только на чтение на реплику ---
+# =============================================================================
+# Функции, помеченные @replica_read, допускают слегка устаревшие данные
+# (статистика, рассылки, планировщик) и выполняются на реплике, если она
+# настроена, доступна и отстает не больше DB_REPLICA_MAX_LAG_SECONDS.
+# Иначе, а также при ошибке на реплике, запрос выполняется на основной БД.
+
+_read_from_replica: ContextVar[bool] = ContextVar("read_from_replica", default=False)
+_replica_state = {"healthy": False, "checked_at": float("-inf"), "lag_seconds": None, "fallbacks": 0}
+
+# Отставание реплики: 0, если все полученные WAL уже применены (иначе на простаивающей
+# основной БД pg_last_xact_replay_timestamp() будет показывать растущее "отставание")
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def _session() -> AsyncSession:
+    """Возвращает сессию реплики внутри @replica_read-функции, иначе - сессию основной БД."""
+    if _read_from_replica.get() and replica_session_maker is not None:
+        return replica_session_maker()
+    return async_session_maker()
+
+
+async def _replica_is_usable() -> bool:
+    """Проверяет (не чаще раза в DB_REPLICA_CHECK_INTERVAL секунд), можно ли читать с реплики."""
+    if replica_session_maker is None:
+        return False
+    now = time_module.monotonic()
+    if now - _replica_state["checked_at"] < db_config.replica_check_interval:
+        return _replica_state["healthy"]
+    # Отмечаем время до запроса, чтобы параллельные вызовы не запускали проверку повторно
+    _replica_state["checked_at"] = now
+    try:
+        async with replica_session_maker() as session:
+            lag = await asyncio.wait_for(session.scalar(REPLICA_LAG_SQL), timeout=5)
+        lag = float(lag) if lag is not None else None
+        healthy = lag is not None and lag <= db_config.replica_max_lag_seconds
+        if not healthy and _replica_state["healthy"]:
+            logger.warning(f"Read replica lag is {lag}s, routing reads to primary.")
+        _replica_state.update(healthy=healthy, lag_seconds=lag)
+    except Exception as e:
+        if _replica_state["healthy"]:
+            logger.warning(f"Read replica is unavailable, routing reads to primary: {e}")
+        _replica_state.update(healthy=False, lag_seconds=None)
+    return _replica_state["healthy"]
+
+
+def replica_read(func):
+    """Помечает функцию как read-only запрос, допускающий чтение с реплики."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if await _replica_is_usable():
+            token = _read_from_replica.set(True)
+            try:
+                return await func(*args, **kwargs)
+            except (DBAPIError, OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Replica read {func.__name__} failed, retrying on primary: {e}")
+                _replica_state.update(healthy=False, checked_at=time_module.monotonic())
+                _replica_state["fallbacks"] += 1
+            finally:
+                _read_from_replica.reset(token)
+        return await func(*args, **kwargs)
+    return wrapper
+
+
+def get_replica_metrics() -> dict:
+    """Возвращает состояние маршрутизации на реплику для /metrics."""
+    return {
+        "configured": replica_session_maker is not None,
+        "healthy": _replica_state["healthy"],
+        "lag_seconds": _replica_state["lag_seconds"],
+        "fallbacks": _replica_state["fallbacks"],
+    }
 
 # =============================================================================
 # --- Функции для работы с пользователями (User) ---
@@ -39,13 +127,44 @@ async def get_user_by_username(username: str) -> User | None:
         result = await session.execute(stmt)
         return result.scalar_one_or_none()
         
+@replica_read
 async def get_all_users_ids() -> list[int]:
     """Асинхронно получает список ID всех пользователей."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         stmt = select(User.user_id)
         result = await session.execute(stmt)
         return result.scalars().all()
 
+async def mark_users_unreachable(user_ids: list[int]):
+    """
+    Асинхронно отмечает пользователей, которым нельзя доставить сообщение
+    (бот заблокирован, аккаунт удален). Они исключаются из массовых отправок.
+    """
+    if not user_ids:
+        return
+    async with async_session_maker() as session:
+        stmt = (
+            update(User)
+            .where(User.user_id.in_(user_ids))
+            .values(
+                blocked_at=func.coalesce(User.blocked_at, datetime.now()),
+                delivery_failures=User.delivery_failures + 1
+            )
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+async def reactivate_user(user_id: int):
+    """Асинхронно снимает отметку недоставляемого чата (пользователь снова написал боту)."""
+    async with async_session_maker() as session:
+        stmt = (
+            update(User)
+            .where(User.user_id == user_id, User.blocked_at.is_not(None))
+            .values(blocked_at=None, delivery_failures=0)
+        )
+        await session.execute(stmt)
+        await session.commit()
+
 async def update_user_xui_username(user_id: int, xui_username: str):
     """Асинхронно обновляет имя пользователя для панели 3x-ui."""
     async with async_session_maker() as session:
@@ -95,26 +214,30 @@ async def delete_user(user_id: int) -> bool:
             return True
         return False
 
+@replica_read
 async def get_users_with_expiring_subscription(days_left: int) -> list[User]:
     """Асинхронно получает пользователей с подпиской, истекающей через X дней."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         target_date_start = datetime.now().date() + timedelta(days=days_left)
         target_date_end = target_date_start + timedelta(days=1)
         stmt = select(User).where(
             User.subscription_end_date >= target_date_start,
-            User.subscription_end_date < target_date_end
+            User.subscription_end_date < target_date_end,
+            User.blocked_at.is_(None)
         )
         result = await session.execute(stmt)
         return result.scalars().all()
 
+@replica_read
 async def get_users_with_expiring_subscription_in_hours(hours: int) -> list[User]:
     """Асинхронно получает пользователей с подпиской, истекающей в ближайшие X часов."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         now = datetime.now()
         expiration_limit = now + timedelta(hours=hours)
         stmt = select(User).where(
             User.subscription_end_date > now,
-            User.subscription_end_date <= expiration_limit
+            User.subscription_end_date <= expiration_limit,
+            User.blocked_at.is_(None)
         )
         result = await session.execute(stmt)
         return result.scalars().all()
@@ -167,24 +290,27 @@ async def delete_tariff_by_id(tariff_id: int):
 # --- Функции для сбора статистики ---
 # =============================================================================
 
+@replica_read
 async def count_all_users() -> int:
     """Асинхронно считает всех пользователей."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         stmt = select(func.count(User.user_id))
         result = await session.execute(stmt)
         return result.scalar()
 
+@replica_read
 async def count_new_users_for_period(days: int) -> int:
     """Асинхронно считает новых пользователей за период."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         start_date = datetime.now() - timedelta(days=days)
         stmt = select(func.count(User.user_id)).where(User.reg_date >= start_date)
         result = await session.execute(stmt)
         return result.scalar()
 
+@replica_read
 async def count_active_subscriptions() -> int:
     """Асинхронно считает активные подписки."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         stmt = select(func.count(User.user_id)).where(
             User.subscription_end_date.is_not(None), 
             User.subscription_end_date > datetime.now()
@@ -192,16 +318,125 @@ async def count_active_subscriptions() -> int:
         result = await session.execute(stmt)
         return result.scalar()
 
+def _payment_stats_columns(start: datetime, end: datetime) -> list:
+    """
+    Скалярные подзапросы по журналу платежей за период: число оплат, выручка и
+    число первых оплат (конверсий). Подставляются в общий SELECT статистики,
+    чтобы вся статистика собиралась за один запрос.
+    """
+    paid_in_period = and_(Payment.status == "succeeded", Payment.paid_at >= start, Payment.paid_at < end)
+    earlier = Payment.__table__.alias("earlier")
+    paid_before = select(earlier.c.id).where(
+        earlier.c.user_id == Payment.user_id,
+        earlier.c.status == "succeeded",
+        earlier.c.paid_at < start
+    ).exists()
+    return [
+        select(func.count(Payment.id)).where(paid_in_period).scalar_subquery().label("payments"),
+        select(func.coalesce(func.sum(Payment.amount), 0)).where(paid_in_period).scalar_subquery().label("revenue"),
+        select(func.count(func.distinct(Payment.user_id))).where(paid_in_period, ~paid_before)
+            .scalar_subquery().label("conversions"),
+    ]
+
+@replica_read
+async def get_live_stats() -> dict:
+    """
+    Асинхронно считает статистику за текущий день одним запросом.
+    Все показатели собираются агрегатами с FILTER за один проход по таблице users.
+    """
+    async with _session() as session:
+        now = datetime.now()
+        today_start = datetime.combine(now.date(), time.min)
+        stmt = select(
+            func.count(User.user_id).label("total_users"),
+            func.count(User.user_id).filter(User.subscription_end_date > now).label("active_subscriptions"),
+            func.count(User.user_id).filter(User.reg_date >= today_start).label("new_users"),
+            func.count(User.user_id).filter(
+                User.subscription_end_date >= today_start,
+                User.subscription_end_date <= now
+            ).label("churned"),
+            *_payment_stats_columns(today_start, now),
+        )
+        result = await session.execute(stmt)
+        return result.one()._asdict()
+
+@replica_read
+async def get_rollup_stats(days: list[int]) -> dict:
+    """
+    Асинхронно суммирует суточные срезы из daily_stats за несколько периодов одним запросом.
+    Период в N дней - это N-1 завершенных дней до сегодняшнего (сегодня считается вживую).
+    Возвращает словарь вида {7: {"new_users": ..., "revenue": ...}, 30: {...}}.
+    """
+    fields = ("new_users", "churned", "payments", "conversions", "revenue")
+    today = date.today()
+    async with _session() as session:
+        columns = []
+        for period in days:
+            period_filter = DailyStats.day >= today - timedelta(days=period - 1)
+            for field in fields:
+                columns.append(
+                    func.coalesce(func.sum(getattr(DailyStats, field)).filter(period_filter), 0).label(f"{field}_{period}")
+                )
+        stmt = select(*columns).where(DailyStats.day >= today - timedelta(days=max(days) - 1), DailyStats.day < today)
+        row = (await session.execute(stmt)).one()._asdict()
+    return {period: {field: row[f"{field}_{period}"] for field in fields} for period in days}
+
+async def get_missing_daily_stats_days(start: date, end: date) -> list[date]:
+    """Асинхронно возвращает дни из диапазона [start, end], для которых еще нет среза в daily_stats."""
+    async with async_session_maker() as session:
+        stmt = select(DailyStats.day).where(DailyStats.day >= start, DailyStats.day <= end)
+        existing = set((await session.execute(stmt)).scalars().all())
+    days = (start + timedelta(days=offset) for offset in range((end - start).days + 1))
+    return [day for day in days if day not in existing]
+
+async def save_daily_stats(day: date):
+    """
+    Асинхронно пересчитывает и сохраняет суточный срез за указанный (завершенный) день.
+    Повторный вызов за тот же день перезаписывает строку.
+
+    Подписки считаются по текущему subscription_end_date, истории продлений нет. Поэтому
+    точен только срез, снятый сразу после конца дня. Для более старых дней (досчет
+    пропусков) active_subscriptions и churned приблизительны: продление после дня
+    сдвигает дату окончания, и истечение в этот день уже не видно.
+    """
+    async with async_session_maker() as session:
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=1)
+        stmt = select(
+            func.count(User.user_id).filter(User.reg_date < day_end).label("total_users"),
+            func.count(User.user_id).filter(User.reg_date >= day_start, User.reg_date < day_end).label("new_users"),
+            func.count(User.user_id).filter(
+                User.reg_date < day_end,
+                User.subscription_end_date >= day_end
+            ).label("active_subscriptions"),
+            func.count(User.user_id).filter(
+                User.subscription_end_date >= day_start,
+                User.subscription_end_date < day_end
+            ).label("churned"),
+            *_payment_stats_columns(day_start, day_end),
+        )
+        values = (await session.execute(stmt)).one()._asdict()
+
+        upsert = pg_insert(DailyStats).values(day=day, **values)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[DailyStats.day],
+            set_={key: upsert.excluded[key] for key in values}
+        )
+        await session.execute(upsert)
+        await session.commit()
+
+@replica_read
 async def count_user_referrals(user_id: int) -> int:
     """Асинхронно считает рефералов пользователя."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         stmt = select(func.count(User.user_id)).where(User.referrer_id == user_id)
         result = await session.execute(stmt)
         return result.scalar()
 
+@replica_read
 async def get_user_referrals(user_id: int) -> list[User]:
     """Асинхронно получает рефералов пользователя."""
-    async with async_session_maker() as session:
+    async with _session() as session:
         stmt = select(User).where(User.referrer_id == user_id)
         result = await session.execute(stmt)
         return result.scalars().all()
@@ -259,26 +494,70 @@ async def get_promo_code(code: str) -> PromoCode | None:
         result = await session.execute(stmt)
         return result.scalar_one_or_none()
 
-async def has_user_used_promo(user_id: int, promo_id: int) -> bool:
-    """Асинхронно проверяет, использовал ли пользователь промокод."""
+async def redeem_promo_code(user_id: int, code: str) -> tuple[PromoCode | None, str | None]:
+    """
+    Атомарно активирует промокод для пользователя за один запрос к БД.
+    Списание использования (uses_left > 0) и запись в used_promo_codes выполняются
+    одним оператором в одной транзакции, поэтому параллельные активации не могут
+    израсходовать промокод сверх лимита или дважды засчитать его одному пользователю.
+
+    Возвращает (промокод, None) при успехе или (None, причина) при отказе, где причина -
+    одна из: "not_found", "expired", "exhausted", "already_used".
+    """
+    now = datetime.now()
     async with async_session_maker() as session:
-        stmt = select(UsedPromoCode).where(
+        already_used = select(UsedPromoCode.id).where(
             UsedPromoCode.user_id == user_id,
-            UsedPromoCode.promo_code_id == promo_id
+            UsedPromoCode.promo_code_id == PromoCode.id
+        ).exists()
+        claimed = (
+            update(PromoCode)
+            .where(
+                func.lower(PromoCode.code) == code.lower(),
+                PromoCode.uses_left > 0,
+                or_(PromoCode.expire_date.is_(None), PromoCode.expire_date >= now),
+                ~already_used
+            )
+            .values(uses_left=PromoCode.uses_left - 1)
+            .returning(
+                PromoCode.id, PromoCode.code, PromoCode.bonus_days, PromoCode.discount_percent,
+                PromoCode.expire_date, PromoCode.max_uses, PromoCode.uses_left
+            )
+            .cte("claimed")
         )
-        result = await session.execute(select(stmt.exists()))
-        return result.scalar()
+        recorded = (
+            pg_insert(UsedPromoCode)
+            .from_select(
+                ["user_id", "promo_code_id", "used_date"],
+                select(literal(user_id, BigInteger), claimed.c.id, literal(now))
+            )
+            .on_conflict_do_nothing(index_elements=["user_id", "promo_code_id"])
+            .returning(UsedPromoCode.promo_code_id)
+            .cte("recorded")
+        )
+        stmt = select(claimed, recorded.c.promo_code_id.is_not(None).label("recorded")).select_from(
+            claimed.outerjoin(recorded, recorded.c.promo_code_id == claimed.c.id)
+        )
+        row = (await session.execute(stmt)).one_or_none()
 
-async def use_promo_code(user_id: int, promo: PromoCode):
-    """Асинхронно отмечает использование промокода."""
-    async with async_session_maker() as session:
-        # Уменьшаем счетчик
-        promo.uses_left -= 1
-        # Создаем запись об использовании
-        new_usage = UsedPromoCode(user_id=user_id, promo_code_id=promo.id)
-        session.add(promo)
-        session.add(new_usage)
-        await session.commit()
+        if row is not None and row.recorded:
+            await session.commit()
+            values = row._asdict()
+            values.pop("recorded")
+            return PromoCode(**values), None
+
+        # Параллельная активация тем же пользователем: откатываем списание
+        await session.rollback()
+
+    # Неуспешный путь - выясняем причину отказа отдельным запросом
+    promo = await get_promo_code(code)
+    if not promo:
+        return None, "not_found"
+    if promo.expire_date and promo.expire_date < now:
+        return None, "expired"
+    if promo.uses_left <= 0:
+        return None, "exhausted"
+    return None, "already_used"
 
 async def delete_promo_code(promo_id: int) -> bool:
     """Асинхронно удаляет промокод."""
@@ -329,4 +608,500 @@ async def set_trial_received(user_id: int):
     async with async_session_maker() as session:
         stmt = update(User).where(User.user_id == user_id).values(has_received_trial=True)
         await session.execute(stmt)
-        await session.commit()
\ No newline at end of file
+        await session.commit()
+
+# =============================================================================
+# --- Функции для журнала платежей (Payment) ---
+# =============================================================================
+
+# Из каких статусов разрешен переход в данный статус
+PAYMENT_TRANSITIONS = {
+    "waiting_for_capture": ("pending",),
+    "succeeded": ("pending", "waiting_for_capture"),
+    "canceled": ("pending", "waiting_for_capture"),
+}
+
+async def create_payment_record(payment_id: str, user_id: int, tariff_id: int, amount: float,
+                                promo_code: str | None = None, confirmation_url: str | None = None,
+                                expires_at: datetime | None = None):
+    """Асинхронно записывает созданный платеж в журнал со статусом pending."""
+    async with async_session_maker() as session:
+        stmt = pg_insert(Payment).values(
+            id=payment_id, user_id=user_id, tariff_id=tariff_id,
+            amount=amount, promo_code=promo_code, status="pending",
+            confirmation_url=confirmation_url, expires_at=expires_at
+        ).on_conflict_do_nothing(index_elements=[Payment.id])
+        await session.execute(stmt)
+        await session.commit()
+
+async def get_reusable_payment(user_id: int, tariff_id: int, amount: float) -> Payment | None:
+    """
+    Асинхронно ищет неоплаченный платеж пользователя за тот же тариф и ту же сумму,
+    ссылку которого еще можно показать повторно (использует индекс ix_payments_pending_lookup).
+    Суммы сравниваются в копейках: цена со скидкой (например, 149.5) в float не всегда
+    совпадает побитово с сохраненной.
+    """
+    async with async_session_maker() as session:
+        stmt = (
+            select(Payment)
+            .where(
+                Payment.user_id == user_id,
+                Payment.tariff_id == tariff_id,
+                func.round(Payment.amount * 100) == round(amount * 100),
+                Payment.status == "pending",
+                Payment.confirmation_url.is_not(None),
+                Payment.expires_at > datetime.now()
+            )
+            .order_by(Payment.created_at.desc())
+            .limit(1)
+        )
+        result = await session.execute(stmt)
+        return result.scalar_one_or_none()
+
+async def claim_payments_for_status_check(limit: int, max_age_hours: int,
+                                          base_interval_seconds: int, max_interval_seconds: int) -> list[Payment]:
+    """
+    Асинхронно выбирает неоплаченные платежи, статус которых пора проверить в YooKassa,
+    и сразу назначает им следующую проверку (одним запросом).
+    Интервал между проверками растет экспоненциально с каждой проверкой:
+    base, 2*base, 4*base ... но не более max_interval_seconds.
+    SKIP LOCKED не дает нескольким копиям бота проверять одни и те же платежи.
+    """
+    now = datetime.now()
+    async with async_session_maker() as session:
+        due_ids = (
+            select(Payment.id)
+            .where(
+                Payment.status.in_(("pending", "waiting_for_capture")),
+                Payment.created_at > now - timedelta(hours=max_age_hours),
+                or_(Payment.next_check_at.is_(None), Payment.next_check_at <= now)
+            )
+            .order_by(Payment.next_check_at.asc().nulls_first())
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        interval_seconds = func.least(base_interval_seconds * func.power(2, Payment.check_count), max_interval_seconds)
+        stmt = (
+            update(Payment)
+            .where(Payment.id.in_(due_ids))
+            .values(
+                check_count=Payment.check_count + 1,
+                next_check_at=literal(now) + func.make_interval(0, 0, 0, 0, 0, 0, interval_seconds)
+            )
+            .returning(Payment)
+        )
+        result = await session.execute(stmt)
+        payments = list(result.scalars().all())
+        await session.commit()
+        return payments
+
+async def apply_payment_status(payment_id: str, status: str, user_id: int, tariff_id: int,
+                               amount: float, promo_code: str | None = None,
+                               lease_seconds: int = 300) -> Payment | None:
+    """
+    Асинхронно переводит платеж в новый статус одним запросом (INSERT ... ON CONFLICT DO UPDATE).
+    Если платежа еще нет в журнале (например, создан до появления журнала), он будет добавлен.
+
+    Возвращает платеж, только если переход действительно произошел. Для статуса succeeded
+    это означает, что вызывающий взял аренду обработки платежа (processing_started_at) на
+    lease_seconds. Обработку завершает complete_payment_processing, а при ошибке аренду снимает
+    release_payment_processing. Пока аренда действует или платеж уже обработан, повторный
+    вебхук получит None и не продлит подписку второй раз.
+    """
+    now = datetime.now()
+    values = dict(
+        id=payment_id, user_id=user_id, tariff_id=tariff_id, amount=amount,
+        promo_code=promo_code, status=status, created_at=now, updated_at=now
+    )
+    if status == "succeeded":
+        values.update(paid_at=now, processing_started_at=now)
+
+    stmt = pg_insert(Payment).values(**values)
+    allowed = Payment.status.in_(PAYMENT_TRANSITIONS.get(status, ()))
+    if status == "succeeded":
+        # Успешный, но не обработанный платеж можно взять снова, если никто не держит аренду
+        # (обработка сорвалась) или аренда истекла (процесс обработчика упал)
+        allowed = or_(allowed, and_(
+            Payment.status == "succeeded",
+            Payment.processed_at.is_(None),
+            or_(Payment.processing_started_at.is_(None),
+                Payment.processing_started_at < now - timedelta(seconds=lease_seconds))
+        ))
+    update_values = {"status": stmt.excluded.status, "updated_at": stmt.excluded.updated_at}
+    if status == "succeeded":
+        update_values.update(
+            paid_at=func.coalesce(Payment.paid_at, stmt.excluded.paid_at),
+            processing_started_at=stmt.excluded.processing_started_at
+        )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Payment.id], set_=update_values, where=allowed
+    ).returning(Payment)
+
+    async with async_session_maker() as session:
+        result = await session.execute(stmt)
+        payment = result.scalar_one_or_none()
+        await session.commit()
+        return payment
+
+async def get_payment_ledger_start() -> datetime | None:
+    """Асинхронно возвращает время создания самого старого платежа в журнале."""
+    async with async_session_maker() as session:
+        return await session.scalar(select(func.min(Payment.created_at)))
+
+async def import_succeeded_payments(records: list[dict]) -> int:
+    """
+    Асинхронно добавляет в журнал успешные платежи, обработанные до его появления
+    (ключи id, user_id, tariff_id, amount, created_at, paid_at). Такие платежи сразу
+    отмечаются обработанными, уже известные журналу не меняются. Возвращает число добавленных.
+    """
+    if not records:
+        return 0
+    async with async_session_maker() as session:
+        stmt = pg_insert(Payment).values([
+            {**record, "status": "succeeded", "updated_at": record["paid_at"], "processed_at": record["paid_at"]}
+            for record in records
+        ]).on_conflict_do_nothing(index_elements=[Payment.id]).returning(Payment.id)
+        result = await session.execute(stmt)
+        imported = len(result.all())
+        await session.commit()
+        return imported
+
+async def get_payment_record(payment_id: str) -> Payment | None:
+    """Асинхронно получает платеж из журнала."""
+    async with async_session_maker() as session:
+        return await session.get(Payment, payment_id)
+
+async def complete_payment_processing(payment_id: str):
+    """Асинхронно отмечает успешный платеж обработанным (подписка продлена) и снимает аренду."""
+    async with async_session_maker() as session:
+        stmt = (
+            update(Payment)
+            .where(Payment.id == payment_id)
+            .values(processed_at=datetime.now(), processing_started_at=None)
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+async def release_payment_processing(payment_id: str):
+    """Асинхронно снимает аренду необработанного платежа, чтобы повторная попытка обработала его заново."""
+    async with async_session_maker() as session:
+        stmt = (
+            update(Payment)
+            .where(Payment.id == payment_id, Payment.processed_at.is_(None))
+            .values(processing_started_at=None)
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+# =============================================================================
+# --- Функции для очереди вебхуков (WebhookJob) ---
+# =============================================================================
+
+async def enqueue_webhook_job(dedup_key: str, kind: str, payload: dict) -> bool:
+    """Асинхронно ставит вебхук в очередь. Возвращает False, если такая задача уже есть."""
+    async with async_session_maker() as session:
+        stmt = pg_insert(WebhookJob).values(
+            dedup_key=dedup_key, kind=kind, payload=payload, status="pending"
+        ).on_conflict_do_nothing(index_elements=[WebhookJob.dedup_key]).returning(WebhookJob.id)
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.scalar_one_or_none() is not None
+
+async def claim_webhook_job(stale_after_seconds: int) -> WebhookJob | None:
+    """
+    Асинхронно захватывает одну готовую к обработке задачу.
+    FOR UPDATE SKIP LOCKED позволяет нескольким воркерам (и процессам) разбирать
+    очередь параллельно, не блокируя друг друга. Задачи, зависшие в processing
+    дольше stale_after_seconds (например, после перезапуска бота), захватываются повторно.
+    """
+    now = datetime.now()
+    async with async_session_maker() as session:
+        next_job = (
+            select(WebhookJob.id)
+            .where(or_(
+                and_(WebhookJob.status == "pending", WebhookJob.run_after <= now),
+                and_(WebhookJob.status == "processing",
+                     WebhookJob.locked_at < now - timedelta(seconds=stale_after_seconds))
+            ))
+            .order_by(WebhookJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(WebhookJob)
+            .where(WebhookJob.id == next_job)
+            .values(status="processing", locked_at=now, attempts=WebhookJob.attempts + 1)
+            .returning(WebhookJob)
+        )
+        result = await session.execute(stmt)
+        job = result.scalar_one_or_none()
+        await session.commit()
+        return job
+
+async def complete_webhook_job(job_id: int):
+    """Асинхронно отмечает задачу как выполненную."""
+    async with async_session_maker() as session:
+        stmt = update(WebhookJob).where(WebhookJob.id == job_id).values(status="done", locked_at=None)
+        await session.execute(stmt)
+        await session.commit()
+
+async def fail_webhook_job(job_id: int, error: str, retry_in_seconds: int | None):
+    """
+    Асинхронно записывает ошибку обработки. Если retry_in_seconds задан, задача вернется
+    в очередь через это время, иначе помечается как окончательно неудачная.
+    """
+    async with async_session_maker() as session:
+        values = {"last_error": error[:1000], "locked_at": None}
+        if retry_in_seconds is None:
+            values["status"] = "failed"
+        else:
+            values.update(status="pending", run_after=datetime.now() + timedelta(seconds=retry_in_seconds))
+        stmt = update(WebhookJob).where(WebhookJob.id == job_id).values(**values)
+        await session.execute(stmt)
+        await session.commit()
+
+async def delete_finished_webhook_jobs(older_than_days: int = 7) -> int:
+    """Асинхронно удаляет выполненные задачи старше указанного числа дней. Возвращает число удаленных."""
+    async with async_session_maker() as session:
+        stmt = delete(WebhookJob).where(
+            WebhookJob.status == "done",
+            WebhookJob.created_at < datetime.now() - timedelta(days=older_than_days)
+        )
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.rowcount
+
+# =============================================================================
+# --- Функции для рассылок (Broadcast) ---
+# =============================================================================
+
+# --- Сегменты аудитории ---
+# Каждый фильтр - функция от параметра, возвращающая SQL-условие на таблицу users.
+# Сегмент - список [имя_фильтра, параметр], условия объединяются через AND.
+
+def _has_paid():
+    # Оплаты до появления журнала переносятся в него из YooKassa при старте (backfill_payment_ledger).
+    # Флаг первой оплаты - дополнительный признак для оплат, которых в журнале все же нет
+    return or_(
+        User.is_first_payment_made == True,
+        select(Payment.id).where(Payment.user_id == User.user_id, Payment.status == "succeeded").exists()
+    )
+
+def _has_referrals():
+    referral = aliased(User)
+    return select(referral.user_id).where(referral.referrer_id == User.user_id).exists()
+
+SEGMENT_FILTERS = {
+    # Подписка активна сейчас
+    "active": lambda _: User.subscription_end_date > datetime.now(),
+    # Подписка закончилась за последние N дней
+    "expired_within": lambda days: and_(
+        User.subscription_end_date <= datetime.now(),
+        User.subscription_end_date > datetime.now() - timedelta(days=days)
+    ),
+    # Получили пробный период, но ни разу не платили
+    "trial_only": lambda _: and_(User.has_received_trial == True, not_(_has_paid())),
+    # Ни одной успешной оплаты
+    "never_paid": lambda _: not_(_has_paid()),
+    # Пригласили хотя бы одного пользователя
+    "referrers": lambda _: _has_referrals(),
+    # Зарегистрировались за последние N дней
+    "registered_within": lambda days: User.reg_date > datetime.now() - timedelta(days=days),
+}
+
+def _segment_conditions(segment: list | None) -> list:
+    """Преобразует описание сегмента в список SQL-условий (плюс исключение недоставляемых чатов)."""
+    conditions = [User.blocked_at.is_(None)]
+    for name, param in segment or []:
+        conditions.append(SEGMENT_FILTERS[name](param))
+    return conditions
+
+@replica_read
+async def count_segment_users(segment: list | None = None) -> int:
+    """Асинхронно считает получателей сегмента (для предпросмотра в админке)."""
+    async with _session() as session:
+        stmt = select(func.count(User.user_id)).where(*_segment_conditions(segment))
+        result = await session.execute(stmt)
+        return result.scalar()
+
+async def create_broadcast(from_chat_id: int, message_ids: list[int], admin_chat_id: int, total: int,
+                           segment: list | None = None) -> Broadcast:
+    """Асинхронно создает задачу рассылки в статусе running. Несколько message_ids - альбом."""
+    async with async_session_maker() as session:
+        broadcast = Broadcast(
+            from_chat_id=from_chat_id, message_id=message_ids[0],
+            message_ids=message_ids if len(message_ids) > 1 else None,
+            admin_chat_id=admin_chat_id, total=total, status="running",
+            segment=segment
+        )
+        session.add(broadcast)
+        await session.commit()
+        await session.refresh(broadcast)
+        return broadcast
+
+async def get_broadcast(broadcast_id: int) -> Broadcast | None:
+    """Асинхронно получает рассылку по ID."""
+    async with async_session_maker() as session:
+        return await session.get(Broadcast, broadcast_id)
+
+async def set_broadcast_progress_message(broadcast_id: int, progress_message_id: int):
+    """Асинхронно запоминает сообщение, в котором показывается прогресс рассылки."""
+    async with async_session_maker() as session:
+        stmt = update(Broadcast).where(Broadcast.id == broadcast_id).values(progress_message_id=progress_message_id)
+        await session.execute(stmt)
+        await session.commit()
+
+@replica_read
+async def get_broadcast_recipients(after_user_id: int, limit: int, segment: list | None = None) -> list[int]:
+    """
+    Асинхронно получает следующую пачку получателей рассылки по ключу (user_id > after_user_id).
+    Постраничный перебор по первичному ключу не замедляется к концу таблицы, в отличие от OFFSET,
+    и не требует загружать весь список получателей в память.
+    """
+    async with _session() as session:
+        stmt = (
+            select(User.user_id)
+            .where(User.user_id > after_user_id, *_segment_conditions(segment))
+            .order_by(User.user_id)
+            .limit(limit)
+        )
+        result = await session.execute(stmt)
+        return list(result.scalars().all())
+
+async def save_broadcast_progress(broadcast_id: int, cursor: int, sent: int, failed: int) -> str | None:
+    """
+    Асинхронно сохраняет контрольную точку рассылки (курсор и прирост счетчиков)
+    и возвращает текущий статус, чтобы воркер узнал о паузе или отмене.
+    """
+    async with async_session_maker() as session:
+        stmt = (
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(
+                cursor=cursor,
+                sent=Broadcast.sent + sent,
+                failed=Broadcast.failed + failed,
+                updated_at=datetime.now()
+            )
+            .returning(Broadcast.status)
+        )
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.scalar_one_or_none()
+
+async def set_broadcast_status(broadcast_id: int, status: str, from_statuses: tuple[str, ...]) -> Broadcast | None:
+    """
+    Асинхронно меняет статус рассылки, только если текущий статус входит в from_statuses.
+    Возвращает обновленную рассылку или None, если переход невозможен.
+    """
+    values = {"status": status, "updated_at": datetime.now()}
+    if status in ("done", "cancelled"):
+        values["finished_at"] = datetime.now()
+    async with async_session_maker() as session:
+        stmt = (
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status.in_(from_statuses))
+            .values(**values)
+            .returning(Broadcast)
+        )
+        result = await session.execute(stmt)
+        broadcast = result.scalar_one_or_none()
+        await session.commit()
+        return broadcast
+
+async def claim_stale_broadcasts(stale_after_seconds: int) -> list[Broadcast]:
+    """
+    Асинхронно захватывает рассылки в статусе running, воркер которых перестал
+    обновлять контрольную точку (например, бот был перезапущен).
+    Обновление updated_at в том же запросе не дает двум процессам продолжить одну рассылку.
+    """
+    now = datetime.now()
+    async with async_session_maker() as session:
+        stmt = (
+            update(Broadcast)
+            .where(
+                Broadcast.status == "running",
+                Broadcast.updated_at < now - timedelta(seconds=stale_after_seconds)
+            )
+            .values(updated_at=now)
+            .returning(Broadcast)
+        )
+        result = await session.execute(stmt)
+        broadcasts = list(result.scalars().all())
+        await session.commit()
+        return broadcasts
+
+# =============================================================================
+# --- Функции для кэша QR-кодов (QrFileCache) ---
+# =============================================================================
+
+async def get_qr_file_id(link_hash: str) -> str | None:
+    """Асинхронно получает file_id ранее загруженного QR-кода для ссылки."""
+    async with async_session_maker() as session:
+        result = await session.execute(select(QrFileCache.file_id).where(QrFileCache.link_hash == link_hash))
+        return result.scalar_one_or_none()
+
+async def save_qr_file_id(link_hash: str, file_id: str):
+    """Асинхронно сохраняет file_id загруженного QR-кода (перезаписывает устаревший)."""
+    async with async_session_maker() as session:
+        stmt = pg_insert(QrFileCache).values(link_hash=link_hash, file_id=file_id, created_at=datetime.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[QrFileCache.link_hash],
+            set_={"file_id": stmt.excluded.file_id, "created_at": stmt.excluded.created_at}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+# =============================================================================
+# --- Функции для хранилища FSM (FsmRecord) ---
+# =============================================================================
+
+async def get_fsm_record(key: str) -> tuple[str | None, str | None] | None:
+    """Асинхронно получает (state, data) по ключу FSM, если запись есть и не истекла."""
+    async with async_session_maker() as session:
+        stmt = select(FsmRecord.state, FsmRecord.data).where(
+            FsmRecord.key == key,
+            FsmRecord.expires_at > datetime.now()
+        )
+        row = (await session.execute(stmt)).first()
+        return tuple(row) if row else None
+
+async def save_fsm_records(records: list[dict], delete_keys: list[str]):
+    """
+    Асинхронно сохраняет пачку записей FSM одной транзакцией.
+    records - словари с key, state, data, expires_at (вставка или перезапись),
+    delete_keys - ключи опустевших записей.
+    """
+    async with async_session_maker() as session:
+        if records:
+            stmt = pg_insert(FsmRecord).values(records)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[FsmRecord.key],
+                set_={
+                    "state": stmt.excluded.state,
+                    "data": stmt.excluded.data,
+                    "expires_at": stmt.excluded.expires_at,
+                }
+            )
+            await session.execute(stmt)
+        if delete_keys:
+            await session.execute(delete(FsmRecord).where(FsmRecord.key.in_(delete_keys)))
+        await session.commit()
+
+async def delete_expired_fsm_records() -> int:
+    """Асинхронно удаляет истекшие записи FSM. Возвращает число удаленных."""
+    async with async_session_maker() as session:
+        result = await session.execute(delete(FsmRecord).where(FsmRecord.expires_at <= datetime.now()))
+        await session.commit()
+        return result.rowcount
+
+# =============================================================================
+# --- Межпроцессные уведомления (LISTEN/NOTIFY) ---
+# =============================================================================
+
+async def notify(channel: str, payload: str):
+    """Асинхронно отправляет NOTIFY всем процессам, слушающим канал."""
+    async with async_session_maker() as session:
+        await session.execute(select(func.pg_notify(channel, payload)))
+        await session.commit()
@@ -1,11 +1,14 @@
 # db.py (ФИНАЛЬНАЯ ВЕРСИЯ НА SQLAlchemy)
 
 import datetime
+import time
 from sqlalchemy import (
-    create_engine, BigInteger, String, DateTime, Boolean, ForeignKey,
-    Integer, Float, select, func
+    BigInteger, String, DateTime, Date, Boolean, ForeignKey,
+    Integer, Float, Index, JSON, Text, UniqueConstraint, select, func, text
 )
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 from config import load_config
@@ -14,12 +17,91 @@ from config import load_config
 config = load_config()
 db_config = config.dataBase
 DSN = f"postgresql+asyncpg://{db_config.user}:{db_config.password}@{db_config.host}:{db_config.port}/{db_config.db_name}"
-SYNC_DSN = f"postgresql://{db_config.user}:{db_config.password}@{db_config.host}:{db_config.port}/{db_config.db_name}"
+# Тот же адрес для прямых соединений asyncpg вне пула (LISTEN, advisory-блокировки)
+ASYNCPG_DSN = DSN.replace("postgresql+asyncpg://", "postgresql://", 1)
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который дополнительно считает время ожидания свободного соединения.
+    Открытие нового соединения ожиданием не считается.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            self._record_wait(time.perf_counter() - started)
+            raise
+        # Время открытия соединения проставляет _create_connection этого же вызова
+        connect_time = record.__dict__.pop("_connect_time", 0.0)
+        self._record_wait(time.perf_counter() - started - connect_time)
+        return record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        record = super()._create_connection()
+        record._connect_time = time.perf_counter() - started
+        return record
+
+    def _record_wait(self, waited: float):
+        self.wait_count += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+
+def _create_engine(dsn: str):
+    """Создает асинхронный движок с общими настройками пула и драйвера."""
+    return create_async_engine(
+        dsn,
+        poolclass=MeteredPool,
+        pool_size=db_config.pool_size,
+        max_overflow=db_config.max_overflow,
+        pool_timeout=db_config.pool_timeout,
+        pool_recycle=db_config.pool_recycle,
+        pool_pre_ping=db_config.pool_pre_ping,
+        connect_args={
+            "statement_cache_size": db_config.statement_cache_size,
+            "server_settings": {
+                "statement_timeout": str(db_config.statement_timeout_ms),
+                "application_name": "vpn_bot",
+            },
+        },
+    )
+
 
 # Создаем асинхронный "движок" и фабрику сессий
-async_engine = create_async_engine(DSN)
+async_engine = _create_engine(DSN)
 async_session_maker = async_sessionmaker(async_engine, expire_on_commit=False)
 
+# Движок реплики создается, только если она настроена
+replica_engine = _create_engine(db_config.replica_dsn) if db_config.replica_dsn else None
+replica_session_maker = async_sessionmaker(replica_engine, expire_on_commit=False) if replica_engine else None
+
+
+def get_pool_metrics() -> dict:
+    """Возвращает текущее состояние пула соединений основной БД."""
+    pool: MeteredPool = async_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": db_config.max_overflow,
+        "waits": pool.wait_count,
+        "wait_time_avg_ms": round(pool.wait_time_total / pool.wait_count * 1000, 2) if pool.wait_count else 0.0,
+        "wait_time_max_ms": round(pool.wait_time_max * 1000, 2),
+        "timeouts": pool.timeouts,
+    }
+
 # --- 2. Базовая модель ---
 class Base(DeclarativeBase):
     pass
@@ -37,10 +119,14 @@ class User(Base):
     # --- НОВОЕ ПОЛЕ ДЛЯ ОТСЛЕЖИВАНИЯ ТРИАЛА ---
     has_received_trial: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     
-    referrer_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id', ondelete='SET NULL'), nullable=True)
+    referrer_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id', ondelete='SET NULL'), nullable=True, index=True)
     referral_bonus_days: Mapped[int] = mapped_column(Integer, default=0)
     is_first_payment_made: Mapped[bool] = mapped_column(Boolean, default=False)
     support_topic_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    # Недоставляемые чаты: пользователь заблокировал бота или удалил аккаунт.
+    # Такие пользователи пропускаются в рассылках и напоминаниях до следующего /start.
+    blocked_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    delivery_failures: Mapped[int] = mapped_column(Integer, default=0, server_default=text('0'))
 
 class Tariff(Base):
     __tablename__ = 'tariffs'
@@ -62,6 +148,8 @@ class PromoCode(Base):
 
 class UsedPromoCode(Base):
     __tablename__ = 'used_promo_codes'
+    # Один пользователь - одно использование промокода (нужно для ON CONFLICT при активации)
+    __table_args__ = (UniqueConstraint('user_id', 'promo_code_id', name='uq_used_promo_codes_user_promo'),)
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id'))
     promo_code_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('promo_codes.id'))
@@ -74,10 +162,200 @@ class RequiredChannel(Base):
     channel_name: Mapped[str] = mapped_column(String)
     channel_url: Mapped[str] = mapped_column(String)
 
+class DailyStats(Base):
+    """Суточный срез статистики. Заполняется планировщиком раз в сутки."""
+    __tablename__ = 'daily_stats'
+    day: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    total_users: Mapped[int] = mapped_column(Integer, default=0)
+    new_users: Mapped[int] = mapped_column(Integer, default=0)
+    active_subscriptions: Mapped[int] = mapped_column(Integer, default=0)
+    churned: Mapped[int] = mapped_column(Integer, default=0)
+    # Считаются по журналу платежей (payments)
+    payments: Mapped[int] = mapped_column(Integer, default=0)
+    conversions: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[float] = mapped_column(Float, default=0)
+
+
+class Payment(Base):
+    """
+    Журнал платежей YooKassa. Ключ - ID платежа в YooKassa.
+    Статусы: pending -> waiting_for_capture -> succeeded / canceled.
+    """
+    __tablename__ = 'payments'
+    __table_args__ = (
+        Index('ix_payments_user_status', 'user_id', 'status'),
+        # Поиск неоплаченной ссылки для повторного показа: только по pending-платежам
+        Index('ix_payments_pending_lookup', 'user_id', 'tariff_id', 'amount',
+              postgresql_where=text("status = 'pending'")),
+    )
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    tariff_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    amount: Mapped[float] = mapped_column(Float)
+    promo_code: Mapped[str] = mapped_column(String, nullable=True)
+    status: Mapped[str] = mapped_column(String, default='pending')
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    paid_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True, index=True)
+    # Время, когда подписка по успешному платежу продлена.
+    # NULL у успешного платежа означает, что обработку нужно выполнить (или повторить).
+    processed_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    # Аренда обработки: когда обработчик взял платеж. Пока аренда не истекла, другие
+    # обработчики платеж не берут; аренду упавшего процесса можно перехватить по истечении
+    processing_started_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    # Ссылка на оплату и срок, до которого ее можно показывать повторно
+    confirmation_url: Mapped[str] = mapped_column(String, nullable=True)
+    expires_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    # Опрос статуса на случай потерянного вебхука: число проверок и время следующей
+    check_count: Mapped[int] = mapped_column(Integer, default=0, server_default=text('0'))
+    next_check_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+class WebhookJob(Base):
+    """
+    Очередь входящих вебхуков на обработку. Вебхук сохраняется сюда сразу после проверки,
+    а обрабатывается фоновыми воркерами (захват через FOR UPDATE SKIP LOCKED).
+    Статусы: pending -> processing -> done / failed.
+    """
+    __tablename__ = 'webhook_jobs'
+    __table_args__ = (Index('ix_webhook_jobs_status_run_after', 'status', 'run_after'),)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    # Ключ дедупликации: повторная доставка того же события не создает новую задачу
+    dedup_key: Mapped[str] = mapped_column(String, unique=True)
+    kind: Mapped[str] = mapped_column(String)
+    payload: Mapped[dict] = mapped_column(JSON)
+    status: Mapped[str] = mapped_column(String, default='pending')
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_after: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    locked_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+
+class Broadcast(Base):
+    """
+    Задача рассылки. Сообщение не хранится - рассылается копия исходного сообщения
+    (from_chat_id, message_id). cursor - ID последнего обработанного пользователя,
+    получатели перебираются по возрастанию ID, поэтому после перезапуска рассылка
+    продолжается с места последней контрольной точки.
+    updated_at обновляется на каждой контрольной точке и служит признаком живого воркера.
+    Статусы: running -> done / paused -> running / cancelled.
+    """
+    __tablename__ = 'broadcasts'
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    from_chat_id: Mapped[int] = mapped_column(BigInteger)
+    message_id: Mapped[int] = mapped_column(BigInteger)
+    # Для альбома - ID всех его сообщений (отправляются одним copy_messages), иначе NULL
+    message_ids: Mapped[list] = mapped_column(JSON, nullable=True)
+    # Куда выводить прогресс: чат администратора и сообщение, которое редактируется
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    status: Mapped[str] = mapped_column(String, default='running', index=True)
+    cursor: Mapped[int] = mapped_column(BigInteger, default=0)
+    # Аудитория: список фильтров [[имя, параметр], ...], объединяемых через AND. NULL - все пользователи
+    segment: Mapped[list] = mapped_column(JSON, nullable=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    finished_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+class QrFileCache(Base):
+    """
+    Кэш загруженных в Telegram QR-кодов: хэш ссылки-конфига -> file_id фото.
+    Повторный показ профиля отправляет фото по file_id, без отрисовки и загрузки.
+    """
+    __tablename__ = 'qr_file_cache'
+    link_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    file_id: Mapped[str] = mapped_column(String)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+
+class FsmRecord(Base):
+    """
+    Состояние FSM и его данные для одного ключа (бот, чат, пользователь, тема, назначение).
+    data - компактный JSON. Записи с истекшим expires_at считаются отсутствующими
+    и периодически удаляются планировщиком.
+    """
+    __tablename__ = 'fsm_states'
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    state: Mapped[str] = mapped_column(String, nullable=True)
+    data: Mapped[str] = mapped_column(Text, nullable=True)
+    expires_at: Mapped[datetime.datetime] = mapped_column(DateTime, index=True)
+
+# --- 4. Схема БД: создание таблиц и миграции ---
+
+# create_all создает только недостающие таблицы и не трогает существующие.
+# Все изменения уже существующих таблиц добавляются сюда в виде миграций
+# с уникальным идентификатором; каждая применяется ровно один раз.
+MIGRATIONS: list[tuple[str, str]] = [
+    (
+        # Дубликаты активаций, накопившиеся до атомарной активации, иначе не дадут создать уникальный индекс.
+        # Оставляем самую раннюю запись
+        "0000_used_promo_codes_dedupe",
+        "DELETE FROM used_promo_codes duplicate USING used_promo_codes original "
+        "WHERE duplicate.user_id = original.user_id AND duplicate.promo_code_id = original.promo_code_id "
+        "AND duplicate.id > original.id"
+    ),
+    (
+        "0001_used_promo_codes_unique",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_used_promo_codes_user_promo "
+        "ON used_promo_codes (user_id, promo_code_id)"
+    ),
+    (
+        "0002_payments_confirmation_url",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS confirmation_url VARCHAR, "
+        "ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITHOUT TIME ZONE"
+    ),
+    (
+        "0003_payments_pending_lookup_index",
+        "CREATE INDEX IF NOT EXISTS ix_payments_pending_lookup "
+        "ON payments (user_id, tariff_id, amount) WHERE status = 'pending'"
+    ),
+    (
+        "0004_payments_status_checks",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS check_count INTEGER NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP WITHOUT TIME ZONE"
+    ),
+    (
+        "0005_users_delivery_state",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP WITHOUT TIME ZONE, "
+        "ADD COLUMN IF NOT EXISTS delivery_failures INTEGER NOT NULL DEFAULT 0"
+    ),
+    (
+        "0006_broadcasts_segment",
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS segment JSON"
+    ),
+    (
+        "0007_users_referrer_index",
+        "CREATE INDEX IF NOT EXISTS ix_users_referrer_id ON users (referrer_id)"
+    ),
+    (
+        "0008_broadcasts_message_ids",
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS message_ids JSON"
+    ),
+    (
+        "0009_payments_processing_lease",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMP WITHOUT TIME ZONE"
+    ),
+]
+
+# Произвольный ключ advisory-блокировки, чтобы несколько копий бота не применяли миграции одновременно
+SCHEMA_LOCK_KEY = 7_301_001
+
 
-# --- 4. Функция для создания таблиц ---
-def setup_database_sync():
-    """Создает таблицы синхронно при старте бота."""
-    engine = create_engine(SYNC_DSN)
-    Base.metadata.create_all(engine)
-    print("INFO: Database tables created or already exist via SQLAlchemy.")
\ No newline at end of file
+async def setup_database():
+    """Асинхронно создает таблицы и применяет новые миграции при старте бота."""
+    async with async_engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT now())"
+        ))
+        applied = set((await conn.execute(text("SELECT version FROM schema_migrations"))).scalars())
+        for version, statement in MIGRATIONS:
+            if version in applied:
+                continue
+            await conn.execute(text(statement))
+            await conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"), {"version": version})
+            print(f"INFO: Applied database migration {version}.")
+    print("INFO: Database tables created or already exist via SQLAlchemy.")
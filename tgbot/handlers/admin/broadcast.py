@@ -1,7 +1,8 @@
 # tgbot/handlers/admin/broadcast.py
 
 import asyncio
-from aiogram import Router, F, Bot
+
+from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
@@ -9,8 +10,10 @@ from loader import logger
 
 # --- Фильтры, клавиатуры, БД ---
 from tgbot.filters.admin import IsAdmin
+from tgbot.services.broadcast import BroadcastManager, format_broadcast_progress
 from database import requests as db
-from tgbot.keyboards.inline import confirm_broadcast_keyboard, cancel_fsm_keyboard, admin_main_menu_keyboard
+from tgbot.keyboards.inline import (confirm_broadcast_keyboard, cancel_fsm_keyboard, admin_main_menu_keyboard,
+                                    broadcast_control_keyboard, broadcast_segments_keyboard)
 
 admin_broadcast_router = Router()
 admin_broadcast_router.message.filter(IsAdmin())
@@ -20,11 +23,55 @@ admin_broadcast_router.callback_query.filter(IsAdmin())
 # --- Состояния FSM для рассылки ---
 class BroadcastFSM(StatesGroup):
     get_message = State()
+    choose_segment = State()
     confirm = State()
 
 
+# --- Сегменты аудитории: ключ кнопки -> (название, фильтр из db.SEGMENT_FILTERS) ---
+BROADCAST_SEGMENTS = {
+    "active": ("Активная подписка", ["active", None]),
+    "exp7": ("Истекла за 7 дней", ["expired_within", 7]),
+    "exp30": ("Истекла за 30 дней", ["expired_within", 30]),
+    "trial": ("Только пробный", ["trial_only", None]),
+    "nopay": ("Ни разу не платили", ["never_paid", None]),
+    "ref": ("Приглашали друзей", ["referrers", None]),
+    "new7": ("Новые за 7 дней", ["registered_within", 7]),
+    "new30": ("Новые за 30 дней", ["registered_within", 30]),
+}
+
+
+def build_segment(selected: list[str]) -> list | None:
+    """Собирает описание сегмента из выбранных кнопок. Пустой выбор - все пользователи."""
+    return [BROADCAST_SEGMENTS[key][1] for key in selected] or None
+
+
+def describe_segment(selected: list[str]) -> str:
+    if not selected:
+        return "все пользователи"
+    return " + ".join(BROADCAST_SEGMENTS[key][0] for key in selected)
+
+
+async def show_segment_menu(message: Message, selected: list[str], edit: bool):
+    """Показывает выбор аудитории с количеством получателей."""
+    recipients = await db.count_segment_users(build_segment(selected))
+    text = (
+        "👥 <b>Выберите аудиторию рассылки.</b>\n\n"
+        "Выбранные фильтры объединяются (должны выполняться все). Без фильтров - всем пользователям.\n\n"
+        f"Аудитория: <b>{describe_segment(selected)}</b>\n"
+        f"Получателей: <b>{recipients}</b>"
+    )
+    markup = broadcast_segments_keyboard(
+        {key: title for key, (title, _) in BROADCAST_SEGMENTS.items()}, selected, recipients
+    )
+    if edit:
+        await message.edit_text(text, reply_markup=markup)
+    else:
+        await message.answer(text, reply_markup=markup)
+
+
 # --- Обработчик для кнопки "Отмена" внутри FSM ---
 @admin_broadcast_router.callback_query(F.data == "admin_main_menu", BroadcastFSM.get_message)
+@admin_broadcast_router.callback_query(F.data == "admin_main_menu", BroadcastFSM.choose_segment)
 @admin_broadcast_router.callback_query(F.data == "admin_main_menu", BroadcastFSM.confirm)
 async def cancel_broadcast_handler(call: CallbackQuery, state: FSMContext):
     await state.clear()
@@ -36,24 +83,86 @@ async def cancel_broadcast_handler(call: CallbackQuery, state: FSMContext):
 async def start_broadcast(call: CallbackQuery, state: FSMContext):
     """Шаг 1: Запрашиваем сообщение для рассылки."""
     await call.message.edit_text(
-        "Пришлите сообщение, которое вы хотите разослать всем пользователям.\n\n"
+        "Пришлите сообщение, которое вы хотите разослать.\n\n"
         "Вы можете присылать текст, фото, видео, документы и использовать форматирование.",
         reply_markup=cancel_fsm_keyboard("admin_main_menu")
     )
     await state.set_state(BroadcastFSM.get_message)
 
 
-# --- Получение сообщения и запрос подтверждения ---
+# --- Получение сообщения и выбор аудитории ---
+# Альбом приходит несколькими отдельными сообщениями с общим media_group_id.
+# Хендлер только дописывает ID в буфер альбома и сразу возвращается, чтобы не задерживать
+# очередь апдейтов чата; альбом считается собранным, когда ALBUM_COLLECT_DELAY секунд
+# не приходило новых частей.
+ALBUM_COLLECT_DELAY = 1.0
+_album_buffer: dict[str, dict] = {}
+
+
+async def _save_broadcast_message(message: Message, state: FSMContext, message_ids: list[int]):
+    # Храним только ID - при рассылке сообщение копируется (фото, видео, кнопки и форматирование сохраняются)
+    await state.update_data(
+        broadcast_chat_id=message.chat.id,
+        broadcast_message_ids=message_ids,
+        segment_keys=[]
+    )
+    await show_segment_menu(message, [], edit=False)
+    await state.set_state(BroadcastFSM.choose_segment)
+
+
+async def _finish_album(media_group_id: str, message: Message, state: FSMContext):
+    """Ждет, пока части альбома перестанут приходить, и сохраняет альбом как одно сообщение рассылки."""
+    album = _album_buffer[media_group_id]
+    try:
+        while (delay := album["last_part_at"] + ALBUM_COLLECT_DELAY - asyncio.get_running_loop().time()) > 0:
+            await asyncio.sleep(delay)
+        _album_buffer.pop(media_group_id)
+        # Пока альбом собирался, рассылку могли отменить - тогда альбом не нужен
+        if await state.get_state() != BroadcastFSM.get_message.state:
+            return
+        await _save_broadcast_message(message, state, sorted(album["message_ids"]))
+    except Exception as e:
+        _album_buffer.pop(media_group_id, None)
+        logger.error(f"Failed to collect broadcast album {media_group_id}: {e}", exc_info=True)
+
+
 @admin_broadcast_router.message(BroadcastFSM.get_message)
 async def get_broadcast_message(message: Message, state: FSMContext):
-    """Шаг 2: Получаем сообщение, показываем его для предпросмотра и запрашиваем подтверждение."""
-    # Сохраняем все сообщение целиком, чтобы можно было его скопировать
-    # Это позволяет сохранить фото, видео, кнопки и т.д.
-    await state.update_data(message_to_send=message)
-    
-    # Отправляем сообщение "для предпросмотра"
-    await message.answer(
-        "Вот так будет выглядеть ваше сообщение для рассылки. Вы уверены, что хотите его отправить?",
+    """Шаг 2: Получаем сообщение (или альбом) и предлагаем выбрать аудиторию."""
+    if not message.media_group_id:
+        await _save_broadcast_message(message, state, [message.message_id])
+        return
+
+    now = asyncio.get_running_loop().time()
+    album = _album_buffer.get(message.media_group_id)
+    if album is None:
+        album = _album_buffer[message.media_group_id] = {"message_ids": [], "last_part_at": now}
+        album["task"] = asyncio.create_task(_finish_album(message.media_group_id, message, state))
+    album["message_ids"].append(message.message_id)
+    album["last_part_at"] = now
+
+
+@admin_broadcast_router.callback_query(F.data.startswith("bc_seg_"), F.data != "bc_seg_done", BroadcastFSM.choose_segment)
+async def toggle_broadcast_segment(call: CallbackQuery, state: FSMContext):
+    """Включает или выключает фильтр аудитории и пересчитывает получателей."""
+    key = call.data.removeprefix("bc_seg_")
+    if key not in BROADCAST_SEGMENTS:
+        return
+    selected = (await state.get_data()).get("segment_keys", [])
+    selected = [k for k in selected if k != key] if key in selected else selected + [key]
+    await state.update_data(segment_keys=selected)
+    await show_segment_menu(call.message, selected, edit=True)
+
+
+@admin_broadcast_router.callback_query(F.data == "bc_seg_done", BroadcastFSM.choose_segment)
+async def confirm_broadcast_segment(call: CallbackQuery, state: FSMContext):
+    """Шаг 3: Показываем итоговую аудиторию и запрашиваем подтверждение."""
+    selected = (await state.get_data()).get("segment_keys", [])
+    recipients = await db.count_segment_users(build_segment(selected))
+    await call.message.edit_text(
+        f"Аудитория: <b>{describe_segment(selected)}</b>\n"
+        f"Получателей: <b>{recipients}</b>\n\n"
+        "Вы уверены, что хотите отправить рассылку?",
         reply_markup=confirm_broadcast_keyboard()
     )
     await state.set_state(BroadcastFSM.confirm)
@@ -61,13 +170,15 @@ async def get_broadcast_message(message: Message, state: FSMContext):
 
 # --- Запуск рассылки после подтверждения ---
 @admin_broadcast_router.callback_query(F.data == "broadcast_start", BroadcastFSM.confirm)
-async def confirm_and_run_broadcast(call: CallbackQuery, state: FSMContext, bot: Bot):
-    """Шаг 3: Запускаем процесс рассылки."""
+async def confirm_and_run_broadcast(call: CallbackQuery, state: FSMContext, broadcast_manager: BroadcastManager):
+    """Шаг 4: Создаем задачу рассылки и запускаем ее в фоне."""
     data = await state.get_data()
-    message_to_send: Message = data.get("message_to_send")
+    from_chat_id = data.get("broadcast_chat_id")
+    message_ids = data.get("broadcast_message_ids")
+    segment = build_segment(data.get("segment_keys", []))
     await state.clear()
 
-    if not message_to_send:
+    if not message_ids:
         await call.message.edit_text(
             "❌ <b>Ошибка:</b> не найдено сообщение для рассылки. Попробуйте снова.",
             reply_markup=admin_main_menu_keyboard(),
@@ -75,36 +186,45 @@ async def confirm_and_run_broadcast(call: CallbackQuery, state: FSMContext, bot:
         )
         return
 
-    users_ids = await db.get_all_users_ids()
-    total_users = len(users_ids)
-    
+    # Заблокировавших бота не считаем - им рассылка не отправляется
+    total_users = await db.count_segment_users(segment)
+    broadcast = await db.create_broadcast(
+        from_chat_id=from_chat_id,
+        message_ids=message_ids,
+        admin_chat_id=call.from_user.id,
+        total=total_users,
+        segment=segment
+    )
+
+    # Это сообщение будет обновляться по ходу рассылки
     await call.message.edit_text(
-        f"🚀 <b>Рассылка запущена!</b>\n\n"
-        f"Сообщение будет отправлено <b>{total_users}</b> пользователям. "
-        "Это может занять некоторое время. Вы получите отчет по завершении.",
-        reply_markup=None,
+        format_broadcast_progress(broadcast),
+        reply_markup=broadcast_control_keyboard(broadcast.id, broadcast.status),
         parse_mode="HTML"
     )
+    await db.set_broadcast_progress_message(broadcast.id, call.message.message_id)
 
-    # --- Сам процесс рассылки ---
-    success_count = 0
-    errors_count = 0
-    
-    for user_id in users_ids:
-        try:
-            await message_to_send.copy_to(chat_id=user_id)
-            success_count += 1
-            await asyncio.sleep(0.025)
-        except Exception as e:
-            errors_count += 1
-            logger.warning(f"Broadcast failed for user {user_id}. Error: {e}")
-            
-    # --- Финальный отчет админу ---
-    await call.bot.send_message(
-        chat_id=call.from_user.id,
-        text=(
-            f"✅ <b>Рассылка завершена!</b>\n\n"
-            f"👍 Отправлено: <b>{success_count}</b>\n"
-            f"👎 Ошибок: <b>{errors_count}</b>"
-        ),
-    )
+    logger.info(f"Admin {call.from_user.id} started broadcast {broadcast.id} to {total_users} users.")
+    broadcast_manager.start(broadcast.id)
+
+
+# --- Управление идущей рассылкой ---
+@admin_broadcast_router.callback_query(F.data.startswith("broadcast_pause_"))
+async def pause_broadcast_handler(call: CallbackQuery, broadcast_manager: BroadcastManager):
+    broadcast_id = int(call.data.split("_")[2])
+    if not await broadcast_manager.pause(broadcast_id):
+        await call.answer("Рассылка уже не выполняется.", show_alert=True)
+
+
+@admin_broadcast_router.callback_query(F.data.startswith("broadcast_resume_"))
+async def resume_broadcast_handler(call: CallbackQuery, broadcast_manager: BroadcastManager):
+    broadcast_id = int(call.data.split("_")[2])
+    if not await broadcast_manager.resume(broadcast_id):
+        await call.answer("Рассылку нельзя продолжить.", show_alert=True)
+
+
+@admin_broadcast_router.callback_query(F.data.startswith("broadcast_cancel_"))
+async def cancel_running_broadcast_handler(call: CallbackQuery, broadcast_manager: BroadcastManager):
+    broadcast_id = int(call.data.split("_")[2])
+    if not await broadcast_manager.cancel(broadcast_id):
+        await call.answer("Рассылка уже завершена.", show_alert=True)
@@ -7,6 +7,7 @@ from aiogram.types import Message, CallbackQuery
 from tgbot.filters.admin import IsAdmin
 from tgbot.keyboards.inline import back_to_admin_main_menu_keyboard # Добавьте/адаптируйте клавиатуры
 from database import requests as db
+from tgbot.services.cache_bus import CHANNELS, cache_bus
 
 admin_channels_router = Router()
 admin_channels_router.message.filter(IsAdmin())
@@ -53,6 +54,7 @@ async def add_channel_finish(message: Message, state: FSMContext, bot: Bot):
             channel_name=chat.title,
             channel_url=invite_link.invite_link
         )
+        await cache_bus.invalidate(CHANNELS)
         await message.answer(f"✅ Канал «{chat.title}» (<code>{chat.id}</code>) успешно добавлен.")
     except Exception as e:
         await message.answer(f"❌ Ошибка при добавлении канала: {e}\n\n"
@@ -74,6 +76,7 @@ async def delete_channel_finish(message: Message, state: FSMContext):
         channel_id = int(message.text)
         success = await db.delete_required_channel(channel_id)
         if success:
+            await cache_bus.invalidate(CHANNELS)
             await message.answer(f"✅ Канал <code>{channel_id}</code> удален.")
         else:
             await message.answer(f"⚠️ Канал <code>{channel_id}</code> не найден в базе.")
@@ -5,6 +5,7 @@ from aiogram.types import Message, CallbackQuery
 from tgbot.filters.admin import IsAdmin
 from tgbot.keyboards.inline import admin_main_menu_keyboard
 from database import requests as db 
+from db import get_pool_metrics
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 admin_main_router = Router()
@@ -24,22 +25,33 @@ async def admin_stats_handler(call: CallbackQuery):
     # Используем call.answer(), чтобы убрать "часики" на кнопке
     await call.answer("Собираю статистику...")
     
-    # Собираем данные с помощью новых функций
-    total_users = await db.count_all_users()
-    active_subs = await db.count_active_subscriptions()
-    users_today = await db.count_new_users_for_period(days=1)
-    users_week = await db.count_new_users_for_period(days=7)
-    users_month = await db.count_new_users_for_period(days=30)
-    
+    # Сегодняшний день считаем вживую одним запросом,
+    # прошлые дни берем из суточных срезов daily_stats
+    today = await db.get_live_stats()
+    rollup = await db.get_rollup_stats(days=[7, 30])
+    week, month = rollup[7], rollup[30]
+    pool = get_pool_metrics()
+
+    def total(period: dict, field: str):
+        return period[field] + today.get(field, 0)
+
     # Формируем текст сообщения
     text = (
         "📊 <b>Статистика бота</b>\n\n"
-        f"👥 Всего пользователей: <b>{total_users}</b>\n"
-        f"✅ Активных подписок: <b>{active_subs}</b>\n\n"
+        f"👥 Всего пользователей: <b>{today['total_users']}</b>\n"
+        f"✅ Активных подписок: <b>{today['active_subscriptions']}</b>\n\n"
         "<b>Новые пользователи:</b>\n"
-        f"• За сегодня: <b>{users_today}</b>\n"
-        f"• За неделю: <b>{users_week}</b>\n"
-        f"• За месяц: <b>{users_month}</b>"
+        f"• За сегодня: <b>{today['new_users']}</b>\n"
+        f"• За неделю: <b>{total(week, 'new_users')}</b>\n"
+        f"• За месяц: <b>{total(month, 'new_users')}</b>\n\n"
+        "<b>Динамика (7 дн. / 30 дн.):</b>\n"
+        f"💰 Выручка: <b>{total(week, 'revenue'):.2f}</b> / <b>{total(month, 'revenue'):.2f}</b> RUB\n"
+        f"🧾 Оплат: <b>{total(week, 'payments')}</b> / <b>{total(month, 'payments')}</b>\n"
+        f"💳 Первые оплаты: <b>{total(week, 'conversions')}</b> / <b>{total(month, 'conversions')}</b>\n"
+        f"📉 Истекло подписок: <b>{total(week, 'churned')}</b> / <b>{total(month, 'churned')}</b>\n\n"
+        f"🗄 Пул БД: занято <b>{pool['checked_out']}</b> из <b>{pool['size']}</b> "
+        f"(+{pool['overflow']}/{pool['max_overflow']} сверх), "
+        f"ожидание макс. <b>{pool['wait_time_max_ms']}</b> мс, таймаутов: <b>{pool['timeouts']}</b>"
     )
     
     # Создаем клавиатуру с кнопками "Обновить" и "Назад"
@@ -6,6 +6,7 @@ from loader import logger
 
 from tgbot.filters.admin import IsAdmin
 from database import requests as db
+from tgbot.services.cache_bus import TARIFFS, cache_bus
 from tgbot.keyboards.inline import (tariffs_list_keyboard, single_tariff_manage_keyboard, 
                                     confirm_delete_tariff_keyboard, cancel_fsm_keyboard)
 
@@ -64,6 +65,7 @@ async def toggle_tariff_status(call: CallbackQuery):
     if tariff:
         new_status = not tariff.is_active
         await db.update_tariff_field(tariff_id, 'is_active', new_status)
+        await cache_bus.invalidate(TARIFFS)
         await call.answer(f"Статус изменен на {'Активен' if new_status else 'Отключен'}")
         await show_tariff_card(call, tariff_id)
 
@@ -81,6 +83,7 @@ async def delete_tariff_confirm(call: CallbackQuery):
 async def delete_tariff_finish(call: CallbackQuery):
     tariff_id = int(call.data.split("_")[4])
     await db.delete_tariff_by_id(tariff_id)
+    await cache_bus.invalidate(TARIFFS)
     await call.answer("Тариф успешно удален", show_alert=True)
     await tariffs_menu(call) # Возвращаемся к списку тарифов
 
@@ -123,6 +126,7 @@ async def add_tariff_duration(message: Message, state: FSMContext):
         price=data['price'],
         duration_days=duration
     )
+    await cache_bus.invalidate(TARIFFS)
     await state.clear()
     await message.answer(f"✅ Новый тариф «{new_tariff.name}» успешно создан!")
     
@@ -165,5 +169,6 @@ async def edit_tariff_finish(message: Message, state: FSMContext):
         return
 
     await db.update_tariff_field(tariff_id, field, new_value)
+    await cache_bus.invalidate(TARIFFS)
     await state.clear()
     await message.answer("✅ Данные тарифа успешно обновлены!")
\ No newline at end of file
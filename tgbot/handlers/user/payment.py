@@ -1,6 +1,7 @@
 # tgbot/handlers/user/payment.py (Полная, исправленная и оптимизированная версия)
 
-from datetime import datetime
+from datetime import datetime, timedelta
+
 from aiogram import Router, F, Bot
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
@@ -8,12 +9,13 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters import Command
 
-from loader import logger
+from loader import config, logger
 from database import requests as db
 from xui.init_client import XUIClient
 from tgbot.handlers.user.profile import show_profile_logic
-from tgbot.keyboards.inline import cancel_fsm_keyboard, tariffs_keyboard, back_to_main_menu_keyboard
+from tgbot.keyboards.inline import cancel_fsm_keyboard, back_to_main_menu_keyboard
 from tgbot.services import payment
+from tgbot.services.reference_cache import reference_cache
 
 payment_router = Router()
 
@@ -30,16 +32,13 @@ async def show_tariffs_logic(event: Message | CallbackQuery, state: FSMContext):
     fsm_data = await state.get_data()
     discount = fsm_data.get("discount")
     
-    active_tariffs = await db.get_active_tariffs()
-    tariffs_list = list(active_tariffs) if active_tariffs else []
+    reply_markup = await reference_cache.get_tariffs_keyboard()
 
     text = "Пожалуйста, выберите тарифный план:"
     if discount:
         text = f"✅ Промокод на <b>{discount}%</b> применен!\n\n" + text
 
-    reply_markup = tariffs_keyboard(tariffs_list)
-
-    if not tariffs_list:
+    if not reply_markup:
         text = "К сожалению, сейчас нет доступных тарифов для покупки."
         reply_markup = back_to_main_menu_keyboard()
     
@@ -95,23 +94,23 @@ async def enter_promo_callback_handler(call: CallbackQuery, state: FSMContext):
 async def process_promo_code(message: Message, state: FSMContext, bot: Bot, xui: XUIClient):
     """Обрабатывает введенный промокод."""
     code = message.text.upper()
-    promo = await db.get_promo_code(code)
     user_id = message.from_user.id
 
     await message.delete() # Сразу удаляем сообщение с кодом
 
-    error_text = None
-    if not promo: error_text = "Промокод не найден."
-    elif promo.uses_left <= 0: error_text = "Этот промокод уже закончился."
-    elif promo.expire_date and promo.expire_date < datetime.now(): error_text = "Срок действия этого промокода истек."
-    elif await db.has_user_used_promo(user_id, promo.id): error_text = "Вы уже использовали этот промокод."
-
-    if error_text:
-        await message.answer(error_text)
+    # Проверка и списание использования выполняются атомарно в одной транзакции
+    promo, error = await db.redeem_promo_code(user_id, code)
+
+    if error:
+        error_texts = {
+            "not_found": "Промокод не найден.",
+            "exhausted": "Этот промокод уже закончился.",
+            "expired": "Срок действия этого промокода истек.",
+            "already_used": "Вы уже использовали этот промокод.",
+        }
+        await message.answer(error_texts[error])
         return
 
-    await db.use_promo_code(user_id, promo)
-
     if promo.bonus_days > 0:
         await state.clear()
         user_from_db = await db.get_user(user_id) # Получаем юзера один раз
@@ -171,13 +170,31 @@ async def select_tariff_handler(call: CallbackQuery, state: FSMContext, bot: Bot
     else:
         price_text = f"<b>{original_price} RUB</b>"
 
-    payment_url, _ = payment.create_payment(
-        user_id=call.from_user.id,
-        amount=final_price,
-        description=f"Оплата тарифа '{tariff.name}'" + (f" (скидка {discount_percent}%)" if discount_percent else ""),
-        bot_username=(await bot.get_me()).username,
-        metadata={'user_id': str(call.from_user.id), 'tariff_id': tariff_id}
-    )
+    # Пользователь уже открывал этот тариф по этой цене - показываем ту же ссылку без обращения к YooKassa
+    pending_payment = await db.get_reusable_payment(call.from_user.id, tariff_id, final_price)
+    if pending_payment:
+        payment_url = pending_payment.confirmation_url
+    else:
+        metadata = {'user_id': str(call.from_user.id), 'tariff_id': tariff_id}
+        if discount_percent and promo_code:
+            metadata['promo_code'] = promo_code
+
+        payment_url, payment_id = await payment.create_payment(
+            user_id=call.from_user.id,
+            amount=final_price,
+            description=f"Оплата тарифа '{tariff.name}'" + (f" (скидка {discount_percent}%)" if discount_percent else ""),
+            bot_username=await reference_cache.get_bot_username(bot),
+            metadata=metadata
+        )
+        await db.create_payment_record(
+            payment_id=payment_id,
+            user_id=call.from_user.id,
+            tariff_id=tariff_id,
+            amount=final_price,
+            promo_code=promo_code if discount_percent else None,
+            confirmation_url=payment_url,
+            expires_at=datetime.now() + timedelta(minutes=config.yookassa.payment_link_ttl_minutes)
+        )
 
     payment_kb = InlineKeyboardBuilder()
     payment_kb.button(text="💳 Перейти к оплате", url=payment_url)
@@ -1,5 +1,7 @@
 # tgbot/handlers/user/profile.py (ФИНАЛЬНАЯ УПРОЩЕННАЯ ВЕРСИЯ)
 
+import hashlib
+
 from aiogram import Router, F, types, Bot
 from aiogram.types import Message, CallbackQuery
 from aiogram.exceptions import TelegramBadRequest
@@ -7,6 +9,7 @@ from aiogram.filters import Command
 from datetime import datetime
 
 from loader import logger
+from database import requests as db
 from xui.init_client import XUIClient
 from tgbot.keyboards.inline import profile_keyboard
 from tgbot.services import qr_generator
@@ -15,6 +18,40 @@ from tgbot.services.utils import format_traffic, get_xui_user_info, get_user_att
 profile_router = Router()
 
 
+# --- ОТПРАВКА ФОТО ПРОФИЛЯ ---
+async def _send_profile_photo(event: Message | CallbackQuery, bot: Bot, photo: str | types.InputFile,
+                              caption: str, full_sub_url: str) -> Message | None:
+    """
+    Показывает профиль с QR-кодом: редактирует прошлое сообщение или отправляет новое.
+    photo - file_id из кэша или новый файл. Возвращает отправленное сообщение, если оно есть.
+    """
+    if isinstance(event, types.CallbackQuery):
+        try:
+            # Пытаемся отредактировать медиа, если это возможно
+            result = await event.message.edit_media(
+                media=types.InputMediaPhoto(media=photo, caption=caption),
+                reply_markup=profile_keyboard(full_sub_url)
+            )
+            return result if isinstance(result, Message) else None # Если получилось, выходим
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                # Тот же QR из кэша и те же данные - обновлять нечего
+                return None
+            # Если не вышло (например, прошлое сообщение было текстовым), удаляем и шлем новое
+            try:
+                await event.message.delete()
+            except TelegramBadRequest:
+                pass
+
+    # Отправляем новое сообщение с фото
+    return await bot.send_photo(
+        chat_id=event.from_user.id,
+        photo=photo,
+        caption=caption,
+        reply_markup=profile_keyboard(full_sub_url)
+    )
+
+
 # --- ОСНОВНАЯ ФУНКЦИЯ ДЛЯ ПОКАЗА ПРОФИЛЯ ---
 async def show_profile_logic(event: Message | CallbackQuery, xui: XUIClient, bot: Bot):
     """
@@ -66,34 +103,24 @@ async def show_profile_logic(event: Message | CallbackQuery, xui: XUIClient, bot
 
     # 5. Отправляем ответ с QR-кодом
     try:
-        qr_code_stream = qr_generator.create_qr_code(full_sub_url)
-        qr_photo = types.BufferedInputFile(qr_code_stream.getvalue(), filename="qr.png")
-
         # Добавляем ссылку в подпись к фото
         caption_with_link = profile_text + f"\n\n🔗 <b>Ваш ключ-конфиг (нажмите, чтобы скопировать):</b>\n<code>{full_sub_url}</code>"
 
-        if isinstance(event, types.CallbackQuery):
+        # Ссылка меняется редко: QR для нее загружается в Telegram один раз, дальше используется file_id
+        link_hash = hashlib.sha256(full_sub_url.encode()).hexdigest()
+        cached_file_id = await db.get_qr_file_id(link_hash)
+        if cached_file_id:
             try:
-                # Пытаемся отредактировать медиа, если это возможно
-                await event.message.edit_media(
-                    media=types.InputMediaPhoto(media=qr_photo, caption=caption_with_link),
-                    reply_markup=profile_keyboard(full_sub_url)
-                )
-                return # Если получилось, выходим
-            except TelegramBadRequest:
-                # Если не вышло (например, прошлое сообщение было текстовым), удаляем и шлем новое
-                try:
-                    await event.message.delete()
-                except TelegramBadRequest:
-                    pass
-        
-        # Отправляем новое сообщение с фото
-        await bot.send_photo(
-            chat_id=user_id,
-            photo=qr_photo,
-            caption=caption_with_link,
-            reply_markup=profile_keyboard(full_sub_url)
-        )
+                await _send_profile_photo(event, bot, cached_file_id, caption_with_link, full_sub_url)
+                return
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached QR file_id for user {user_id} is invalid, re-uploading: {e}")
+
+        qr_png = await qr_generator.create_qr_code(full_sub_url)
+        qr_photo = types.BufferedInputFile(qr_png, filename="qr.png")
+        sent_message = await _send_profile_photo(event, bot, qr_photo, caption_with_link, full_sub_url)
+        if sent_message and sent_message.photo:
+            await db.save_qr_file_id(link_hash, sent_message.photo[-1].file_id)
 
     except Exception as e:
         logger.error(f"Error sending profile with QR: {e}", exc_info=True)
@@ -1,8 +1,8 @@
 # tgbot/handlers/user/start.py
 
 from aiogram import Router, F, Bot
-from aiogram.filters import CommandStart, Command, CommandObject
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import CommandStart, Command, CommandObject, ChatMemberUpdatedFilter, KICKED, MEMBER
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 # --- Импорты ---
@@ -10,8 +10,9 @@ from loader import logger
 from database import requests as db
 # --- ИЗМЕНЕНИЕ: Импортируем наш новый XUIClient ---
 from xui.init_client import XUIClient
-from tgbot.services.subscription import check_subscription
-from tgbot.keyboards.inline import main_menu_keyboard, back_to_main_menu_keyboard, channels_subscribe_keyboard
+from tgbot.services.subscription import check_subscription, update_membership
+from tgbot.services.reference_cache import reference_cache
+from tgbot.keyboards.inline import main_menu_keyboard, back_to_main_menu_keyboard
 
 # Создаем локальный роутер для этого файла
 start_router = Router()
@@ -65,6 +66,9 @@ async def process_start_command(message: Message, command: CommandObject, bot: B
     username = message.from_user.username
     
     user, created = await db.get_or_create_user(user_id, full_name, username)
+    if user.blocked_at:
+        # Пользователь вернулся - снова включаем его в рассылки и напоминания
+        await db.reactivate_user(user_id)
 
     # --- ОБРАБОТКА РЕФЕРАЛЬНОЙ ССЫЛКИ (НЕЗАВИСИМО) ---
     if created and command and command.args and command.args.startswith('ref'):
@@ -97,6 +101,27 @@ async def process_start_command(message: Message, command: CommandObject, bot: B
     await message.answer(f"👋 С возвращением, <b>{full_name}</b>!", reply_markup=main_menu_keyboard())
 
 
+# --- БЛОКИРОВКА И РАЗБЛОКИРОВКА БОТА ПОЛЬЗОВАТЕЛЕМ ---
+@start_router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def bot_blocked_handler(event: ChatMemberUpdated):
+    """Пользователь заблокировал бота - исключаем его из рассылок сразу, не дожидаясь ошибки отправки."""
+    await db.mark_users_unreachable([event.from_user.id])
+    logger.info(f"User {event.from_user.id} blocked the bot.")
+
+
+@start_router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def bot_unblocked_handler(event: ChatMemberUpdated):
+    await db.reactivate_user(event.from_user.id)
+    logger.info(f"User {event.from_user.id} unblocked the bot.")
+
+
+# --- ПОДПИСКИ НА ОБЯЗАТЕЛЬНЫЕ КАНАЛЫ ---
+@start_router.chat_member(F.chat.type == "channel")
+async def channel_member_handler(event: ChatMemberUpdated):
+    """Telegram присылает эти события только из каналов, где бот администратор."""
+    update_membership(event.chat.id, event.new_chat_member.user.id, event.new_chat_member.status)
+
+
 # --- НОВЫЙ ХЕНДЛЕР ДЛЯ КНОПКИ "ПОЛУЧИТЬ БЕСПЛАТНО" ---
 @start_router.callback_query(F.data == "start_trial_process")
 async def start_trial_process_handler(call: CallbackQuery, bot: Bot, xui: XUIClient):
@@ -130,15 +155,14 @@ async def start_trial_process_handler(call: CallbackQuery, bot: Bot, xui: XUICli
         await give_trial_subscription(user_id, bot, xui, call.message.chat.id)
     else:
         # Если не подписан, показываем каналы
-        channels = await db.get_all_required_channels()
-        if not channels:
+        keyboard = await reference_cache.get_channels_keyboard()
+        if not keyboard:
             logger.warning(f"User {user_id} is starting trial, but no channels are in DB. Giving trial immediately.")
             await call.answer("Активируем пробный период...", show_alert=True)
             await call.message.delete()
             await give_trial_subscription(user_id, bot, xui, call.message.chat.id)
             return
 
-        keyboard = channels_subscribe_keyboard(channels)
         await call.message.edit_text(
             "❗️ <b>Для получения пробного периода, пожалуйста, подпишитесь на наши каналы.</b>\n\n"
             "После подписки нажмите кнопку «Проверить» ниже.",
@@ -211,8 +235,8 @@ async def activate_referral_bonus(message: Message, referrer_id: int, xui: XUICl
 async def show_referral_info(message: Message, bot: Bot):
     """Вспомогательная функция для показа информации о реферальной программе."""
     user_id = message.from_user.id
-    bot_info = await bot.get_me()
-    referral_link = f"https://t.me/{bot_info.username}?start=ref{user_id}"
+    bot_username = await reference_cache.get_bot_username(bot)
+    referral_link = f"https://t.me/{bot_username}?start=ref{user_id}"
     user_data = await db.get_user(user_id)
     referral_count = await db.count_user_referrals(user_id)
 
@@ -1,29 +1,34 @@
 # tgbot/handlers/webhook_handlers.py (Оптимиз
+import asyncio
+import time
 from datetime import datetime
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiohttp import web
-from aiogram import Bot, Dispatcher
+from aiogram import Bot
 
 # Импортируем сервисы, БД, клиент и логгер
 from tgbot.services import payment
+from tgbot.services.transaction_log import transaction_log
+from tgbot.services.webhook_queue import PermanentJobError
+from tgbot.middlewares.rate_limit import SendPriority, send_priority
 from database import requests as db
 from  xui.init_client import XUIClient
-from loader import logger, config
+from loader import logger
 
 # Импортируем нашу функцию для показа профиля из хендлеров
 from tgbot.handlers.user.profile import show_profile_logic
 
 
 # --- 1. Логика управления основным пользователем ---
-async def _handle_user_payment(user_id: int, tariff, xui: XUIClient) -> bool:
+async def _handle_user_payment(user, tariff, xui: XUIClient) -> bool:
     """Продлевает подписку в БД и создает/модифицирует пользователя в Marzban."""
+    user_id = user.user_id
     subscription_days = tariff.duration_days
     await db.extend_user_subscription(user_id, days=subscription_days)
     logger.info(f"Subscription for user {user_id} in local DB extended by {subscription_days} days.")
 
-    user_from_db = await db.get_user(user_id)
-    xui_username = (user_from_db.xui_username or f"user_{user_id}").lower()
+    xui_username = (user.xui_username or f"user_{user_id}").lower()
     is_new_user_for_marzban = False
     try:
         if await xui.get_user(xui_username):
@@ -31,7 +36,7 @@ async def _handle_user_payment(user_id: int, tariff, xui: XUIClient) -> bool:
         else:
             await xui.add_user(username=xui_username, expire_days=subscription_days)
             is_new_user_for_marzban = True
-        if not user_from_db.xui_username:
+        if not user.xui_username:
             await db.update_user_xui_username(user_id, xui_username)
             
     except Exception as e:
@@ -41,16 +46,18 @@ async def _handle_user_payment(user_id: int, tariff, xui: XUIClient) -> bool:
 
 
 # --- 2. Логика начисления реферального бонуса ---
-async def _handle_referral_bonus(user_who_paid_id: int, xui: XUIClient, bot: Bot):
-    """Проверяет и начисляет бонус рефереру."""
-    user_who_paid = await db.get_user(user_who_paid_id)
-    if not (user_who_paid and user_who_paid.referrer_id and not user_who_paid.is_first_payment_made):
-        return # Если нет реферера или это не первая оплата - выходим
+async def _handle_referral_bonus(user_who_paid, xui: XUIClient) -> tuple[int, str] | None:
+    """
+    Проверяет и начисляет бонус рефереру.
+    Возвращает (id реферера, текст уведомления) - само уведомление отправляется отдельно.
+    """
+    if not (user_who_paid.referrer_id and not user_who_paid.is_first_payment_made):
+        return None # Если нет реферера или это не первая оплата - выходим
 
     bonus_days = 7
     referrer = await db.get_user(user_who_paid.referrer_id)
     if not referrer:
-        return
+        return None
 
     # Если у реферера есть активный аккаунт, продлеваем его везде
     if referrer.xui_username:
@@ -59,34 +66,33 @@ async def _handle_referral_bonus(user_who_paid_id: int, xui: XUIClient, bot: Bot
             await db.extend_user_subscription(referrer.user_id, days=bonus_days)
             await db.add_bonus_days(referrer.user_id, days=bonus_days)
             logger.info(f"Referral bonus: Extended subscription for referrer {referrer.user_id} by {bonus_days} days.")
-            await bot.send_message(
-                referrer.user_id,
-                f"🎉 Ваш реферал совершил первую оплату! Вам начислено <b>{bonus_days} бонусных дней</b> подписки."
-            )
+            text = f"🎉 Ваш реферал совершил первую оплату! Вам начислено <b>{bonus_days} бонусных дней</b> подписки."
         except Exception as e:
             logger.error(f"Failed to apply referral bonus to user {referrer.user_id}: {e}")
             await db.add_bonus_days(referrer.user_id, days=bonus_days) # Начисляем виртуальные дни
-            await bot.send_message(referrer.user_id, "Не удалось продлить вашу подписку, бонусные дни зачислены на ваш баланс.")
+            text = "Не удалось продлить вашу подписку, бонусные дни зачислены на ваш баланс."
     else:
         # Если у реферера нет аккаунта, просто даем виртуальные дни
         await db.add_bonus_days(referrer.user_id, days=bonus_days)
         logger.info(f"Referral bonus: Added {bonus_days} virtual bonus days to user {referrer.user_id}.")
-        try:
-            await bot.send_message(referrer.user_id, f"🎉 Ваш реферал совершил первую оплату! Вам начислено <b>{bonus_days} бонусных дней</b>.")
-        except Exception: pass
+        text = f"🎉 Ваш реферал совершил первую оплату! Вам начислено <b>{bonus_days} бонусных дней</b>."
             
-    await db.set_first_payment_done(user_who_paid_id)
+    await db.set_first_payment_done(user_who_paid.user_id)
+    return referrer.user_id, text
+
+
+async def _notify_referrer(bot: Bot, referrer_id: int, text: str):
+    """Сообщает рефереру о начисленном бонусе."""
+    await bot.send_message(referrer_id, text)
 
 
 # --- 3. Логика уведомления пользователя об оплате и показ ключей ---
-async def _notify_user_and_show_keys(user_id: int, tariff, xui: XUIClient, bot: Bot,  request: web.Request):
+async def _notify_user_and_show_keys(user_id: int, tariff, xui: XUIClient, bot: Bot, storage: BaseStorage):
     """
     Уведомляет пользователя об успехе, очищает старые сообщения/состояния и показывает профиль.
     """
     # --- 1. Очистка FSM и старого сообщения с платежом ---
     try:
-        dp: Dispatcher = request.app['dp'] # Получаем диспетчер из request.app
-        storage = dp.storage              # Получаем хранилище из диспетчера
         storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
         state = FSMContext(storage=storage, key=storage_key)
         
@@ -134,15 +140,12 @@ async def _notify_user_and_show_keys(user_id: int, tariff, xui: XUIClient, bot:
 
 async def _log_transaction(
     bot: Bot, 
-    user_id: int, 
+    user, 
     tariff_name: str, 
     tariff_price: float, 
     is_new_user: bool
 ):
     """Формирует и отправляет лог о транзакции в специальную тему."""
-    user = await db.get_user(user_id)
-    if not user: return
-    
     # Определяем, была ли это первая покупка или продление
     action_type = "💎 Новая подписка" if is_new_user else "🔄 Продление подписки"
     
@@ -155,56 +158,218 @@ async def _log_transaction(
         f"💰 <b>Сумма:</b> {tariff_price} RUB"
     )
     
+    # При частых оплатах события объединяются в сводку, чтобы не упираться в лимит группы
+    await transaction_log.add(text, tariff_price)
+
+
+# --- 4. Конвейер обработки успешного платежа ---
+
+# Ограничение времени на каждый побочный шаг: зависший Telegram не задерживает остальные
+SIDE_EFFECT_TIMEOUT = 20
+
+# Статистика по шагам конвейера: имя шага -> счетчики и время выполнения
+_step_stats: dict[str, dict] = {}
+
+# Шаги, время которых в статистику конвейера не попадает. Лог транзакций при частых
+# оплатах только кладет событие в буфер сводки, а отправку в Telegram замеряет сам буфер
+UNTIMED_SIDE_EFFECTS = {"transaction_log"}
+
+
+def _record_step(name: str, elapsed_ms: float, outcome: str):
+    stats = _step_stats.setdefault(name, {"ok": 0, "error": 0, "timeout": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats[outcome] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def get_payment_pipeline_metrics() -> dict:
+    """Снимок задержек шагов обработки платежа для /metrics."""
+    metrics = {}
+    for name, stats in _step_stats.items():
+        calls = stats["ok"] + stats["error"] + stats["timeout"]
+        metrics[name] = {
+            **stats,
+            "total_ms": round(stats["total_ms"], 1),
+            "max_ms": round(stats["max_ms"], 1),
+            "avg_ms": round(stats["total_ms"] / calls, 1) if calls else 0.0,
+        }
+    return metrics
+
+
+async def _run_step(name: str, coro, timeout: float | None = None, record: bool = True):
+    """Выполняет шаг конвейера, замеряя время (если record). Ошибки пробрасываются дальше."""
+    started_at = time.perf_counter()
+
+    def finish(outcome: str):
+        if record:
+            _record_step(name, (time.perf_counter() - started_at) * 1000, outcome)
+
     try:
-        await bot.send_message(
-            chat_id=config.tg_bot.support_chat_id,
-            message_thread_id=config.tg_bot.transaction_log_topic_id,
-            text=text
-        )
+        result = await asyncio.wait_for(coro, timeout) if timeout else await coro
+    except asyncio.TimeoutError:
+        finish("timeout")
+        raise
+    except Exception:
+        finish("error")
+        raise
+    finish("ok")
+    return result
+
+
+async def _run_side_effects(user_id: int, side_effects: dict):
+    """
+    Запускает независимые побочные шаги параллельно, каждый со своим таймаутом.
+    Ошибка или таймаут одного шага только логируется и не влияет на остальные.
+    """
+    names = list(side_effects)
+    results = await asyncio.gather(
+        *(_run_step(name, side_effects[name], SIDE_EFFECT_TIMEOUT, record=name not in UNTIMED_SIDE_EFFECTS)
+          for name in names),
+        return_exceptions=True
+    )
+    for name, result in zip(names, results):
+        if isinstance(result, asyncio.TimeoutError):
+            logger.error(f"Payment side effect '{name}' for user {user_id} timed out after {SIDE_EFFECT_TIMEOUT}s")
+        elif isinstance(result, Exception):
+            logger.error(f"Payment side effect '{name}' for user {user_id} failed: {result}")
+
+
+async def _run_payment_pipeline(payment_id: str, user, tariff, amount: float, xui: XUIClient, bot: Bot,
+                                storage: BaseStorage):
+    """
+    Обрабатывает успешный платеж. Сначала последовательно выполняются обязательные шаги
+    (продление подписки, реферальный бонус), затем параллельно - уведомления.
+    Пользователь загружается из БД один раз и передается во все шаги.
+    """
+    user_id = user.user_id
+    # Ошибка обязательного шага пробрасывается наверх - задача будет повторена
+    is_new = await _run_step("subscription", _handle_user_payment(user, tariff, xui))
+    # Сразу после продления: дальнейшие ошибки и перезапуски уже не приведут к повторному продлению
+    await db.complete_payment_processing(payment_id)
+
+    try:
+        referral = await _run_step("referral_bonus", _handle_referral_bonus(user, xui))
     except Exception as e:
-        logger.error(f"Failed to send transaction log for user {user_id}: {e}")
+        # Подписка уже продлена, поэтому бонус не должен приводить к повтору всего платежа
+        logger.error(f"Failed to process referral bonus for user {user_id}: {e}", exc_info=True)
+        referral = None
+
+    side_effects = {
+        "transaction_log": _log_transaction(
+            bot=bot,
+            user=user,
+            tariff_name=tariff.name,
+            tariff_price=amount,
+            is_new_user=is_new
+        ),
+        "user_notification": _notify_user_and_show_keys(user_id, tariff, xui, bot, storage),
+    }
+    if referral:
+        side_effects["referrer_notification"] = _notify_referrer(bot, *referral)
+    await _run_side_effects(user_id, side_effects)
+
+# --- ОБРАБОТКА УВЕДОМЛЕНИЯ ИЗ ОЧЕРЕДИ ---
+
+class PaymentInProgressError(Exception):
+    """Успешный платеж еще не обработан, но аренду его обработки держит другой обработчик."""
+
+
+async def process_payment_notification(payload: dict, bot: Bot, xui: XUIClient, storage: BaseStorage):
+    """
+    Обрабатывает сохраненное уведомление YooKassa. Вызывается воркерами очереди вебхуков.
+    Повторные уведомления об одном и том же платеже отсекаются журналом платежей:
+    подписка продлевается только один раз, под арендой обработки платежа.
+    Исключение приводит к повторной попытке обработки задачи позже.
+    """
+    notification = payment.parse_webhook_notification(payload)
+    status = payment.PAYMENT_EVENT_STATUSES[notification.event]
+    payment_object = notification.object
+    metadata = payment_object.metadata
+    user_id = int(metadata['user_id'])
+    tariff_id = int(metadata['tariff_id'])
+
+    # Один запрос: фиксируем переход статуса и (для succeeded) берем аренду обработки платежа
+    ledger_entry = await db.apply_payment_status(
+        payment_id=payment_object.id,
+        status=status,
+        user_id=user_id,
+        tariff_id=tariff_id,
+        amount=float(payment_object.amount.value),
+        promo_code=metadata.get('promo_code')
+    )
+    if ledger_entry is None:
+        if status == 'succeeded':
+            existing = await db.get_payment_record(payment_object.id)
+            if existing and existing.status == 'succeeded' and existing.processed_at is None:
+                # Обработчик, взявший платеж, еще работает или упал и его аренда не истекла.
+                # Повторяем задачу позже, иначе оплата может остаться не зачтенной
+                raise PaymentInProgressError(f"Payment {payment_object.id} is being processed by another worker")
+        logger.info(f"Payment {payment_object.id}: duplicate or outdated '{notification.event}', skipping.")
+        return
+
+    if status != 'succeeded':
+        logger.info(f"Payment {payment_object.id} of user {user_id} is now '{status}'.")
+        return
+
+    tariff = await db.get_tariff_by_id(tariff_id)
+    if not tariff:
+        # Повтор не поможет: платеж остается необработанным, а задача - в статусе failed для ручного разбора
+        await db.release_payment_processing(payment_object.id)
+        raise PermanentJobError(f"Payment {payment_object.id} is for non-existent tariff_id: {tariff_id}")
+
+    logger.info(f"Processing successful payment {payment_object.id} for user {user_id}, tariff '{tariff.name}'.")
+
+    try:
+        user = await db.get_user(user_id)
+        if not user:
+            raise LookupError(f"User {user_id} from payment {payment_object.id} not found")
+        # Уведомления об оплате отправляются раньше рассылок и прочих массовых сообщений
+        with send_priority(SendPriority.TRANSACTIONAL):
+            await _run_payment_pipeline(payment_object.id, user, tariff, ledger_entry.amount, xui, bot, storage)
+    except BaseException:
+        # В том числе при отмене задачи на остановке бота. Если подписка уже продлена,
+        # платеж отмечен обработанным и аренда не снимается
+        await db.release_payment_processing(payment_object.id)
+        raise
+
 
 # --- ГЛАВНЫЙ ХЕНДЛЕР ВЕБХУКА ---
 async def yookassa_webhook_handler(request: web.Request):
     """
-    Принимает вебхуки от YooKassa и делегирует задачи соответствующим функциям.
+    Принимает вебхуки от YooKassa: проверяет, сохраняет в очередь и сразу отвечает 200.
+    Вся тяжелая обработка (панель, бонусы, уведомления) выполняется воркерами очереди,
+    поэтому медленная панель больше не приводит к таймаутам и повторам со стороны YooKassa.
     """
     try:
         request_body = await request.json()
         notification = payment.parse_webhook_notification(request_body)
 
-        if notification is None or notification.event != 'payment.succeeded':
+        if notification is None:
             return web.Response(status=400)
 
-        metadata = notification.object.metadata
-        user_id = int(metadata['user_id'])
-        tariff_id = int(metadata['tariff_id'])
-        tariff = await db.get_tariff_by_id(tariff_id)
+        if notification.event not in payment.PAYMENT_EVENT_STATUSES:
+            # Остальные события нам не нужны, но подтверждаем их, чтобы YooKassa не повторяла отправку
+            return web.Response(status=200)
 
-        if not tariff:
-            logger.error(f"Webhook for non-existent tariff_id: {tariff_id}")
+        payment_object = notification.object
+        metadata = payment_object.metadata or {}
+        try:
+            int(metadata['user_id']), int(metadata['tariff_id'])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Webhook for payment {payment_object.id} has invalid metadata: {metadata}")
             return web.Response(status=400)
-            
-        logger.info(f"Webhook: Processing successful payment for user {user_id}, tariff '{tariff.name}'.")
-
-        # Получаем объекты бота и клиента Marzban из приложения
-        bot: Bot = request.app['bot']
-        xui: XUIClient = request.app['xui']
-         
-        # Вызываем наши функции последовательно
-        is_new = await _handle_user_payment(user_id, tariff, xui)
-        await _handle_referral_bonus(user_id, xui, bot)
-        await _log_transaction(
-        bot=bot,
-        user_id=user_id,
-        tariff_name=tariff.name,
-        tariff_price=tariff.price,
-        is_new_user=is_new
-    )
-        await _notify_user_and_show_keys(user_id, tariff, xui, bot, request)
+
+        queue = request.app['payment_queue']
+        created = await queue.enqueue(
+            dedup_key=f"{payment_object.id}:{notification.event}",
+            kind="yookassa",
+            payload=request_body
+        )
+        if not created:
+            logger.info(f"Webhook: '{notification.event}' for payment {payment_object.id} is already queued.")
 
         return web.Response(status=200)
 
     except Exception as e:
         logger.error(f"FATAL: Unhandled error in yookassa_webhook_handler: {e}", exc_info=True)
-        return web.Response(status=500)
\ No newline at end of file
+        return web.Response(status=500)
@@ -197,6 +197,30 @@ def confirm_broadcast_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+def broadcast_segments_keyboard(segments: dict[str, str], selected: list[str], recipients: int) -> InlineKeyboardMarkup:
+    """Выбор аудитории рассылки: фильтры включаются и выключаются нажатием, выбранные объединяются."""
+    builder = InlineKeyboardBuilder()
+    for key, title in segments.items():
+        mark = "✅" if key in selected else "▫️"
+        builder.button(text=f"{mark} {title}", callback_data=f"bc_seg_{key}")
+    builder.button(text=f"➡️ Далее ({recipients} получ.)", callback_data="bc_seg_done")
+    builder.button(text="❌ Отмена", callback_data="admin_main_menu")
+    builder.adjust(2)
+    return builder.as_markup()
+
+def broadcast_control_keyboard(broadcast_id: int, status: str) -> InlineKeyboardMarkup | None:
+    """Кнопки управления идущей рассылкой. Для завершенной рассылки кнопок нет."""
+    builder = InlineKeyboardBuilder()
+    if status == "running":
+        builder.button(text="⏸ Пауза", callback_data=f"broadcast_pause_{broadcast_id}")
+    elif status == "paused":
+        builder.button(text="▶️ Продолжить", callback_data=f"broadcast_resume_{broadcast_id}")
+    else:
+        return None
+    builder.button(text="⏹ Отменить", callback_data=f"broadcast_cancel_{broadcast_id}")
+    builder.adjust(2)
+    return builder.as_markup()
+
 
 # =============================================================================
 # === 3. УНИВЕРСАЛЬНЫЕ И СЛУЖЕБНЫЕ КЛАВИАТУРЫ ===
@@ -18,6 +18,9 @@ class ThrottlingMiddleware(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any],
     ) -> Any:
+        # Части альбома приходят пачкой отдельными сообщениями - это не флуд
+        if getattr(event, "media_group_id", None):
+            return await handler(event, data)
 
         if event.from_user.id in self.cache_l1:
             if event.from_user.id in self.cache_l2:
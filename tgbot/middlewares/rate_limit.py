@@ -0,0 +1,187 @@
+# tgbot/middlewares/rate_limit.py
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from cachetools import TTLCache
+
+from loader import logger
+
+
+class SendPriority(IntEnum):
+    """Классы приоритета исходящих сообщений: меньше значение - раньше отправка."""
+    TRANSACTIONAL = 0   # Оплаты, выдача ключей
+    NORMAL = 1          # Ответы на действия пользователя
+    BULK = 2            # Рассылки, напоминания
+
+
+_send_priority: ContextVar[SendPriority] = ContextVar("send_priority", default=SendPriority.NORMAL)
+
+
+@contextmanager
+def send_priority(priority: SendPriority):
+    """Задает приоритет всех отправок внутри блока (и запущенных из него задач)."""
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Корзина токенов с резервированием: reserve() сразу списывает токен (баланс может
+    уйти в минус) и возвращает, сколько секунд нужно подождать до своей очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Единый ограничитель исходящих сообщений на уровне сессии бота.
+
+    Все отправки (рассылки, напоминания, уведомления об оплате, ответы поддержки)
+    проходят через одни и те же лимиты Telegram:
+    - не более global_rate сообщений в секунду на бота;
+    - не более 1 сообщения в секунду в личный чат;
+    - не более 20 сообщений в минуту в группу.
+    Редактирование (Edit*) в ответ на нажатия кнопок расходует только глобальный
+    лимит, чтобы быстрая навигация по меню не тормозила; лимит чата для него
+    действует только в рассылках (BULK).
+    Глобальные токены выдаются в порядке приоритета, поэтому рассылка не задерживает
+    подтверждения оплат. При TelegramRetryAfter вся отправка ставится на общую паузу.
+    """
+
+    # Методы, которые считаются отправкой сообщения в чат
+    LIMITED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+    # Методы, которые всегда расходуют и лимит чата
+    CHAT_LIMITED_PREFIXES = ("Send", "Copy", "Forward")
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate_per_minute: float = 20,
+                 chat_burst: float = 3, max_retries: int = 3):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate_per_minute / 60
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        # Корзины чатов, которые давно не использовались, все равно полные - их можно забыть
+        self._chat_buckets: TTLCache = TTLCache(maxsize=100_000, ttl=120)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self._paused_until = 0.0
+        self._sent = {priority.name.lower(): 0 for priority in SendPriority}
+        self._retry_after_count = 0
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        method_name = type(method).__name__
+        if not method_name.startswith(self.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        priority = _send_priority.get()
+        chat_id = None
+        if method_name.startswith(self.CHAT_LIMITED_PREFIXES) or priority == SendPriority.BULK:
+            chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                self._pause(e.retry_after)
+                continue
+            self._sent[priority.name.lower()] += 1
+            return response
+
+    def get_metrics(self) -> dict:
+        return {
+            "sent": dict(self._sent),
+            "waiting": len(self._waiters),
+            "retry_after": self._retry_after_count,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 1),
+        }
+
+    def _pause(self, retry_after: float):
+        """Общая пауза для всех отправок после ответа Telegram 429."""
+        self._retry_after_count += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        logger.warning(f"Telegram flood control: pausing all outgoing messages for {retry_after}s")
+
+    async def _acquire(self, chat_id, priority: SendPriority):
+        # 1. Лимит чата: ждем своей очереди в корзине конкретного чата
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+        # 2. Глобальный лимит: встаем в очередь с приоритетом
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный ID - группа или канал, у них лимит строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self._group_rate if is_group else self._chat_rate, self._chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        """Выдает глобальные токены ожидающим отправкам, самым приоритетным - первыми."""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            delay = self._global_bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            if self._paused_until > time.monotonic():
+                continue
+
+            # Берем самого приоритетного на момент выдачи токена (он мог прийти, пока мы ждали)
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
@@ -0,0 +1,163 @@
+# tgbot/middlewares/update_queue.py
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject, Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from loader import logger
+
+
+class UpdateQueueFull(Exception):
+    """Очередь апдейтов заполнена - апдейт не принят."""
+
+
+class UpdateQueueMiddleware(BaseMiddleware):
+    """
+    Фоновая обработка апдейтов ограниченным пулом воркеров.
+
+    Мидлварь ставит апдейт в очередь его чата и сразу возвращает управление:
+    вебхук Telegram получает ответ без ожидания панели и генерации QR, а поллинг
+    забирает следующую пачку. Апдейты одного чата (в группах - одного участника)
+    обрабатываются строго по очереди, остальные - параллельно, не более workers одновременно.
+
+    Если в очереди max_queue апдейтов, вебхук получает отказ (Telegram повторит
+    доставку позже), а поллинг ждет, пока освободится место.
+    """
+
+    def __init__(self, workers: int = 16, max_queue: int = 1000, reject_when_full: bool = True):
+        self._workers_count = workers
+        self._max_queue = max_queue
+        self._reject_when_full = reject_when_full
+        # Очереди чатов; чат есть в словаре, пока у него есть необработанные апдейты
+        self._chats: dict[Any, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._has_space = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._pending = 0
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._max_wait = 0.0
+
+    def setup(self, dp: Dispatcher):
+        """
+        Регистрирует мидлварь первой в цепочке апдейта.
+
+        Встроенные мидлвари aiogram читают состояние FSM в момент вызова, поэтому
+        они должны выполняться уже в воркере - после обработки предыдущих апдейтов чата.
+        """
+        builtin = list(dp.update.outer_middleware)
+        for middleware in builtin:
+            dp.update.outer_middleware.unregister(middleware)
+        dp.update.outer_middleware(self)
+        for middleware in builtin:
+            dp.update.outer_middleware(middleware)
+        dp.shutdown.register(self.stop)
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any],
+    ) -> Any:
+        while self._pending >= self._max_queue:
+            if self._reject_when_full:
+                self._rejected += 1
+                raise UpdateQueueFull()
+            self._has_space.clear()
+            await self._has_space.wait()
+
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+
+        key = self._chat_key(event)
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((handler, event, data, time.monotonic()))
+        self._pending += 1
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_metrics(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "queued": self._pending - self._in_flight,
+            "in_flight": self._in_flight,
+            "chats": len(self._chats),
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "max_wait_ms": round(self._max_wait * 1000),
+        }
+
+    @staticmethod
+    def _chat_key(event: Update):
+        """
+        Ключ последовательной обработки. В личном чате это сам чат. В группах
+        (например, в группе поддержки) - пользователь в чате, как и ключ FSM:
+        медленный хендлер одного участника не задерживает апдейты остальных.
+        """
+        context = UserContextMiddleware.resolve_event_context(event=event)
+        if context.chat and context.user and context.chat.type in ("group", "supergroup"):
+            return context.chat.id, context.user.id
+        if context.chat:
+            return context.chat.id
+        if context.user:
+            return context.user.id
+        # Апдейты без чата и пользователя упорядочивать не нужно
+        return f"update_{event.update_id}"
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            handler, event, data, queued_at = queue.popleft()
+            self._max_wait = max(self._max_wait, time.monotonic() - queued_at)
+            self._in_flight += 1
+            try:
+                result = await handler(event, data)
+                # Ответ методом в теле вебхука уже невозможен - отправляем запросом
+                if isinstance(result, TelegramMethod):
+                    await data["bot"](result)
+                self._processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._failed += 1
+                logger.error(f"Failed to process update {event.update_id}: {e}", exc_info=True)
+            finally:
+                self._in_flight -= 1
+                self._pending -= 1
+                self._has_space.set()
+
+            # Следующий апдейт чата - в конец общей очереди, чтобы активный чат не занимал воркер
+            if queue:
+                self._ready.put_nowait(key)
+            else:
+                del self._chats[key]
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука Telegram, отвечающий 503 при переполненной очереди апдейтов."""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        try:
+            return await super().handle(request)
+        except UpdateQueueFull:
+            logger.warning("Update queue is full, asking Telegram to redeliver the update later.")
+            return web.Response(status=503)
@@ -0,0 +1,178 @@
+# tgbot/services/broadcast.py
+
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from database import requests as db
+from loader import logger
+from tgbot.keyboards.inline import broadcast_control_keyboard
+from tgbot.middlewares.rate_limit import SendPriority, send_priority
+from tgbot.services.utils import is_unreachable_chat_error
+
+# Результаты отправки одному получателю
+SENT, FAILED, UNREACHABLE = "sent", "failed", "unreachable"
+
+STATUS_TITLES = {
+    "running": "🚀 Рассылка идет",
+    "paused": "⏸ Рассылка на паузе",
+    "cancelled": "⏹ Рассылка отменена",
+    "done": "✅ Рассылка завершена",
+}
+
+
+def format_broadcast_progress(broadcast) -> str:
+    """Текст сообщения с прогрессом рассылки."""
+    processed = broadcast.sent + broadcast.failed
+    percent = processed * 100 // broadcast.total if broadcast.total else 100
+    return (
+        f"<b>{STATUS_TITLES.get(broadcast.status, broadcast.status)}</b>\n\n"
+        f"📊 Прогресс: <b>{processed}</b> из <b>{broadcast.total}</b> ({percent}%)\n"
+        f"👍 Отправлено: <b>{broadcast.sent}</b>\n"
+        f"👎 Ошибок: <b>{broadcast.failed}</b>"
+    )
+
+
+class BroadcastManager:
+    """
+    Фоновое выполнение рассылок из таблицы broadcasts.
+
+    Получатели перебираются пачками по возрастанию ID, внутри пачки сообщения
+    отправляются параллельно (не более concurrency одновременно), а темп задает
+    общий ограничитель исходящих сообщений. После каждой пачки курсор сохраняется
+    в БД - это и контрольная точка для продолжения после перезапуска, и сигнал
+    о паузе или отмене, выставленных администратором.
+    """
+
+    def __init__(self, bot: Bot, batch_size: int = 100, concurrency: int = 25,
+                 progress_interval: float = 5.0, stale_after_seconds: int = 120):
+        self._bot = bot
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._progress_interval = progress_interval
+        self._stale_after_seconds = stale_after_seconds
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def start(self, broadcast_id: int):
+        """Запускает воркер рассылки, если он еще не работает в этом процессе."""
+        task = self._tasks.get(broadcast_id)
+        if task and not task.done():
+            return
+        self._tasks[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+
+    async def pause(self, broadcast_id: int):
+        broadcast = await db.set_broadcast_status(broadcast_id, "paused", from_statuses=("running",))
+        if broadcast:
+            await self._show_progress(broadcast)
+        return broadcast
+
+    async def resume(self, broadcast_id: int):
+        broadcast = await db.set_broadcast_status(broadcast_id, "running", from_statuses=("paused",))
+        if broadcast:
+            self.start(broadcast_id)
+            await self._show_progress(broadcast)
+        return broadcast
+
+    async def cancel(self, broadcast_id: int):
+        broadcast = await db.set_broadcast_status(broadcast_id, "cancelled", from_statuses=("running", "paused"))
+        if broadcast:
+            await self._show_progress(broadcast)
+        return broadcast
+
+    async def resume_stale(self):
+        """Продолжает рассылки, прерванные перезапуском бота. Вызывается при старте и по расписанию."""
+        for broadcast in await db.claim_stale_broadcasts(self._stale_after_seconds):
+            logger.info(f"Resuming broadcast {broadcast.id} from user_id > {broadcast.cursor}.")
+            self.start(broadcast.id)
+
+    def get_metrics(self) -> dict:
+        return {"running": sum(1 for task in self._tasks.values() if not task.done())}
+
+    async def _run(self, broadcast_id: int):
+        broadcast = await db.get_broadcast(broadcast_id)
+        if not broadcast or broadcast.status != "running":
+            return
+
+        cursor = broadcast.cursor
+        semaphore = asyncio.Semaphore(self._concurrency)
+        last_progress_at = 0.0
+        logger.info(f"Broadcast {broadcast_id} started (cursor={cursor}).")
+        try:
+            # Рассылка - массовые сообщения: пропускаем вперед уведомления об оплате
+            with send_priority(SendPriority.BULK):
+                while True:
+                    recipients = await db.get_broadcast_recipients(cursor, self._batch_size, broadcast.segment)
+                    if not recipients:
+                        broadcast = await db.set_broadcast_status(broadcast_id, "done", from_statuses=("running",))
+                        break
+
+                    results = await asyncio.gather(
+                        *(self._send(semaphore, broadcast, user_id) for user_id in recipients)
+                    )
+                    cursor = recipients[-1]
+                    sent = results.count(SENT)
+                    # Заблокировавшие бота больше не попадут в рассылки до следующего /start
+                    await db.mark_users_unreachable(
+                        [user_id for user_id, result in zip(recipients, results) if result == UNREACHABLE]
+                    )
+                    status = await db.save_broadcast_progress(broadcast_id, cursor, sent, len(results) - sent)
+                    if status != "running":
+                        # Администратор поставил рассылку на паузу или отменил ее
+                        broadcast = None
+                        break
+
+                    if time.monotonic() - last_progress_at >= self._progress_interval:
+                        last_progress_at = time.monotonic()
+                        await self._show_progress(await db.get_broadcast(broadcast_id))
+        except Exception as e:
+            # Статус остается running: рассылку продолжит resume_stale с последней контрольной точки
+            logger.error(f"Broadcast {broadcast_id} worker crashed at cursor {cursor}: {e}", exc_info=True)
+            return
+        finally:
+            self._tasks.pop(broadcast_id, None)
+
+        if broadcast:
+            logger.info(f"Broadcast {broadcast_id} finished: sent={broadcast.sent}, failed={broadcast.failed}.")
+            await self._show_progress(broadcast)
+
+    async def _send(self, semaphore: asyncio.Semaphore, broadcast, user_id: int) -> str:
+        async with semaphore:
+            try:
+                if broadcast.message_ids:
+                    # Альбом целиком - одним запросом на получателя
+                    await self._bot.copy_messages(
+                        chat_id=user_id,
+                        from_chat_id=broadcast.from_chat_id,
+                        message_ids=broadcast.message_ids
+                    )
+                else:
+                    await self._bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=broadcast.from_chat_id,
+                        message_id=broadcast.message_id
+                    )
+                return SENT
+            except Exception as e:
+                if is_unreachable_chat_error(e):
+                    return UNREACHABLE
+                logger.warning(f"Broadcast {broadcast.id} failed for user {user_id}. Error: {e}")
+                return FAILED
+
+    async def _show_progress(self, broadcast):
+        """Обновляет сообщение с прогрессом у администратора."""
+        if not broadcast or not broadcast.progress_message_id:
+            return
+        try:
+            await self._bot.edit_message_text(
+                chat_id=broadcast.admin_chat_id,
+                message_id=broadcast.progress_message_id,
+                text=format_broadcast_progress(broadcast),
+                reply_markup=broadcast_control_keyboard(broadcast.id, broadcast.status)
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" и удаленное сообщение не должны мешать рассылке
+            logger.debug(f"Could not update progress of broadcast {broadcast.id}: {e}")
+        except Exception as e:
+            logger.warning(f"Could not update progress of broadcast {broadcast.id}: {e}")
@@ -0,0 +1,143 @@
+# tgbot/services/cache_bus.py
+
+import asyncio
+import os
+import socket
+from typing import Callable
+
+import asyncpg
+
+from database import requests as db
+from db import ASYNCPG_DSN
+from loader import logger
+
+# Канал Postgres, через который процессы бота сообщают друг другу об изменениях
+CHANNEL = "bot_cache_invalidation"
+# Ограничение Postgres на размер payload одного NOTIFY - с запасом
+MAX_PAYLOAD = 7000
+# Как часто проверять соединение слушателя
+WATCHDOG_INTERVAL = 10
+
+# Темы сброса
+TARIFFS = "tariffs"
+CHANNELS = "channels"
+FSM = "fsm"
+# Особое значение: сбросить все (после переподключения уведомления могли быть потеряны)
+ALL = "*"
+
+
+class CacheInvalidationBus:
+    """
+    Сброс кэшей во всех процессах бота через LISTEN/NOTIFY основной БД.
+
+    Кэши подписываются на темы (subscribe), а код, изменивший данные, вызывает
+    invalidate: локальные кэши сбрасываются сразу, остальным процессам уходит NOTIFY.
+    Пока шина не запущена (один процесс), invalidate работает только локально.
+    """
+
+    def __init__(self):
+        self._handlers: dict[str, list[Callable[[str], None]]] = {}
+        # Отличаем свои уведомления от чужих: Postgres доставляет NOTIFY и отправителю
+        self._origin = f"{socket.gethostname()}:{os.getpid()}"
+        self._connection: asyncpg.Connection | None = None
+        self._watchdog: asyncio.Task | None = None
+        self._published = 0
+        self._received = 0
+        self._reconnects = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._watchdog is not None
+
+    def subscribe(self, topic: str, handler: Callable[[str], None]):
+        """handler получает payload уведомления или ALL, если сбросить нужно все."""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    async def invalidate(self, topic: str, payload: str = ""):
+        """Сбрасывает кэш темы в этом процессе и во всех остальных."""
+        self._dispatch(topic, payload)
+        await self.publish(topic, payload)
+
+    async def publish(self, topic: str, payload: str = ""):
+        """Сообщает остальным процессам об изменении, не трогая локальные кэши."""
+        if not self.enabled:
+            return
+        try:
+            await db.notify(CHANNEL, f"{self._origin}|{topic}|{payload}")
+            self._published += 1
+        except Exception as e:
+            # Остальные процессы увидят изменения по истечении TTL своих кэшей:
+            # REFERENCE_TTL у справочных данных, cache_ttl у прочитанных состояний FSM
+            logger.error(f"Failed to publish cache invalidation '{topic}': {e}")
+
+    async def publish_keys(self, topic: str, keys: list[str]):
+        """Публикует список ключей через запятую, разбивая его на уведомления допустимого размера."""
+        chunk, size = [], 0
+        for key in keys:
+            if chunk and size + len(key) + 1 > MAX_PAYLOAD:
+                await self.publish(topic, ",".join(chunk))
+                chunk, size = [], 0
+            chunk.append(key)
+            size += len(key) + 1
+        if chunk:
+            await self.publish(topic, ",".join(chunk))
+
+    async def start(self):
+        if self._watchdog:
+            return
+        await self._connect()
+        self._watchdog = asyncio.create_task(self._watch())
+        logger.info("Cross-process cache invalidation started.")
+
+    async def stop(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self._connection and not self._connection.is_closed():
+            await self._connection.close()
+
+    def get_metrics(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "published": self._published,
+            "received": self._received,
+            "reconnects": self._reconnects,
+        }
+
+    async def _connect(self):
+        # Отдельное соединение вне пула: оно постоянно держит LISTEN
+        self._connection = await asyncpg.connect(ASYNCPG_DSN)
+        await self._connection.add_listener(CHANNEL, self._on_notification)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            if self._connection and not self._connection.is_closed():
+                continue
+            try:
+                await self._connect()
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener reconnect failed: {e}")
+                continue
+            self._reconnects += 1
+            # Пока соединения не было, уведомления терялись - сбрасываем все
+            for topic in list(self._handlers):
+                self._dispatch(topic, ALL)
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str):
+        origin, topic, body = payload.split("|", 2)
+        if origin == self._origin:
+            return
+        self._received += 1
+        self._dispatch(topic, body)
+
+    def _dispatch(self, topic: str, payload: str):
+        for handler in self._handlers.get(topic, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"Cache invalidation handler for '{topic}' failed: {e}", exc_info=True)
+
+
+# Единая шина сброса кэшей для всего процесса
+cache_bus = CacheInvalidationBus()
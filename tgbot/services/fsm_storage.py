@@ -0,0 +1,204 @@
+# tgbot/services/fsm_storage.py
+
+import asyncio
+import json
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from cachetools import TTLCache
+
+from database import requests as db
+from loader import logger
+
+# Пауза перед повторной попыткой сохранения, если БД недоступна
+FLUSH_RETRY_DELAY = 5
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states основной БД.
+
+    Состояния переживают перезапуск бота и доступны всем его копиям. Запись
+    отложенная: изменения копятся в памяти и сохраняются одной транзакцией раз
+    в flush_interval секунд, поэтому серия update_data в одном хендлере дает
+    одну запись в БД. Прочитанные записи кэшируются на cache_ttl секунд
+    (cache_ttl=0 - без кэша, каждое чтение идет в БД). Запись, которую не меняли
+    ttl, считается удаленной.
+
+    При нескольких процессах on_saved получает ключи сохраненных записей, чтобы
+    сообщить остальным процессам, а те сбрасывают их у себя через invalidate.
+    """
+
+    def __init__(self, ttl: timedelta = timedelta(days=3), flush_interval: float = 0.5,
+                 cache_ttl: float = 60, cache_size: int = 50_000,
+                 on_saved: Callable[[list[str]], Awaitable[None]] | None = None):
+        self._ttl = ttl
+        self._on_saved = on_saved
+        self._flush_interval = flush_interval
+        self._cache: TTLCache = TTLCache(maxsize=cache_size, ttl=cache_ttl or 1)
+        self._cache_enabled = cache_ttl > 0
+        # Измененные, но еще не сохраненные записи. Они не вытесняются из памяти, в отличие от кэша
+        self._dirty: dict[str, _Record] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._writes = 0
+        self._flushes = 0
+        self._flushed_records = 0
+        self._loads = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny]
+        return ":".join("" if part is None else str(part) for part in parts)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record_key = self._key(key)
+        record = await self._load(record_key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(record_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record_key = self._key(key)
+        record = await self._load(record_key)
+        record.data = data.copy()
+        self._mark_dirty(record_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self._key(key))).data.copy()
+
+    async def close(self) -> None:
+        """Сохраняет несохраненные изменения при остановке бота."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    def disable_read_cache(self):
+        """Читает записи из БД при каждом обращении: без шины сброса кэш мог бы отдать чужие устаревшие данные."""
+        self._cache_enabled = False
+        self._cache.clear()
+
+    def invalidate(self, record_keys: list[str] | None = None):
+        """Забывает прочитанные записи (все, если ключи не переданы). Несохраненные не трогает."""
+        if record_keys is None:
+            self._cache.clear()
+        for record_key in record_keys or []:
+            self._cache.pop(record_key, None)
+        for record_key, record in self._dirty.items():
+            self._remember(record_key, record)
+
+    def get_metrics(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "writes": self._writes,
+            "flushes": self._flushes,
+            "flushed_records": self._flushed_records,
+            "loads": self._loads,
+        }
+
+    async def flush(self):
+        """Сохраняет все накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            batch, self._dirty = self._dirty, {}
+            if not batch:
+                return
+
+            try:
+                records, delete_keys = self._serialize(batch)
+                await db.save_fsm_records(records, delete_keys)
+            except BaseException:
+                # Возвращаем в очередь то, что не успели изменить повторно (в том числе при отмене)
+                for record_key, record in batch.items():
+                    self._dirty.setdefault(record_key, record)
+                raise
+            self._flushes += 1
+            self._flushed_records += len(batch)
+
+        if self._on_saved:
+            await self._on_saved(list(batch))
+
+    def _serialize(self, batch: dict[str, _Record]) -> tuple[list[dict], list[str]]:
+        """
+        Готовит строки для сохранения. Запись, данные которой не сериализуются в JSON,
+        пропускается и убирается из пачки: повтор не поможет, а остальные записи сохранятся.
+        """
+        expires_at = datetime.now() + self._ttl
+        records, delete_keys = [], []
+        for record_key, record in list(batch.items()):
+            if record.state is None and not record.data:
+                delete_keys.append(record_key)
+                continue
+            try:
+                data = json.dumps(record.data, ensure_ascii=False, separators=(",", ":")) if record.data else None
+            except (TypeError, ValueError) as e:
+                logger.error(f"Skipping FSM record '{record_key}': data is not JSON serializable: {e}")
+                del batch[record_key]
+                continue
+            records.append({"key": record_key, "state": record.state, "data": data, "expires_at": expires_at})
+        return records, delete_keys
+
+    async def _load(self, record_key: str) -> _Record:
+        record = self._cached(record_key)
+        if record is not None:
+            return record
+
+        row = await db.get_fsm_record(record_key)
+        self._loads += 1
+        # Пока шел запрос, запись могли загрузить или изменить параллельно - берем ту версию
+        record = self._cached(record_key)
+        if record is not None:
+            return record
+
+        record = _Record()
+        if row:
+            record.state, data = row
+            record.data = json.loads(data) if data else {}
+        self._remember(record_key, record)
+        return record
+
+    def _cached(self, record_key: str) -> _Record | None:
+        record = self._dirty.get(record_key)
+        if record is None and self._cache_enabled:
+            record = self._cache.get(record_key)
+        return record
+
+    def _remember(self, record_key: str, record: _Record):
+        if self._cache_enabled:
+            self._cache[record_key] = record
+
+    def _mark_dirty(self, record_key: str, record: _Record):
+        self._dirty[record_key] = record
+        self._remember(record_key, record)
+        self._writes += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self._flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to save FSM states, retrying in {FLUSH_RETRY_DELAY}s: {e}")
+                delay = FLUSH_RETRY_DELAY
+                continue
+            # Изменения, сделанные во время сохранения, уходят следующей пачкой
+            if not self._dirty:
+                return
+            delay = self._flush_interval
@@ -0,0 +1,149 @@
+# tgbot/services/leader.py
+
+import asyncio
+import inspect
+import time
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from db import ASYNCPG_DSN
+from loader import logger
+
+# Ключ advisory-блокировки лидера (не совпадает с ключом блокировки миграций)
+LEADER_LOCK_KEY = 7_301_002
+
+# Проверка, что блокировку держит именно наше соединение
+HELD_LOCK_SQL = (
+    "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND granted "
+    "AND pid = pg_backend_pid() AND classid = ($1::bigint >> 32)::oid AND objid = ($1::bigint & 4294967295)::oid "
+    "AND objsubid = 1)"
+)
+
+
+class LeaderElector:
+    """
+    Выбор единственного лидера среди процессов и копий бота на advisory-блокировке Postgres.
+
+    Каждый процесс держит отдельное соединение и раз в heartbeat_interval секунд либо
+    пытается взять блокировку (pg_try_advisory_lock), либо, будучи лидером, проверяет,
+    что она все еще за ним. Блокировка живет, пока живо соединение:
+    - при остановке лидер отпускает ее сразу;
+    - если лидер не смог проверить блокировку, он считает себя смещенным и закрывает соединение;
+    - если процесс лидера пропал без закрытия соединения, Postgres обнаружит это по TCP keepalive
+      примерно за 3 * heartbeat_interval.
+    Итого другой процесс становится лидером не позже чем через ~4 * heartbeat_interval.
+    """
+
+    def __init__(
+            self,
+            on_elected: Callable[[], Awaitable[None] | None],
+            on_demoted: Callable[[], Awaitable[None] | None],
+            lock_key: int = LEADER_LOCK_KEY,
+            heartbeat_interval: float = 5,
+    ):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._lock_key = lock_key
+        self._interval = heartbeat_interval
+        self._connection: asyncpg.Connection | None = None
+        self._task: asyncio.Task | None = None
+        self._is_leader = False
+        self._last_heartbeat = 0.0
+        self._elections = 0
+        self._demotions = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает выборы и отпускает лидерство, чтобы другой процесс подхватил его без задержки."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._step_down("shutdown")
+        await self._disconnect()
+
+    def get_metrics(self) -> dict:
+        return {
+            "is_leader": self._is_leader,
+            "elections": self._elections,
+            "demotions": self._demotions,
+            "heartbeat_age": round(time.monotonic() - self._last_heartbeat, 1) if self._is_leader else None,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Leader election: database check failed: {e}")
+                await self._step_down("lost connection to the database")
+                await self._disconnect()
+            await asyncio.sleep(self._interval)
+
+    async def _tick(self):
+        if self._connection is None or self._connection.is_closed():
+            self._connection = await asyncpg.connect(
+                ASYNCPG_DSN,
+                timeout=self._interval,
+                server_settings={
+                    "application_name": "vpn_bot_leader",
+                    # Postgres закроет соединение (и отпустит блокировку) пропавшего процесса
+                    "tcp_keepalives_idle": str(int(self._interval)),
+                    "tcp_keepalives_interval": str(int(self._interval)),
+                    "tcp_keepalives_count": "2",
+                },
+            )
+
+        if self._is_leader:
+            held = await self._connection.fetchval(HELD_LOCK_SQL, self._lock_key, timeout=self._interval)
+            if not held:
+                await self._step_down("lock is no longer held")
+                return
+            self._last_heartbeat = time.monotonic()
+            return
+
+        acquired = await self._connection.fetchval(
+            "SELECT pg_try_advisory_lock($1)", self._lock_key, timeout=self._interval
+        )
+        if acquired:
+            self._is_leader = True
+            self._last_heartbeat = time.monotonic()
+            self._elections += 1
+            logger.info("Leader election: this process is now the leader.")
+            await self._call(self._on_elected)
+
+    async def _step_down(self, reason: str):
+        if not self._is_leader:
+            return
+        self._is_leader = False
+        self._demotions += 1
+        logger.warning(f"Leader election: stepping down ({reason}).")
+        await self._call(self._on_demoted)
+
+    async def _disconnect(self):
+        # Закрытие соединения отпускает session-level блокировку
+        if self._connection and not self._connection.is_closed():
+            try:
+                await self._connection.close(timeout=self._interval)
+            except Exception:
+                self._connection.terminate()
+        self._connection = None
+
+    @staticmethod
+    async def _call(callback: Callable[[], Awaitable[None] | None]):
+        try:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"Leader election callback failed: {e}", exc_info=True)
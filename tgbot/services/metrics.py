@@ -0,0 +1,46 @@
+# tgbot/services/metrics.py
+
+import hmac
+from typing import Callable
+
+from aiohttp import web
+
+from loader import config, logger
+
+# Источники метрик: имя -> функция, возвращающая словарь с текущими значениями
+_sources: dict[str, Callable[[], dict]] = {}
+
+
+def register_source(name: str, collector: Callable[[], dict]):
+    """Регистрирует источник метрик (пул БД, очереди, лимитеры и т.д.)."""
+    _sources[name] = collector
+
+
+def collect() -> dict:
+    """Собирает снимок всех зарегистрированных метрик."""
+    snapshot = {}
+    for name, collector in _sources.items():
+        try:
+            snapshot[name] = collector()
+        except Exception as e:
+            logger.warning(f"Failed to collect metrics from '{name}': {e}")
+            snapshot[name] = None
+    return snapshot
+
+
+def check_access(request: web.Request):
+    """
+    Пускает к /metrics только с токеном METRICS_TOKEN: эндпоинт слушает публичный порт
+    и раскрывает внутреннее состояние бота. Без настроенного токена /metrics недоступен.
+    """
+    token = config.webhook.metrics_token
+    if not token:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        raise web.HTTPUnauthorized()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """HTTP-эндпоинт /metrics: отдает снимок метрик в JSON."""
+    check_access(request)
+    return web.json_response(collect())
@@ -1,18 +1,112 @@
 
+import asyncio
 import uuid
-from yookassa import Configuration, Payment
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional, Dict, Any
+
+import aiohttp
 from yookassa.domain.notification import WebhookNotification
 
 
 # Импортируем наш объект конфига из loader
-from loader import config
+from loader import config, logger
+
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
+
+# События YooKassa, которые меняют статус платежа в журнале
+PAYMENT_EVENT_STATUSES = {
+    'payment.waiting_for_capture': 'waiting_for_capture',
+    'payment.succeeded': 'succeeded',
+    'payment.canceled': 'canceled',
+}
+
+
+class YooKassaError(Exception):
+    """Ошибка обращения к API YooKassa."""
+
+    def __init__(self, status: int, body: Any):
+        self.status = status
+        self.body = body
+        super().__init__(f"YooKassa API error {status}: {body}")
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API YooKassa поверх aiohttp.
+    Синхронный SDK (requests) блокировал цикл событий на все время HTTPS-запроса,
+    здесь же используется одна переиспользуемая сессия с пулом соединений.
+    """
+
+    def __init__(self, shop_id: str, secret_key: str, timeout: float = 15, max_connections: int = 20,
+                 max_retries: int = 3):
+        self._auth = aiohttp.BasicAuth(str(shop_id), secret_key)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._max_connections = max_connections
+        self._max_retries = max_retries
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_connections),
+                auth=self._auth,
+                timeout=self._timeout,
+                headers={"Accept": "application/json"}
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, payload: dict = None,
+                       idempotence_key: str = None, params: dict = None) -> Dict[str, Any]:
+        """
+        Выполняет запрос к API. Ответ 202 (запрос еще обрабатывается) и ошибки 5xx
+        повторяются с тем же ключом идемпотентности, поэтому дубликат платежа не создается.
+        """
+        session = await self._get_session()
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+        for attempt in range(1, self._max_retries + 1):
+            retry_after = 1.0
+            try:
+                async with session.request(method, f"{YOOKASSA_API_URL}{path}", json=payload, params=params,
+                                           headers=headers) as response:
+                    body = await response.json(content_type=None)
+                    if response.status == 200:
+                        return body
+                    if response.status != 202 and response.status < 500:
+                        raise YooKassaError(response.status, body)
+                    error = YooKassaError(response.status, body)
+                    # YooKassa сама подсказывает паузу перед повтором (в миллисекундах)
+                    if isinstance(body, dict) and body.get("retry_after"):
+                        retry_after = body["retry_after"] / 1000
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self._max_retries:
+                raise error
+            logger.warning(f"YooKassa {method} {path} failed ({error}), retry {attempt} in {retry_after}s")
+            await asyncio.sleep(retry_after)
+
+    async def create_payment(self, payment_data: dict, idempotence_key: str) -> Dict[str, Any]:
+        return await self._request("POST", "/payments", payload=payment_data, idempotence_key=idempotence_key)
+
+    async def get_payment(self, payment_id: str) -> Dict[str, Any]:
+        return await self._request("GET", f"/payments/{payment_id}")
+
+    async def list_payments(self, params: dict) -> Dict[str, Any]:
+        return await self._request("GET", "/payments", params=params)
 
-# Настраиваем SDK YooKassa
-Configuration.account_id = config.yookassa.shop_id
-Configuration.secret_key = config.yookassa.secret_key
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
 
 
-def create_payment(user_id: int, amount: int, description: str, bot_username: str, metadata: dict = None):
+yookassa_client = YooKassaClient(
+    shop_id=config.yookassa.shop_id,
+    secret_key=config.yookassa.secret_key,
+    timeout=config.yookassa.api_timeout
+)
+
+
+async def create_payment(user_id: int, amount: int, description: str, bot_username: str, metadata: dict = None):
     """
     Создает платеж в YooKassa и возвращает ссылку на оплату.
     """
@@ -42,7 +136,7 @@ def create_payment(user_id: int, amount: int, description: str, bot_username: st
         ]
     }
     
-    payment = Payment.create({
+    payment = await yookassa_client.create_payment({
         "amount": {
             "value": str(amount),
             "currency": "RUB"
@@ -59,7 +153,35 @@ def create_payment(user_id: int, amount: int, description: str, bot_username: st
     }, idempotence_key)
     
     # Возвращаем URL для оплаты и ID платежа
-    return payment.confirmation.confirmation_url, payment.id
+    return payment["confirmation"]["confirmation_url"], payment["id"]
+
+
+async def get_payment(payment_id: str) -> Dict[str, Any]:
+    """
+    Возвращает актуальное состояние платежа из YooKassa.
+    """
+    return await yookassa_client.get_payment(payment_id)
+
+
+async def iter_succeeded_payments(created_before: datetime | None = None) -> AsyncIterator[list[Dict[str, Any]]]:
+    """
+    Перебирает успешные платежи магазина страницами, от новых к старым.
+    created_before - локальное время: более новые платежи пропускаются.
+    """
+    params = {"status": "succeeded", "limit": 100}
+    if created_before:
+        params["created_at.lt"] = created_before.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    while True:
+        page = await yookassa_client.list_payments(params)
+        yield page.get("items", [])
+        if not page.get("next_cursor"):
+            return
+        params = {**params, "cursor": page["next_cursor"]}
+
+
+def parse_api_datetime(value: str) -> datetime:
+    """Переводит время из API YooKassa (UTC, ISO 8601) в локальное время без зоны, как в БД."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone().replace(tzinfo=None)
 
 
 def parse_webhook_notification(request_body: dict) -> WebhookNotification | None:
@@ -71,4 +193,16 @@ def parse_webhook_notification(request_body: dict) -> WebhookNotification | None
         return notification_object
     except Exception:
         # Если тело запроса невалидно, вернется None
-        return None
\ No newline at end of file
+        return None
+
+
+def build_notification_payload(payment_object: dict) -> dict:
+    """
+    Оборачивает объект платежа из API в формат вебхук-уведомления,
+    чтобы результат опроса обрабатывался тем же кодом, что и настоящий вебхук.
+    """
+    return {
+        "type": "notification",
+        "event": f"payment.{payment_object['status']}",
+        "object": payment_object,
+    }
@@ -1,9 +1,21 @@
-import qrcode
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
-def create_qr_code(data: str) -> BytesIO:
+import qrcode
+from cachetools import LRUCache
+
+# Отрисовка QR и сжатие PNG нагружают процессор, поэтому выполняются в отдельном
+# ограниченном пуле потоков, а не в цикле событий бота
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qr_render")
+
+# Готовые PNG по содержимому QR: ссылка пользователя меняется редко
+_png_cache: LRUCache = LRUCache(maxsize=512)
+
+
+def _render_png(data: str) -> bytes:
     """
-    Создает QR-код из строки и возвращает его в виде байтового потока в памяти.
+    Создает QR-код из строки и возвращает PNG в виде байтов.
     """
     qr = qrcode.QRCode(
         version=1,
@@ -15,10 +27,19 @@ def create_qr_code(data: str) -> BytesIO:
     qr.make(fit=True)
 
     img = qr.make_image(fill_color="black", back_color="white")
-    
+
     # Сохраняем изображение в байтовый поток в памяти
     bio = BytesIO()
     img.save(bio, 'PNG')
-    bio.seek(0) # Перемещаем курсор в начало файла
-    
-    return bio
\ No newline at end of file
+    return bio.getvalue()
+
+
+async def create_qr_code(data: str) -> bytes:
+    """
+    Возвращает PNG с QR-кодом для строки: из кэша или отрисовав его в пуле потоков.
+    """
+    png = _png_cache.get(data)
+    if png is None:
+        png = await asyncio.get_running_loop().run_in_executor(_executor, _render_png, data)
+        _png_cache[data] = png
+    return png
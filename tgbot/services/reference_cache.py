@@ -0,0 +1,113 @@
+# tgbot/services/reference_cache.py
+
+import time
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, User
+
+from database import requests as db
+from loader import logger
+from tgbot.services.cache_bus import CHANNELS, TARIFFS, cache_bus
+from tgbot.keyboards.inline import channels_subscribe_keyboard, tariffs_keyboard
+
+# Страховка на случай потерянного уведомления cache_bus: тарифы и каналы перечитываются не реже
+REFERENCE_TTL = 300
+
+
+class ReferenceCache:
+    """
+    Справочные данные процесса: профиль бота, активные тарифы, обязательные каналы
+    и готовые клавиатуры к ним.
+
+    Данные меняются только из админки, поэтому сбрасываются явно хендлерами
+    управления тарифами и каналами. Сброшенный раздел загружается из БД при
+    следующем обращении. Сброс приходит через cache_bus, поэтому изменение в
+    админке видят все процессы бота. Если уведомление потерялось, раздел все
+    равно перечитывается через REFERENCE_TTL секунд.
+
+    Каждый сброс увеличивает поколение раздела: загрузка, во время которой раздел
+    сбросили, могла прочитать данные до изменения, поэтому она не сохраняется и повторяется.
+    """
+
+    def __init__(self):
+        self._bot_user: User | None = None
+        self._tariffs: list | None = None
+        self._tariffs_keyboard: InlineKeyboardMarkup | None = None
+        self._channels: list | None = None
+        self._channels_keyboard: InlineKeyboardMarkup | None = None
+        self._tariffs_generation = 0
+        self._channels_generation = 0
+        self._tariffs_loaded_at = 0.0
+        self._channels_loaded_at = 0.0
+
+    async def warm_up(self, bot: Bot):
+        """Заполняет кэш при старте, чтобы первые пользователи не ждали запросов к БД и API."""
+        await self.get_bot_user(bot)
+        await self.get_active_tariffs()
+        await self.get_required_channels()
+        logger.info(
+            f"Reference cache warmed up: {len(self._tariffs)} tariffs, {len(self._channels)} required channels."
+        )
+
+    # --- Профиль бота ---
+    async def get_bot_user(self, bot: Bot) -> User:
+        if self._bot_user is None:
+            self._bot_user = await bot.get_me()
+        return self._bot_user
+
+    async def get_bot_username(self, bot: Bot) -> str:
+        return (await self.get_bot_user(bot)).username
+
+    # --- Тарифы ---
+    async def get_active_tariffs(self) -> list:
+        while self._tariffs is None or self._expired(self._tariffs_loaded_at):
+            generation = self._tariffs_generation
+            tariffs = list(await db.get_active_tariffs())
+            if generation != self._tariffs_generation:
+                continue
+            self._tariffs_keyboard = tariffs_keyboard(tariffs) if tariffs else None
+            self._tariffs = tariffs
+            self._tariffs_loaded_at = time.monotonic()
+        return self._tariffs
+
+    async def get_tariffs_keyboard(self) -> InlineKeyboardMarkup | None:
+        """Клавиатура покупки тарифов или None, если активных тарифов нет."""
+        await self.get_active_tariffs()
+        return self._tariffs_keyboard
+
+    def invalidate_tariffs(self):
+        self._tariffs_generation += 1
+        self._tariffs = None
+        self._tariffs_keyboard = None
+
+    # --- Обязательные каналы ---
+    async def get_required_channels(self) -> list:
+        while self._channels is None or self._expired(self._channels_loaded_at):
+            generation = self._channels_generation
+            channels = list(await db.get_all_required_channels())
+            if generation != self._channels_generation:
+                continue
+            self._channels_keyboard = channels_subscribe_keyboard(channels) if channels else None
+            self._channels = channels
+            self._channels_loaded_at = time.monotonic()
+        return self._channels
+
+    async def get_channels_keyboard(self) -> InlineKeyboardMarkup | None:
+        """Клавиатура со ссылками на каналы или None, если каналов нет."""
+        await self.get_required_channels()
+        return self._channels_keyboard
+
+    def invalidate_channels(self):
+        self._channels_generation += 1
+        self._channels = None
+        self._channels_keyboard = None
+
+    @staticmethod
+    def _expired(loaded_at: float) -> bool:
+        return time.monotonic() - loaded_at > REFERENCE_TTL
+
+
+# Единый кэш справочных данных для всего бота
+reference_cache = ReferenceCache()
+cache_bus.subscribe(TARIFFS, lambda _: reference_cache.invalidate_tariffs())
+cache_bus.subscribe(CHANNELS, lambda _: reference_cache.invalidate_channels())
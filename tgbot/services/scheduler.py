@@ -1,12 +1,18 @@
 # tgbot/services/scheduler.py
 
+import asyncio
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot
 from datetime import datetime, timedelta
 
 from database import requests as db
-from tgbot.keyboards.inline import tariffs_keyboard # Импортируем клавиатуру с тарифами
-from .utils import decline_word
+from tgbot.services import payment
+from tgbot.services.webhook_queue import WebhookJobQueue
+from tgbot.services.broadcast import BroadcastManager
+from tgbot.middlewares.rate_limit import SendPriority, send_priority
+from tgbot.services.reference_cache import reference_cache
+from .utils import decline_word, is_unreachable_chat_error
 from loader import logger
 
 # --- 1. Основная функция, которую будет вызывать планировщик ---
@@ -14,16 +20,18 @@ from loader import logger
 async def send_reminder(bot: Bot, user, text: str):
     """Универсальная функция для отправки напоминания с клавиатурой тарифов."""
     try:
-        active_tariffs = db.get_active_tariffs()
-        tariffs_list = list(active_tariffs) if active_tariffs else []
-        
         await bot.send_message(
             chat_id=user.user_id,
             text=text,
-            reply_markup=tariffs_keyboard(tariffs_list) if tariffs_list else None
+            reply_markup=await reference_cache.get_tariffs_keyboard()
         )
         logger.info(f"Sent reminder to user {user.user_id}")
     except Exception as e:
+        if is_unreachable_chat_error(e):
+            # Больше не напоминаем, пока пользователь снова не напишет боту
+            await db.mark_users_unreachable([user.user_id])
+            logger.info(f"User {user.user_id} is unreachable, excluded from reminders.")
+            return
         logger.warning(f"Failed to send reminder to user {user.user_id}. Error: {e}")
 
 
@@ -32,10 +40,17 @@ async def send_reminder(bot: Bot, user, text: str):
 async def check_subscriptions(bot: Bot):
     """Проверяет подписки пользователей и отправляет гибкие напоминания."""
     logger.info("Scheduler job: Running subscription check...")
-    
+
+    # Напоминания - массовые сообщения: пропускаем вперед уведомления об оплате и ответы пользователям
+    with send_priority(SendPriority.BULK):
+        await _send_expiration_reminders(bot)
+
+
+async def _send_expiration_reminders(bot: Bot):
+    """Находит пользователей с истекающей подпиской и отправляет им напоминания."""
     # --- Проверка по дням (7 и 3 дня) ---
     for days_left in [7, 3]:
-        users_to_remind = db.get_users_with_expiring_subscription(days_left)
+        users_to_remind = await db.get_users_with_expiring_subscription(days_left)
         if not users_to_remind:
             continue
             
@@ -50,7 +65,7 @@ async def check_subscriptions(bot: Bot):
             await send_reminder(bot, user, text.format(user_full_name=user.full_name))
 
     # --- Проверка по часам (менее 24 часов) ---
-    users_less_than_day = db.get_users_with_expiring_subscription_in_hours(24)
+    users_less_than_day = await db.get_users_with_expiring_subscription_in_hours(24)
     if not users_less_than_day:
         return # Завершаем, если таких пользователей нет
         
@@ -68,9 +83,149 @@ async def check_subscriptions(bot: Bot):
         await send_reminder(bot, user, text)
 
 
-# --- 2. Функция для добавления всех задач в планировщик ---
+# --- Суточный срез статистики для админ-панели ---
+
+# За сколько прошедших дней досчитываются недостающие срезы (самый длинный период в статистике)
+STATS_BACKFILL_DAYS = 30
+
+
+async def rollup_daily_stats():
+    """
+    Сохраняет в daily_stats срезы за все завершенные дни последних STATS_BACKFILL_DAYS,
+    которых там еще нет: после первого запуска, простоя бота или пропущенного запуска в полночь.
+    Уже сохраненные дни не пересчитываются. Точный срез получает только вчерашний день,
+    досчитанные задним числом дни приблизительны (см. db.save_daily_stats).
+    """
+    yesterday = datetime.now().date() - timedelta(days=1)
+    try:
+        missing = await db.get_missing_daily_stats_days(yesterday - timedelta(days=STATS_BACKFILL_DAYS - 1), yesterday)
+        for day in missing:
+            await db.save_daily_stats(day)
+        if missing:
+            logger.info(f"Scheduler job: Daily stats saved for {len(missing)} day(s), {missing[0]} - {missing[-1]}.")
+    except Exception as e:
+        logger.error(f"Failed to save daily stats: {e}", exc_info=True)
+
+
+# --- Перенос старых оплат в журнал платежей ---
+
+async def backfill_payment_ledger():
+    """
+    Переносит в журнал платежей успешные оплаты YooKassa, созданные раньше самого старого
+    платежа журнала, - то есть сделанные до его появления. Без них пользователи, платившие
+    раньше, попадают в сегменты рассылок "никогда не платил" и в статистику конверсий.
+    После первого полного переноса обходится одним запросом к API.
+    """
+    created_before = await db.get_payment_ledger_start()
+    imported = 0
+    async for items in payment.iter_succeeded_payments(created_before):
+        records = []
+        for item in items:
+            metadata = item.get("metadata") or {}
+            try:
+                user_id, tariff_id = int(metadata["user_id"]), int(metadata["tariff_id"])
+            except (KeyError, TypeError, ValueError):
+                # Платеж не от бота
+                continue
+            created_at = payment.parse_api_datetime(item["created_at"])
+            records.append({
+                "id": item["id"],
+                "user_id": user_id,
+                "tariff_id": tariff_id,
+                "amount": float(item["amount"]["value"]),
+                "created_at": created_at,
+                "paid_at": payment.parse_api_datetime(item["captured_at"]) if item.get("captured_at") else created_at,
+            })
+        imported += await db.import_succeeded_payments(records)
+    if imported:
+        logger.info(f"Imported {imported} earlier succeeded payments into the payment ledger.")
+
+
+async def backfill_history():
+    """При старте: сначала переносит старые оплаты, затем досчитывает срезы статистики, где они уже учтены."""
+    try:
+        await backfill_payment_ledger()
+    except Exception as e:
+        logger.error(f"Failed to backfill the payment ledger: {e}", exc_info=True)
+    await rollup_daily_stats()
+
+
+# --- Очистка очереди вебхуков ---
+
+async def cleanup_webhook_jobs():
+    """Удаляет давно выполненные задачи очереди вебхуков, чтобы таблица не разрасталась."""
+    try:
+        deleted = await db.delete_finished_webhook_jobs(older_than_days=7)
+        if deleted:
+            logger.info(f"Deleted {deleted} finished webhook jobs.")
+    except Exception as e:
+        logger.error(f"Failed to clean up webhook jobs: {e}", exc_info=True)
+
+
+async def cleanup_fsm_states():
+    """Удаляет истекшие состояния FSM."""
+    try:
+        deleted = await db.delete_expired_fsm_records()
+        if deleted:
+            logger.info(f"Deleted {deleted} expired FSM states.")
+    except Exception as e:
+        logger.error(f"Failed to clean up FSM states: {e}", exc_info=True)
+
+
+# --- Опрос статусов платежей (на случай потерянных вебхуков) ---
 
-def schedule_jobs(scheduler: AsyncIOScheduler, bot: Bot):
+PAYMENT_POLL_BATCH_SIZE = 50        # Сколько платежей проверяем за один запуск
+PAYMENT_POLL_CONCURRENCY = 10       # Сколько запросов к YooKassa выполняется одновременно
+PAYMENT_POLL_MAX_AGE_HOURS = 24     # Более старые неоплаченные платежи не проверяем
+PAYMENT_POLL_BASE_INTERVAL = 60     # Первая повторная проверка через минуту, дальше интервал удваивается
+PAYMENT_POLL_MAX_INTERVAL = 3600    # ... но не реже раза в час
+
+
+async def _check_payment_status(payment_id: str, semaphore: asyncio.Semaphore, payment_queue: WebhookJobQueue):
+    async with semaphore:
+        payment_object = await payment.get_payment(payment_id)
+
+    event = f"payment.{payment_object['status']}"
+    if event not in payment.PAYMENT_EVENT_STATUSES:
+        return
+    # Тот же ключ дедупликации, что и у вебхука: если вебхук все же придет, повторной обработки не будет
+    created = await payment_queue.enqueue(
+        dedup_key=f"{payment_id}:{event}",
+        kind="yookassa",
+        payload=payment.build_notification_payload(payment_object)
+    )
+    if created:
+        logger.info(f"Payment poller: payment {payment_id} is '{payment_object['status']}', queued for processing.")
+
+
+async def poll_pending_payments(payment_queue: WebhookJobQueue):
+    """
+    Проверяет в YooKassa статус недавних неоплаченных платежей из журнала.
+    Оплаченные и отмененные платежи отправляются в ту же очередь, что и вебхуки,
+    поэтому продление подписки остается идемпотентным.
+    """
+    payments = await db.claim_payments_for_status_check(
+        limit=PAYMENT_POLL_BATCH_SIZE,
+        max_age_hours=PAYMENT_POLL_MAX_AGE_HOURS,
+        base_interval_seconds=PAYMENT_POLL_BASE_INTERVAL,
+        max_interval_seconds=PAYMENT_POLL_MAX_INTERVAL
+    )
+    if not payments:
+        return
+
+    semaphore = asyncio.Semaphore(PAYMENT_POLL_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_check_payment_status(p.id, semaphore, payment_queue) for p in payments),
+        return_exceptions=True
+    )
+    for p, result in zip(payments, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Payment poller: failed to check payment {p.id}: {result}")
+
+
+# --- 2. Функция для добавления всех задач в планировщик ---
+def schedule_jobs(scheduler: AsyncIOScheduler, bot: Bot, payment_queue: WebhookJobQueue,
+                  broadcast_manager: BroadcastManager):
     """
     Добавляет все фоновые задачи в планировщик.
     Вызывается один раз при старте бота.
@@ -83,5 +238,27 @@ def schedule_jobs(scheduler: AsyncIOScheduler, bot: Bot):
         minute=30,          # Указываем минуту
         kwargs={'bot': bot}
     )
+
+    # Срезы статистики за прошедшие дни - сразу после полуночи и один раз при старте,
+    # чтобы досчитать дни до появления daily_stats и дни, когда бот был выключен.
+    # При старте перед этим в журнал переносятся оплаты, сделанные до его появления
+    scheduler.add_job(rollup_daily_stats, trigger='cron', hour=0, minute=5)
+    scheduler.add_job(backfill_history, trigger='date')
+
+    scheduler.add_job(cleanup_webhook_jobs, trigger='cron', hour=3, minute=0)
+    scheduler.add_job(cleanup_fsm_states, trigger='cron', hour=3, minute=10)
+
+    # Каждую минуту проверяем платежи, по которым подошло время очередной проверки
+    scheduler.add_job(
+        poll_pending_payments,
+        trigger='interval',
+        minutes=1,
+        max_instances=1,
+        coalesce=True,
+        kwargs={'payment_queue': payment_queue}
+    )
+
+    # Подхватываем рассылки, воркер которых перестал отмечаться (например, упал процесс)
+    scheduler.add_job(broadcast_manager.resume_stale, trigger='interval', minutes=1, max_instances=1, coalesce=True)
     
     logger.info("Scheduler jobs added.")
\ No newline at end of file
@@ -1,26 +1,57 @@
 # tgbot/services/subscription.py
 
+import asyncio
+
 from aiogram import Bot
 from aiogram.enums import ChatMemberStatus
-from typing import List
-from database import requests as db
+from cachetools import TTLCache
+
+from loader import logger
+from tgbot.services.reference_cache import reference_cache
+
+# Статусы, при которых пользователь не считается подписчиком канала
+NOT_SUBSCRIBED_STATUSES = (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED)
+
+# Подтвержденные подписки (channel_id, user_id). Отрицательный результат не кэшируется:
+# пользователь подписывается и сразу нажимает «Проверить»
+_memberships: TTLCache = TTLCache(maxsize=100_000, ttl=300)
+
+
+def update_membership(channel_id: int, user_id: int, status: str):
+    """Обновляет кэш по событию chat_member из канала, где бот администратор."""
+    if status in NOT_SUBSCRIBED_STATUSES:
+        _memberships.pop((channel_id, user_id), None)
+    else:
+        _memberships[(channel_id, user_id)] = True
+
+
+async def _is_member(bot: Bot, channel_id: int, user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+    except Exception as e:
+        # Если бот не админ в канале или ID неверный, считаем, что пользователь не подписан
+        logger.warning(f"Could not check membership of user {user_id} in channel {channel_id}: {e}")
+        return False
+    return member.status not in NOT_SUBSCRIBED_STATUSES
+
 
 async def check_subscription(bot: Bot, user_id: int) -> bool:
     """
     Проверяет, подписан ли пользователь на все каналы из БД.
     Возвращает True, если подписан на все, иначе False.
     """
-    required_channels = await db.get_all_required_channels()
+    required_channels = await reference_cache.get_required_channels()
     if not required_channels:
         return True # Если каналов в списке нет, проверка пройдена
 
-    for channel in required_channels:
-        try:
-            member = await bot.get_chat_member(chat_id=channel.channel_id, user_id=user_id)
-            if member.status in [ChatMemberStatus.LEFT, ChatMemberStatus.KICKED]:
-                return False # Если пользователь не подписан хотя бы на один канал
-        except Exception:
-            # Если бот не админ в канале или ID неверный, считаем, что пользователь не подписан
-            return False
-            
-    return True # Если циклы завершились, пользователь подписан на все
\ No newline at end of file
+    # Проверяем параллельно только каналы без подтвержденной подписки в кэше
+    unchecked = [
+        channel.channel_id for channel in required_channels
+        if (channel.channel_id, user_id) not in _memberships
+    ]
+    results = await asyncio.gather(*(_is_member(bot, channel_id, user_id) for channel_id in unchecked))
+
+    for channel_id, is_member in zip(unchecked, results):
+        if is_member:
+            _memberships[(channel_id, user_id)] = True
+    return all(results)
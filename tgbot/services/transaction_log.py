@@ -0,0 +1,140 @@
+# tgbot/services/transaction_log.py
+
+import asyncio
+import time
+from dataclasses import dataclass
+
+from aiogram import Bot
+
+from loader import bot, config, logger
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+
+@dataclass
+class TransactionEvent:
+    text: str
+    amount: float
+
+
+class TransactionLogBuffer:
+    """
+    Лог транзакций в тему чата поддержки с режимом сводки.
+
+    При низкой нагрузке каждое событие отправляется сразу отдельным сообщением.
+    Если события идут чаще, чем раз в flush_interval секунд, они копятся в буфере
+    и отправляются одним сообщением-сводкой: по таймеру или при накоплении max_events.
+    Так лог не расходует лимит групповых сообщений во время акций.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, thread_id: int | None,
+                 flush_interval: float = 60, max_events: int = 20):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._thread_id = thread_id
+        self._flush_interval = flush_interval
+        self._max_events = max_events
+        self._events: list[TransactionEvent] = []
+        self._last_sent_at = 0.0
+        self._flush_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        # Время отправки сообщений лога в Telegram (сам add в режиме сводки только пишет в буфер)
+        self._sends = 0
+        self._send_errors = 0
+        self._digests = 0
+        self._send_total_ms = 0.0
+        self._send_max_ms = 0.0
+
+    async def add(self, text: str, amount: float):
+        """Добавляет событие: отправляет сразу или откладывает в сводку."""
+        # Сводка отключена или давно ничего не отправляли - отправляем как есть
+        if self._flush_interval <= 0 or (
+                not self._events and time.monotonic() - self._last_sent_at >= self._flush_interval):
+            self._last_sent_at = time.monotonic()
+            await self._send(text)
+            return
+
+        self._events.append(TransactionEvent(text=text, amount=amount))
+        if len(self._events) >= self._max_events:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """Отправляет все накопленные события одним сообщением (или несколькими, если не влезают)."""
+        async with self._lock:
+            events, self._events = self._events, []
+            if not events:
+                return
+            self._last_sent_at = time.monotonic()
+            if len(events) == 1:
+                await self._send(events[0].text)
+                return
+            self._digests += 1
+            for chunk in self._build_digest(events):
+                await self._send(chunk)
+
+    def get_metrics(self) -> dict:
+        return {
+            "buffered": len(self._events),
+            "sends": self._sends,
+            "send_errors": self._send_errors,
+            "digests": self._digests,
+            "send_avg_ms": round(self._send_total_ms / self._sends, 1) if self._sends else 0.0,
+            "send_max_ms": round(self._send_max_ms, 1),
+        }
+
+    async def close(self):
+        """Отправляет остаток буфера при остановке бота."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush transaction log digest: {e}")
+
+    def _build_digest(self, events: list[TransactionEvent]) -> list[str]:
+        total = sum(event.amount for event in events)
+        header = f"🧾 <b>Сводка транзакций:</b> {len(events)} шт. на сумму {total:g} RUB"
+        chunks, current = [], header
+        for event in events:
+            block = f"\n\n{event.text}"
+            if len(current) + len(block) > MESSAGE_LIMIT:
+                chunks.append(current)
+                current = event.text
+            else:
+                current += block
+        chunks.append(current)
+        return chunks
+
+    async def _send(self, text: str):
+        started_at = time.perf_counter()
+        try:
+            await self._bot.send_message(
+                chat_id=self._chat_id,
+                message_thread_id=self._thread_id,
+                text=text
+            )
+        except Exception:
+            self._send_errors += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            self._sends += 1
+            self._send_total_ms += elapsed_ms
+            self._send_max_ms = max(self._send_max_ms, elapsed_ms)
+
+
+# Единый буфер лога транзакций для всего бота
+transaction_log = TransactionLogBuffer(
+    bot=bot,
+    chat_id=config.tg_bot.support_chat_id,
+    thread_id=config.tg_bot.transaction_log_topic_id,
+    flush_interval=config.tg_bot.transaction_digest_interval,
+    max_events=config.tg_bot.transaction_digest_max_events
+)
@@ -5,7 +5,7 @@ from datetime import datetime
 from xui.init_client import XUIClient
 from database import requests as db
 from aiogram import types
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
 from tgbot.keyboards.inline import back_to_main_menu_keyboard
 from loader import logger
@@ -36,6 +36,17 @@ def decline_word(number: int, titles: list[str]) -> str:
     else:
         return titles[2]
 
+# Ошибки Telegram, после которых писать пользователю бессмысленно
+UNREACHABLE_CHAT_ERRORS = ("chat not found", "user is deactivated", "bot was blocked")
+
+def is_unreachable_chat_error(error: Exception) -> bool:
+    """Проверяет, означает ли ошибка отправки, что чат пользователя недоступен навсегда."""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        return any(reason in str(error.message).lower() for reason in UNREACHABLE_CHAT_ERRORS)
+    return False
+
 # --- ОСНОВНАЯ АДАПТАЦИЯ ---
 async def get_xui_user_info(event: types.Message | types.CallbackQuery, xui: XUIClient):
     """
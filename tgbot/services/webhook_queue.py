@@ -0,0 +1,119 @@
+# tgbot/services/webhook_queue.py
+
+import asyncio
+from typing import Awaitable, Callable
+
+from database import requests as db
+from loader import logger
+
+
+class PermanentJobError(Exception):
+    """Ошибка, которую повтор не исправит: задача сразу помечается failed для ручного разбора."""
+
+
+class WebhookJobQueue:
+    """
+    Долговечная очередь обработки вебхуков поверх таблицы webhook_jobs.
+
+    Хендлер вебхука только сохраняет задачу (enqueue) и сразу отвечает 200,
+    а фиксированное число воркеров разбирает очередь с ограниченной параллельностью.
+    Задачи переживают перезапуск: незавершенные будут захвачены повторно.
+    """
+
+    def __init__(
+            self,
+            processor: Callable[[dict], Awaitable[None]],
+            workers: int = 4,
+            poll_interval: float = 5.0,
+            max_attempts: int = 10,
+            stale_after_seconds: int = 300,
+    ):
+        self._processor = processor
+        self._workers_count = workers
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._stale_after_seconds = stale_after_seconds
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._in_flight = 0
+        self._processed = 0
+        self._retried = 0
+        self._failed = 0
+
+    async def enqueue(self, dedup_key: str, kind: str, payload: dict) -> bool:
+        """Сохраняет задачу в БД и будит воркеров. Возвращает False для дубликата."""
+        created = await db.enqueue_webhook_job(dedup_key, kind, payload)
+        if created:
+            self._wakeup.set()
+        return created
+
+    def start(self):
+        """Запускает воркеры. Вызывается один раз при старте бота."""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self._workers_count)]
+        logger.info(f"Webhook job queue started with {self._workers_count} workers.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_metrics(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "in_flight": self._in_flight,
+            "processed": self._processed,
+            "retried": self._retried,
+            "failed": self._failed,
+        }
+
+    async def _worker(self, number: int):
+        while True:
+            try:
+                job = await db.claim_webhook_job(self._stale_after_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Webhook worker #{number}: failed to claim a job: {e}")
+                await asyncio.sleep(self._poll_interval)
+                continue
+
+            if job is None:
+                # Очередь пуста - ждем новую задачу или следующий опрос (на случай отложенных повторов)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job(job)
+
+    async def _run_job(self, job):
+        self._in_flight += 1
+        try:
+            await self._processor(job.payload)
+            await db.complete_webhook_job(job.id)
+            self._processed += 1
+        except asyncio.CancelledError:
+            # Задача останется в processing и будет захвачена повторно после перезапуска
+            raise
+        except PermanentJobError as e:
+            logger.error(f"Webhook job {job.id} ({job.dedup_key}) failed permanently: {e}")
+            await db.fail_webhook_job(job.id, repr(e), retry_in_seconds=None)
+            self._failed += 1
+        except Exception as e:
+            if job.attempts >= self._max_attempts:
+                logger.error(f"Webhook job {job.id} ({job.dedup_key}) failed permanently: {e}", exc_info=True)
+                await db.fail_webhook_job(job.id, repr(e), retry_in_seconds=None)
+                self._failed += 1
+            else:
+                # Экспоненциальная пауза между повторами: 10с, 20с, 40с ... но не более часа
+                retry_in = min(10 * 2 ** (job.attempts - 1), 3600)
+                logger.warning(f"Webhook job {job.id} ({job.dedup_key}) failed, retry in {retry_in}s: {e}")
+                await db.fail_webhook_job(job.id, repr(e), retry_in_seconds=retry_in)
+                self._retried += 1
+        finally:
+            self._in_flight -= 1
@@ -0,0 +1,145 @@
+# tgbot/services/worker_front.py
+
+import asyncio
+import itertools
+import json
+import os
+import sys
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+from loader import logger
+from tgbot.services.metrics import check_access
+
+# Пауза перед перезапуском упавшего воркера
+RESTART_DELAY = 1
+# Сколько ждать ответа воркера: он только ставит апдейт в очередь, так что отвечает быстро
+FORWARD_TIMEOUT = 10
+
+
+def affinity_key(update: dict) -> int:
+    """
+    Ключ привязки апдейта к воркеру - ID чата (для личных чатов совпадает с ID пользователя).
+
+    Для chat_member из каналов берем пользователя, а не канал: кэш подписок пользователя
+    живет в том воркере, который обрабатывает его личный чат.
+    """
+    for field, event in update.items():
+        if not isinstance(event, dict):
+            continue
+        if field == "chat_member":
+            return event["new_chat_member"]["user"]["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if event.get("from"):
+            return event["from"]["id"]
+    return update.get("update_id", 0)
+
+
+class WorkerFront:
+    """
+    Фронт для нескольких процессов бота в режиме вебхука.
+
+    Запускает workers копий бота (каждая слушает свой внутренний порт) и
+    перезапускает упавшие. Вебхуки Telegram распределяются по ID чата, поэтому
+    апдейты одного чата всегда обрабатывает один воркер и в исходном порядке.
+    Вебхуки YooKassa идут по кругу: очередь платежей общая, в БД. /metrics
+    собирает метрики всех воркеров.
+    """
+
+    def __init__(self, workers: int, base_port: int, webhook_path: str):
+        self._workers = workers
+        self._base_port = base_port
+        self._webhook_path = webhook_path
+        self._processes: dict[int, asyncio.subprocess.Process] = {}
+        self._supervisors: list[asyncio.Task] = []
+        self._session: ClientSession | None = None
+        self._round_robin = itertools.cycle(range(workers))
+        self._stopping = False
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self._webhook_path, self._telegram_handler)
+        app.router.add_post("/yookassa", self._yookassa_handler)
+        app.router.add_get("/metrics", self._metrics_handler)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    def run(self, host: str = "0.0.0.0", port: int = 8080):
+        logger.info(f"Starting webhook front with {self._workers} workers...")
+        web.run_app(self.create_app(), host=host, port=port)
+
+    def _worker_url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{self._base_port + index}{path}"
+
+    async def _on_startup(self, app: web.Application):
+        self._session = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+        self._supervisors = [asyncio.create_task(self._supervise(index)) for index in range(self._workers)]
+
+    async def _on_cleanup(self, app: web.Application):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in self._processes.values()), return_exceptions=True)
+        for task in self._supervisors:
+            task.cancel()
+        await self._session.close()
+
+    async def _supervise(self, index: int):
+        """Держит запущенным воркер с номером index."""
+        env = {**os.environ, "WORKER_INDEX": str(index)}
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, sys.argv[0], env=env)
+            self._processes[index] = process
+            logger.info(f"Worker #{index} started (pid {process.pid}, port {self._base_port + index}).")
+            returncode = await process.wait()
+            if self._stopping:
+                return
+            logger.error(f"Worker #{index} exited with code {returncode}, restarting in {RESTART_DELAY}s.")
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _forward(self, index: int, request: web.Request, body: bytes) -> web.Response:
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() in ("content-type", "x-telegram-bot-api-secret-token", "x-forwarded-for")
+        }
+        try:
+            async with self._session.post(self._worker_url(index, request.path), data=body, headers=headers) as response:
+                return web.Response(
+                    status=response.status,
+                    body=await response.read(),
+                    content_type=response.content_type
+                )
+        except (ClientError, asyncio.TimeoutError) as e:
+            # Воркер перезапускается или перегружен - отправитель повторит доставку
+            logger.warning(f"Worker #{index} is unavailable: {e}")
+            return web.Response(status=503)
+
+    async def _telegram_handler(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        return await self._forward(affinity_key(update) % self._workers, request, body)
+
+    async def _yookassa_handler(self, request: web.Request) -> web.Response:
+        return await self._forward(next(self._round_robin), request, await request.read())
+
+    async def _metrics_handler(self, request: web.Request) -> web.Response:
+        check_access(request)
+        # Воркеры проверяют тот же токен
+        headers = {"Authorization": request.headers["Authorization"]}
+
+        async def fetch(index: int):
+            try:
+                async with self._session.get(self._worker_url(index, "/metrics"), headers=headers) as response:
+                    return await response.json()
+            except Exception as e:
+                return {"error": str(e)}
+
+        snapshots = await asyncio.gather(*(fetch(index) for index in range(self._workers)))
+        return web.json_response({f"worker_{index}": snapshot for index, snapshot in enumerate(snapshots)})
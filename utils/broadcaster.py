@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from typing import Union
 
@@ -6,6 +5,10 @@ from aiogram import Bot
 from aiogram import exceptions
 from aiogram.types import InlineKeyboardMarkup
 
+from database import requests as db
+from tgbot.middlewares.rate_limit import SendPriority, send_priority
+from tgbot.services.utils import is_unreachable_chat_error
+
 
 async def send_message(
         bot: Bot,
@@ -31,18 +34,11 @@ async def send_message(
             disable_notification=disable_notification,
             reply_markup=reply_markup,
         )
-    except exceptions.TelegramBadRequest as e:
-        logging.error("Telegram server says - Bad Request: chat not found")
-    except exceptions.TelegramForbiddenError:
-        logging.error(f"Target [ID:{user_id}]: got TelegramForbiddenError")
-    except exceptions.TelegramRetryAfter as e:
-        logging.error(
-            f"Target [ID:{user_id}]: Flood limit is exceeded. Sleep {e.retry_after} seconds."
-        )
-        await asyncio.sleep(e.retry_after)
-        return await send_message(
-            bot, user_id, text, disable_notification, reply_markup
-        )  # Recursive call
+    except (exceptions.TelegramBadRequest, exceptions.TelegramForbiddenError) as e:
+        logging.error(f"Target [ID:{user_id}]: {e.message}")
+        if is_unreachable_chat_error(e):
+            # Exclude the user from bulk sends until they /start the bot again
+            await db.mark_users_unreachable([int(user_id)])
     except exceptions.TelegramAPIError:
         logging.exception(f"Target [ID:{user_id}]: failed")
     else:
@@ -69,14 +65,13 @@ async def broadcast(
     """
     count = 0
     try:
-        for user_id in users:
-            if await send_message(
-                    bot, user_id, text, disable_notification, reply_markup
-            ):
-                count += 1
-            await asyncio.sleep(
-                0.05
-            )  # 20 messages per second (Limit: 30 messages per second)
+        # Limits and flood control backoff are handled by the bot session rate limiter
+        with send_priority(SendPriority.BULK):
+            for user_id in users:
+                if await send_message(
+                        bot, user_id, text, disable_notification, reply_markup
+                ):
+                    count += 1
     finally:
         logging.info(f"{count} messages successful sent.")
 